@@ -1,4 +1,7 @@
-from sqlalchemy import create_engine
+import time
+from contextlib import asynccontextmanager
+from sqlalchemy import create_engine, event
+from sqlalchemy.ext.asyncio import AsyncEngine, AsyncSession, async_sessionmaker, create_async_engine
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
 from app.config import settings
@@ -17,4 +20,115 @@ def get_db():
     try:
         yield db
     finally:
-        db.close()
\ No newline at end of file
+        db.close()
+
+
+# Async layer shared by the API routes and the queue consumer
+
+def async_database_url(url: str) -> str:
+    """Map a sync URL onto its asyncio driver (asyncpg / aiosqlite)."""
+    scheme, _, rest = url.partition("://")
+    if scheme in ("postgres", "postgresql", "postgresql+psycopg2"):
+        return f"postgresql+asyncpg://{rest}"
+    if scheme == "sqlite":
+        return f"sqlite+aiosqlite://{rest}"
+    return url
+
+
+class DBStats:
+    """Pool checkout-wait and query-latency counters for one engine."""
+
+    def __init__(self):
+        self.checkouts = 0
+        self.checkout_wait_total = 0.0
+        self.checkout_wait_max = 0.0
+        self.queries = 0
+        self.query_time_total = 0.0
+        self.query_time_max = 0.0
+        self.slow_queries = 0
+
+    def record_checkout(self, wait: float) -> None:
+        self.checkouts += 1
+        self.checkout_wait_total += wait
+        self.checkout_wait_max = max(self.checkout_wait_max, wait)
+
+    def record_query(self, elapsed: float) -> None:
+        self.queries += 1
+        self.query_time_total += elapsed
+        self.query_time_max = max(self.query_time_max, elapsed)
+        if elapsed * 1000 >= settings.db_slow_query_ms:
+            self.slow_queries += 1
+
+    def snapshot(self, engine: AsyncEngine | None = None) -> dict:
+        data = {
+            "checkouts": self.checkouts,
+            "checkout_wait_avg_ms": round(self.checkout_wait_total / self.checkouts * 1000, 3) if self.checkouts else 0,
+            "checkout_wait_max_ms": round(self.checkout_wait_max * 1000, 3),
+            "queries": self.queries,
+            "query_avg_ms": round(self.query_time_total / self.queries * 1000, 3) if self.queries else 0,
+            "query_max_ms": round(self.query_time_max * 1000, 3),
+            "slow_queries": self.slow_queries,
+        }
+        if engine is not None:
+            data["pool"] = engine.pool.status()
+        return data
+
+
+def _instrument(async_engine: AsyncEngine, stats: DBStats) -> None:
+    @event.listens_for(async_engine.sync_engine, "before_cursor_execute")
+    def _before(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("query_start", []).append(time.perf_counter())
+
+    @event.listens_for(async_engine.sync_engine, "after_cursor_execute")
+    def _after(conn, cursor, statement, parameters, context, executemany):
+        stats.record_query(time.perf_counter() - conn.info["query_start"].pop())
+
+
+def create_async_db_engine(url: str | None = None, stats: DBStats | None = None) -> AsyncEngine:
+    url = async_database_url(url or settings.database_url)
+    kwargs: dict = {"pool_pre_ping": True}
+
+    if url.startswith("postgresql+asyncpg"):
+        kwargs.update(
+            pool_size=settings.db_pool_size,
+            max_overflow=settings.db_max_overflow,
+            pool_recycle=settings.db_pool_recycle,
+            pool_timeout=settings.db_pool_timeout,
+            connect_args={"server_settings": {"statement_timeout": str(settings.db_statement_timeout_ms)}},
+        )
+
+    async_engine = create_async_engine(url, **kwargs)
+    _instrument(async_engine, stats or db_stats)
+    return async_engine
+
+
+db_stats = DBStats()
+async_engine = create_async_db_engine()
+AsyncSessionLocal = async_sessionmaker(bind=async_engine, autoflush=False, expire_on_commit=False)
+
+
+@asynccontextmanager
+async def session_scope(session_factory: async_sessionmaker | None = None, stats: DBStats | None = None):
+    """Yield an AsyncSession with its connection checked out, recording the wait."""
+    session: AsyncSession = (session_factory or AsyncSessionLocal)()
+    try:
+        started = time.perf_counter()
+        await session.connection()
+        (stats or db_stats).record_checkout(time.perf_counter() - started)
+        yield session
+    finally:
+        await session.close()
+
+
+# Dependency to get an async database session
+async def get_async_db():
+    async with session_scope() as session:
+        yield session
+
+
+def pool_stats() -> dict:
+    return db_stats.snapshot(async_engine)
+
+
+async def dispose_async_engine() -> None:
+    await async_engine.dispose()
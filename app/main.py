@@ -1,19 +1,41 @@
-from fastapi import FastAPI, HTTPException, Request
+from fastapi import FastAPI, Header, HTTPException, Request
 from pydantic import BaseModel, EmailStr
 import asyncio
-import signal
-import platform
 import os
 import json
-from fastapi.responses import HTMLResponse
+import secrets
+import time
+from datetime import datetime, timedelta, timezone
+from fastapi.responses import HTMLResponse, PlainTextResponse, StreamingResponse
 import logging
 from logging.handlers import RotatingFileHandler
 from fastapi.staticfiles import StaticFiles
-from app.services.queue_publisher import publish_email
-from app.services.queue_consumer import consume
-from app.utils.logger import get_logger
+from app.services.queue_publisher import batch_publisher, build_message, close_publisher, open_channel, publish_email, publish_message
+from app.services.content_store import ContentTooLarge, attachment_store, check_content_store, run_content_sweeper
+from app.services.claim_check import body_cache, body_store, claim_check, retain_content
+from app.services.outbox import outbox
+from app.services.scheduler import as_utc, scheduler
+from app.services.queue_consumer import consume, email_status_store as consumer_status_store, expired_stats, tenant_stats
+from app.services.tenants import api_key_tenants, resolve_tenant
+from app.services.admission import Rejected, admission
+from app.services.webhooks import allowed_callback_host, valid_callback_url, webhooks
+from app.services.suppression import suppression
+from app.services.status_hub import status_bus, status_hub
+from app.services.rate_limiter import send_rate_limiter
+from app.services.relay_router import relay_router
+from app.services.envelope_merger import envelope_merger
+from app.services.render_pool import render_pool
+from app.services.autoscaler import autoscaler_stats, fleet
+from app.utils.logger import TRACE_FORMAT, TraceContextFilter, flush_logs, get_logger, record_context
+from app.utils import tracing
+from app.utils.profiling import profile_event_loop, profile_running, stage_timer
+from app.utils.traffic_capture import traffic_capture
+from app.utils.runtime import runs_consumer, service_role
 from app.services.email_sender import send_email_async
 from app.config import settings
+from app.db import async_engine, dispose_async_engine, pool_stats, session_scope
+from app.models import EmailStatusEnum
+from app.services.status_store import create_status_schema, get_status, record_final_status, record_message, run_retention_job
 
 if os.name == "nt":
     import ctypes
@@ -26,16 +48,17 @@ app.mount("/static", StaticFiles(directory="app/static"), name="static")
 # Logging setup (console + rotating file)
 os.makedirs("logs", exist_ok=True)
 
-log_formatter = logging.Formatter(
-    "%(asctime)s | %(levelname)s | %(name)s | %(message)s"
-)
+# Lines carry the trace and span ids, so they can be joined with /admin/traces/{trace_id}
+log_formatter = logging.Formatter(TRACE_FORMAT)
 log_file = "logs/email_service.log"
 
 file_handler = RotatingFileHandler(log_file, maxBytes=10_000_000, backupCount=5)
 file_handler.setFormatter(log_formatter)
+file_handler.addFilter(TraceContextFilter())
 
 console_handler = logging.StreamHandler()
 console_handler.setFormatter(log_formatter)
+console_handler.addFilter(TraceContextFilter())
 
 logger = logging.getLogger("email_service_app")
 logger.setLevel(logging.INFO)
@@ -45,6 +68,8 @@ if not logger.handlers:
     logger.addHandler(console_handler)
 
 email_status_store: dict[str, str] = {}
+# Transitions from worker processes arrive over the status exchange
+status_bus.listeners.append(email_status_store.__setitem__)
 
 # Models
 class EmailRequest(BaseModel):
@@ -53,10 +78,21 @@ class EmailRequest(BaseModel):
     body: str
     request_id: str | None = None
     priority: int | None = 1
+    attachments: list[str] | None = None  # ids returned by POST /attachments
+    send_at: datetime | None = None  # ISO 8601 with offset, e.g. 09:00 in the recipient's zone; naive = UTC
+    # Free-form. meta["tenant"] selects the tenant while TENANT_API_KEYS is unset (then X-API-Key does);
+    # meta["callback_url"] receives the delivery-status webhook (API key or WEBHOOK_ALLOWED_HOSTS)
+    meta: dict | None = None
+    expires_at: datetime | None = None  # not sent after this (e.g. OTPs); naive = UTC
+    ttl: float | None = None  # seconds from now; with expires_at, the earlier deadline wins
 
 class StatusRequest(BaseModel):
     request_id: str
 
+class SuppressionRequest(BaseModel):
+    value: str  # an address, or a domain ("example.com") to suppress all of it
+    reason: str | None = None
+
 # Middleware for logging
 @app.middleware("http")
 async def log_requests(request: Request, call_next):
@@ -71,6 +107,39 @@ async def log_requests(request: Request, call_next):
         logger.error(f"Request failed: {request.method} {request.url} | Error: {str(e)}")
         raise
 
+# Sampled, anonymized capture of /send_email traffic for replay_traffic.py
+@app.middleware("http")
+async def capture_traffic(request: Request, call_next):
+    if not traffic_capture.should_capture(request.method, request.url.path):
+        return await call_next(request)
+    body = await request.body()  # cached by Starlette, the endpoint still reads it
+    started = time.perf_counter()
+    response = await call_next(request)
+    elapsed = time.perf_counter() - started
+    try:
+        payload = json.loads(body)
+    except ValueError:
+        payload = None
+    if isinstance(payload, dict):
+        meta = payload.get("meta") if isinstance(payload.get("meta"), dict) else None
+        tenant = resolve_tenant(meta, request.headers.get("x-api-key"))
+        traffic_capture.record(payload, response.status_code, elapsed, tenant)
+    return response
+
+# Outermost: continues an incoming traceparent (or starts a trace) so every log line and span carries it
+@app.middleware("http")
+async def trace_requests(request: Request, call_next):
+    token = tracing.activate(tracing.extract(request.headers) or tracing.new_trace())
+    try:
+        with tracing.span("api", method=request.method, path=request.url.path) as context:
+            response = await call_next(request)
+            context.attributes["status"] = response.status_code
+        response.headers["traceparent"] = context.traceparent
+        response.headers["X-Trace-Id"] = context.trace_id
+        return response
+    finally:
+        tracing.deactivate(token)
+
 # Routes
 @app.get("/", response_class=HTMLResponse)
 async def root():
@@ -100,21 +169,133 @@ async def root():
 @app.get("/health")
 async def health_check():
     logger.info("Health check OK")
-    return {"status": "ok", "service": "email_service"}
+    return {"status": "ok", "service": "email_service", "role": service_role()}
 
 @app.post("/send_email")
-async def send_email_endpoint(payload: EmailRequest):
+async def send_email_endpoint(request: Request, payload: EmailRequest, x_api_key: str | None = Header(default=None)):
+    record_context.request_id = str(payload.request_id or payload.to)
+    tracing.annotate(request_id=record_context.request_id)
     logger.info(f"Email send request: to={payload.to}, subject={payload.subject}, id={payload.request_id}")
     try:
-        await publish_email(payload.to, payload.subject, payload.body)
+        await admission.admit(payload.priority or 1, x_api_key or (request.client.host if request.client else None))
+    except Rejected as e:
+        logger.warning(f"Email rejected, overloaded: to={payload.to} reason={e.reason}")
+        raise HTTPException(status_code=429, detail=f"Overloaded: {e.reason}", headers={"Retry-After": e.retry_after_header})
+    suppressed = suppression.check(payload.to)
+    if suppressed:
+        logger.info(f"Email rejected, recipient suppressed: to={payload.to} match={suppressed}")
+        raise HTTPException(status_code=422, detail=f"Recipient is suppressed ({suppressed})")
+    missing = [digest for digest in payload.attachments or [] if not await attachment_store.exists(digest)]
+    if missing:
+        raise HTTPException(status_code=400, detail=f"Unknown attachment id(s): {', '.join(missing)}")
+    if "\r" in payload.subject or "\n" in payload.subject:
+        raise HTTPException(status_code=400, detail="subject may not contain line breaks")
+    callback = (payload.meta or {}).get("callback_url")
+    if callback is not None and not (isinstance(callback, str) and valid_callback_url(callback)):
+        raise HTTPException(status_code=400, detail="meta.callback_url must be an http(s) URL to a public address")
+    if callback is not None and x_api_key not in api_key_tenants() and not allowed_callback_host(callback):
+        raise HTTPException(status_code=403, detail="meta.callback_url needs a tenant API key or a host in WEBHOOK_ALLOWED_HOSTS")
+    send_at = as_utc(payload.send_at) if payload.send_at else None
+    if send_at and send_at > datetime.now(timezone.utc) and not scheduler.running:
+        raise HTTPException(status_code=400, detail="Scheduled sends are disabled (SCHEDULER_ENABLED=false)")
+    expires_at = as_utc(payload.expires_at) if payload.expires_at else None
+    if payload.ttl is not None:
+        if payload.ttl <= 0:
+            raise HTTPException(status_code=400, detail="ttl must be positive")
+        by_ttl = datetime.now(timezone.utc) + timedelta(seconds=payload.ttl)
+        expires_at = min(expires_at, by_ttl) if expires_at else by_ttl
+    if expires_at and (expires_at <= datetime.now(timezone.utc) or (send_at and expires_at <= send_at)):
+        raise HTTPException(status_code=400, detail="expires_at must be in the future and after send_at")
+    message: dict = {}
+    try:
+        message = build_message(
+            payload.to,
+            payload.subject,
+            payload.body,
+            payload.request_id,
+            payload.priority or 1,
+            payload.attachments,
+            tenant=resolve_tenant(payload.meta, x_api_key),
+            meta=payload.meta,
+            expires_at=expires_at,
+        )
+        message = await claim_check(message)
+        await retain_content(message, send_at, expires_at)
+        scheduled = bool(send_at and send_at > datetime.now(timezone.utc))
+        if settings.status_store_enabled:
+            # Before the publish: the message carries the row's created_at, and the consumer may finish first
+            await record_message(message, EmailStatusEnum.scheduled if scheduled else EmailStatusEnum.pending)
+        if scheduled:
+            schedule_id = await scheduler.schedule(message, send_at)
+            key = str(payload.request_id or payload.to)
+            email_status_store[key] = "scheduled"
+            status_hub.publish(key, "scheduled", send_at=send_at.isoformat())
+            logger.info(f"Email scheduled: {payload.to} | request_id={key} | send_at={send_at.isoformat()}")
+            return {
+                "success": True,
+                "message": "Email scheduled for delivery",
+                "data": {"schedule_id": str(schedule_id), "send_at": send_at.isoformat()},
+            }
+        if outbox.enabled:
+            # Durable local append; the relay forwards to RabbitMQ in the background
+            await outbox.append(message)
+        else:
+            await publish_message(message)
         key = str(payload.request_id or payload.to)
         email_status_store[key] = "pending"
+        status_hub.publish(key, "pending")
         logger.info(f"Email queued successfully: {payload.to} | request_id={key}")
         return {"success": True, "message": "Email queued for delivery"}
     except Exception as e:
         logger.error(f"Failed to queue email: {str(e)} for {payload.to}")
+        # The row was written before the publish: it must not stay pending for a message never queued
+        await record_final_status(message, EmailStatusEnum.failed, f"Failed to queue email: {e}")
         raise HTTPException(status_code=500, detail=f"Failed to queue email: {str(e)}")
 
+@app.post("/attachments")
+async def upload_attachment(request: Request, filename: str = "attachment"):
+    """Store the raw request body once, keyed by its SHA-256; send the id in EmailRequest.attachments."""
+    if "\r" in filename or "\n" in filename:
+        raise HTTPException(status_code=400, detail="filename may not contain line breaks")
+    content_type = request.headers.get("content-type") or "application/octet-stream"
+    try:
+        digest, size, deduplicated = await attachment_store.put_stream(
+            request.stream(),
+            metadata={"filename": filename, "content_type": content_type},
+            max_bytes=settings.attachment_max_bytes,
+        )
+    except ContentTooLarge as e:
+        raise HTTPException(status_code=413, detail=str(e))
+    logger.info(f"Attachment stored: id={digest} size={size} deduplicated={deduplicated}")
+    return {"success": True, "data": {"attachment_id": digest, "size": size, "deduplicated": deduplicated}}
+
+@app.post("/suppressions")
+async def add_suppression(request: Request, payload: SuppressionRequest):
+    require_admin(request)
+    if not suppression.enabled:
+        raise HTTPException(status_code=400, detail="Suppression list is disabled (SUPPRESSION_SOURCE is not set)")
+    if not suppression.writable:
+        raise HTTPException(status_code=400, detail="SUPPRESSION_SOURCE=file is read-only: edit SUPPRESSION_FILE, or use database")
+    await suppression.add(payload.value, payload.reason)
+    logger.info(f"Suppression added: value={payload.value} reason={payload.reason}")
+    return {"success": True}
+
+@app.delete("/suppressions/{value}")
+async def remove_suppression(request: Request, value: str):
+    require_admin(request)
+    if not suppression.enabled:
+        raise HTTPException(status_code=400, detail="Suppression list is disabled (SUPPRESSION_SOURCE is not set)")
+    if not suppression.writable:
+        raise HTTPException(status_code=400, detail="SUPPRESSION_SOURCE=file is read-only: edit SUPPRESSION_FILE, or use database")
+    await suppression.remove(value)
+    logger.info(f"Suppression removed: value={value}")
+    return {"success": True}
+
+@app.get("/suppressions/check")
+async def check_suppression(address: str):
+    match = suppression.check(address)
+    return {"address": address, "suppressed": match is not None, "match": match}
+
 @app.get("/test_smtp")
 async def test_smtp():
     to_test_email = settings.smtp_user
@@ -129,10 +310,129 @@ async def test_smtp():
 async def status_endpoint(payload: StatusRequest):
     logger.info(f"Status check for request_id={payload.request_id}")
     status = email_status_store.get(payload.request_id)
+    if not status and settings.status_store_enabled:
+        # Set by another process (worker, sibling API worker) or before a restart
+        async with session_scope() as session:
+            row = await get_status(session, payload.request_id)
+        status = row.status.value if row else None
     if not status:
         raise HTTPException(status_code=404, detail="Request ID not found")
     return {"request_id": payload.request_id, "status": status}
 
+@app.get("/metrics")
+async def metrics():
+    return {
+        "outbox": outbox.stats(),
+        "publisher": batch_publisher.stats(),
+        "db": pool_stats(),
+        "status_hub": status_hub.stats(),
+        "status_bus": status_bus.stats(),
+        "send_rate": send_rate_limiter.stats(),
+        "smtp_relays": relay_router.stats(),
+        "envelope_merge": envelope_merger.stats(),
+        "render_pool": render_pool.stats(),
+        "body_cache": body_cache.stats(),
+        "consumer": autoscaler_stats(),
+        "scheduler": scheduler.stats(),
+        "tenants": tenant_stats(),
+        "expired": expired_stats(),
+        "admission": admission.stats(),
+        "webhooks": webhooks.stats(),
+        "suppression": suppression.stats(),
+        "traffic_capture": traffic_capture.stats(),
+        "tracing": tracing.exporter.stats() if tracing.exporter else None,
+        "stages": stage_timer.stats(),
+    }
+
+def require_admin(request: Request) -> None:
+    token = request.headers.get("x-admin-token", "")
+    if not settings.admin_token or not secrets.compare_digest(token, settings.admin_token):
+        raise HTTPException(status_code=403, detail="Admin token required")
+
+@app.get("/admin/profile")
+async def admin_profile(
+    request: Request,
+    seconds: float = 10,
+    interval_ms: float = 5,
+    slow_callback_ms: float = 50,
+    format: str = "collapsed",
+):
+    """Sample the live event loop for `seconds`.
+
+    format=collapsed returns folded stacks for flamegraph.pl / speedscope;
+    format=json returns loop lag, slow callbacks and per-stage timings.
+    """
+    require_admin(request)
+    if not 0 < seconds <= settings.profile_max_seconds or interval_ms < 1:
+        raise HTTPException(status_code=400, detail=f"seconds must be in (0, {settings.profile_max_seconds}], interval_ms >= 1")
+    if profile_running():
+        raise HTTPException(status_code=409, detail="A profile is already running")
+
+    logger.info(f"Profiling event loop: seconds={seconds} interval_ms={interval_ms}")
+    profiler = await profile_event_loop(seconds, interval_ms, slow_callback_ms)
+    if format == "json":
+        return profiler.summary()
+    return PlainTextResponse(
+        profiler.collapsed(),
+        headers={"Content-Disposition": 'attachment; filename="event-loop.folded"'},
+    )
+
+@app.get("/admin/traces/{trace_id}")
+async def admin_trace(request: Request, trace_id: str):
+    """Spans of one trace (X-Trace-Id of a /send_email response) with per-stage totals.
+
+    Needs TRACE_EXPORTER=file; spans from API and worker processes land in the same TRACE_FILE.
+    """
+    require_admin(request)
+    if not isinstance(tracing.exporter, tracing.FileSpanExporter):
+        raise HTTPException(status_code=400, detail="Trace lookup needs TRACE_EXPORTER=file")
+    await tracing.exporter.flush()
+    spans = await asyncio.to_thread(tracing.read_trace, trace_id.lower(), tracing.exporter.path)
+    if not spans:
+        raise HTTPException(status_code=404, detail="Trace not found")
+    return {"trace_id": trace_id, "breakdown": tracing.breakdown(spans), "spans": spans}
+
+@app.get("/status/stream")
+async def status_stream(request_ids: str | None = None):
+    """Server-Sent Events feed of status transitions.
+
+    ?request_ids=a,b limits the feed to those requests (their current status is
+    sent first); without it every transition is streamed.
+    """
+    ids = [rid.strip() for rid in request_ids.split(",") if rid.strip()] if request_ids else None
+    subscription = status_hub.subscribe(ids)
+
+    async def event_source():
+        try:
+            for rid in ids or []:
+                current = consumer_status_store.get(rid) or email_status_store.get(rid)
+                if not current and settings.status_store_enabled:
+                    async with session_scope() as session:
+                        row = await get_status(session, rid)
+                    current = row.status.value if row else None
+                if current:
+                    yield f"event: status\ndata: {json.dumps({'request_id': rid, 'status': current})}\n\n".encode()
+            async for chunk in subscription.stream(settings.status_stream_heartbeat):
+                yield chunk
+        finally:
+            status_hub.unsubscribe(subscription)
+
+    return StreamingResponse(
+        event_source(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+@app.get("/scaling")
+async def scaling():
+    """Desired worker replicas for an external autoscaler (KEDA metrics-api / HPA).
+
+    Computed over the whole fleet from the reports worker processes publish
+    on AUTOSCALER_REPORTS_EXCHANGE, plus this process's own consumer (SERVICE_ROLE=both).
+    """
+    stats = autoscaler_stats()
+    return {"desired_replicas": stats.get("desired_replicas", 1), "queue_depth": stats.get("queue_depth", 0)}
+
 @app.post("/retry_failed")
 async def retry_failed_endpoint():
     logger.info("Retry failed emails triggered")
@@ -141,46 +441,82 @@ async def retry_failed_endpoint():
 
 # Background consumer
 consumer_task: asyncio.Task | None = None
+consumer_stop: asyncio.Event | None = None
 
 async def start_consumer():
-    global consumer_task
-    loop = asyncio.get_running_loop()
-
-    if platform.system() != "Windows":
-        def shutdown_signal_handler():
-            if consumer_task:
-                consumer_task.cancel()
-        loop.add_signal_handler(signal.SIGTERM, shutdown_signal_handler)
-        loop.add_signal_handler(signal.SIGINT, shutdown_signal_handler)
+    # SIGTERM/SIGINT are left to uvicorn: it stops serving, then on_shutdown drains the consumer
+    global consumer_task, consumer_stop
+    consumer_stop = asyncio.Event()
 
-    while True:
+    while not consumer_stop.is_set():
         try:
-            consumer_task = asyncio.create_task(consume())
+            consumer_task = asyncio.create_task(consume(consumer_stop))
             await consumer_task
         except asyncio.CancelledError:
             break
         except Exception as e:
             logger.error(f"Consumer crashed: {e}. Restarting in 5 seconds...")
-            await asyncio.sleep(5)
+            try:
+                await asyncio.wait_for(consumer_stop.wait(), 5)
+            except asyncio.TimeoutError:
+                pass
 
 async def stop_consumer():
-    global consumer_task
+    """Drain: no new deliveries, in-flight ones finish (up to DRAIN_TIMEOUT), then the connection closes."""
+    if consumer_stop:
+        consumer_stop.set()
     if consumer_task and not consumer_task.done():
-        consumer_task.cancel()
         try:
-            await consumer_task
+            await asyncio.wait_for(asyncio.shield(consumer_task), settings.drain_timeout + 5)
+        except asyncio.TimeoutError:
+            logger.warning("Consumer did not drain in time, cancelling it.")
+            consumer_task.cancel()
+            await asyncio.gather(consumer_task, return_exceptions=True)
         except asyncio.CancelledError:
             logger.info("Consumer task cancelled successfully.")
+        except Exception as e:
+            logger.error(f"Consumer failed while draining: {e}")
 
 @app.on_event("startup")
 async def on_startup():
-    logger.info("Service startup — launching consumer task.")
-    asyncio.create_task(start_consumer())
+    check_content_store(service_role())
+    if settings.outbox_enabled:
+        await outbox.start()
+    if settings.scheduler_enabled:
+        await scheduler.start()
+    if suppression.enabled:
+        await suppression.start()
+    if settings.status_store_enabled:
+        async with async_engine.begin() as conn:
+            await create_status_schema(conn)
+    if settings.status_retention_enabled:
+        asyncio.create_task(run_retention_job(async_engine))
+    if settings.content_retention_seconds:
+        asyncio.create_task(run_content_sweeper([attachment_store, body_store]))
+    if status_bus.enabled:
+        asyncio.create_task(status_bus.run(open_channel))
+    if settings.autoscaler_reports_exchange:
+        asyncio.create_task(fleet.run(open_channel))
+    if runs_consumer():
+        logger.info("Service startup — launching consumer task.")
+        asyncio.create_task(start_consumer())
+    else:
+        logger.info("Service startup — API role, consumers run in worker processes.")
 
 @app.on_event("shutdown")
 async def on_shutdown():
     await stop_consumer()
+    await webhooks.close()
+    await scheduler.stop()
+    await suppression.stop()
+    await traffic_capture.close()
+    await tracing.close_exporter()
+    render_pool.close()
+    await outbox.stop()
+    await close_publisher()
+    await dispose_async_engine()
     logger.info("Application shutdown complete.")
+    flush_logs()
 
 # Logs viewer
 @app.get("/logs", response_class=HTMLResponse)
@@ -1,29 +1,139 @@
 # app/models.py
-from sqlalchemy import Column, Integer, String, DateTime, Text, JSON, Enum
+from datetime import datetime, timezone
+from sqlalchemy import BigInteger, Boolean, Column, Integer, LargeBinary, String, DateTime, Text, JSON, Enum, Index
 from sqlalchemy.sql import func
 from sqlalchemy.dialects.postgresql import JSONB
 from sqlalchemy.orm import declarative_base
 import enum
+import itertools
+import random
+import time
 
 Base = declarative_base()
 
+# Random start keeps ids from separate processes apart within the same millisecond
+_id_sequence = itertools.count(random.getrandbits(22))
+
+
+def generate_status_id() -> int:
+    """Time-ordered 63-bit id (ms timestamp + 22-bit counter).
+
+    Partitioned tables need the partition key in the primary key, so ids are
+    generated client-side instead of from a per-table serial.
+    """
+    return (int(time.time() * 1000) << 22) | (next(_id_sequence) & 0x3FFFFF)
+
+
+def utcnow() -> datetime:
+    return datetime.now(timezone.utc)
+
+
 class EmailStatusEnum(str, enum.Enum):
     queued = "queued"
     sending = "sending"
     sent = "sent"
     failed = "failed"
+    # The statuses /send_email and the consumer report
+    pending = "pending"
+    scheduled = "scheduled"
+    delivered = "delivered"
+    suppressed = "suppressed"
+    expired = "expired"
 
 class EmailStatus(Base):
+    """Hot status table, range-partitioned by month on created_at in Postgres.
+
+    Partitions are named email_status_YYYY_MM and managed by
+    app.services.status_store; indexes below are created on every partition.
+    """
     __tablename__ = "email_status"
+    __table_args__ = (
+        Index("ix_email_status_request_id", "request_id"),
+        Index("ix_email_status_to_email_created", "to_email", "created_at", "id"),
+        Index("ix_email_status_status_created", "status", "created_at", "id"),
+        {"postgresql_partition_by": "RANGE (created_at)"},
+    )
 
-    id = Column(Integer, primary_key=True, index=True)
-    request_id = Column(String(128), unique=True, nullable=False, index=True)
-    to_email = Column(String(254), nullable=False, index=True)
+    id = Column(BigInteger().with_variant(Integer, "sqlite"), primary_key=True, default=generate_status_id)
+    request_id = Column(String(128), nullable=False)
+    to_email = Column(String(254), nullable=False)
     subject = Column(String(512), nullable=True)
-    body = Column(Text, nullable=True)
+    body = Column(Text, nullable=True)  # NULL when bodies are offloaded to email_body
     status = Column(Enum(EmailStatusEnum), default=EmailStatusEnum.queued, nullable=False)
     attempt = Column(Integer, default=0)
     last_error = Column(Text, nullable=True)
-    meta = Column(JSONB, default={})
-    created_at = Column(DateTime(timezone=True), server_default=func.now())
+    meta = Column(JSON().with_variant(JSONB, "postgresql"), default={})
+    created_at = Column(DateTime(timezone=True), primary_key=True, default=utcnow, server_default=func.now())
     updated_at = Column(DateTime(timezone=True), onupdate=func.now())
+
+class EmailBody(Base):
+    """Cold storage for message bodies kept out of the hot status partitions.
+
+    Keyed like its status row and partitioned by the same months, so
+    retention drops a month's bodies together with its statuses.
+    """
+    __tablename__ = "email_body"
+    __table_args__ = ({"postgresql_partition_by": "RANGE (created_at)"},)
+
+    request_id = Column(String(128), primary_key=True)
+    created_at = Column(DateTime(timezone=True), primary_key=True, default=utcnow)
+    body = Column(Text, nullable=False)
+
+class ScheduledEmail(Base):
+    """Messages waiting for their send_at; rows are deleted once published.
+
+    A scheduler claims rows entering its near horizon by setting claimed_by
+    and lease_until, so several API replicas can share the table.
+    """
+    __tablename__ = "scheduled_email"
+    __table_args__ = (
+        Index("ix_scheduled_email_due", "send_at", "id"),
+        Index("ix_scheduled_email_claimed_by", "claimed_by"),
+    )
+
+    id = Column(BigInteger().with_variant(Integer, "sqlite"), primary_key=True, default=generate_status_id)
+    request_id = Column(String(128), nullable=True)
+    send_at = Column(DateTime(timezone=True), nullable=False)
+    payload = Column(JSON().with_variant(JSONB, "postgresql"), nullable=False)
+    claimed_by = Column(String(128), nullable=True)
+    lease_until = Column(DateTime(timezone=True), nullable=True)
+    created_at = Column(DateTime(timezone=True), default=utcnow, server_default=func.now())
+
+class SuppressionEntry(Base):
+    """Suppressed address ("user@example.com") or domain ("@example.com").
+
+    Removal sets active=False instead of deleting so replicas can pick the
+    change up incrementally by updated_at.
+    """
+    __tablename__ = "suppression"
+    __table_args__ = (Index("ix_suppression_updated_at", "updated_at"),)
+
+    value = Column(String(254), primary_key=True)
+    reason = Column(String(64), nullable=True)
+    active = Column(Boolean, nullable=False, default=True)
+    updated_at = Column(DateTime(timezone=True), nullable=False, default=utcnow)
+
+class ContentBlob(Base):
+    """Content-addressed blob (an attachment or a claim-checked body) every process can read.
+
+    store separates the attachment and body namespaces. The bytes are split
+    over content_chunk rows so they can be written and streamed in pieces;
+    keep_until is when the sweep may delete the blob (NULL = never).
+    """
+    __tablename__ = "content_blob"
+    __table_args__ = (Index("ix_content_blob_keep_until", "keep_until"),)
+
+    store = Column(String(32), primary_key=True)
+    digest = Column(String(64), primary_key=True)
+    size = Column(BigInteger, nullable=False)
+    meta = Column(JSON().with_variant(JSONB, "postgresql"), nullable=True)
+    keep_until = Column(DateTime(timezone=True), nullable=True)
+    created_at = Column(DateTime(timezone=True), default=utcnow, server_default=func.now())
+
+class ContentChunk(Base):
+    __tablename__ = "content_chunk"
+
+    store = Column(String(32), primary_key=True)
+    digest = Column(String(64), primary_key=True)
+    seq = Column(Integer, primary_key=True)
+    data = Column(LargeBinary, nullable=False)
@@ -0,0 +1,194 @@
+import asyncio
+import json
+import math
+import time
+from collections import Counter, OrderedDict
+from typing import Awaitable, Callable
+from app.config import settings
+from app.services.rate_limiter import TokenBucket
+from app.utils.logger import get_logger
+
+logger = get_logger("admission")
+
+SIGNALS = ("queue_depth", "outbox_bytes", "lag_seconds")
+# A signal not read for this many refresh intervals is not trusted to shed load
+STALE_INTERVALS = 5
+MAX_CLIENTS = 10_000
+
+
+async def sample_load() -> dict:
+    """Broker backlog, outbox backlog and the consumers' lag.
+
+    Each signal is sampled on its own; one that cannot be read is None, so a
+    broker outage still leaves the outbox backlog (which then grows) to act on.
+    lag_seconds is the larger of the fleet's estimated drain time and how long
+    its oldest waiting message has been queued; both come from the worker
+    autoscalers' reports when consumers run in other processes.
+    """
+    from app.services import autoscaler
+    from app.services.outbox import outbox
+    from app.services.queue_publisher import queue_depths
+
+    try:
+        depth = sum((await queue_depths()).values())
+    except Exception as e:
+        logger.warning({"status": "admission_sample_failed", "signal": "queue_depth", "error": str(e)})
+        depth = None
+    outbox_bytes = outbox.stats().get("backlog_bytes", 0) if outbox.enabled else 0
+    consumers = autoscaler.autoscaler_stats()
+    lags = [consumers.get("queue_wait_seconds")]
+    if depth is not None and consumers.get("consume_rate"):
+        lags.append(depth / consumers["consume_rate"])
+    lag = max([value for value in lags if value is not None], default=None)
+    return {"queue_depth": depth, "outbox_bytes": outbox_bytes, "lag_seconds": lag}
+
+
+class Rejected(Exception):
+    def __init__(self, reason: str, retry_after: float):
+        super().__init__(reason)
+        self.reason = reason
+        self.retry_after = retry_after
+
+    @property
+    def retry_after_header(self) -> str:
+        return str(max(1, math.ceil(self.retry_after)))
+
+
+class AdmissionController:
+    """Sheds /send_email load at the edge instead of letting the backlog grow.
+
+    The load view (queue depth, outbox backlog, consumer lag) is sampled at
+    most every refresh_interval seconds in the background, so admitting a
+    request costs a dict lookup. Each priority has its own limits: give
+    transactional mail a higher priority with higher (or 0 = no) limits and it
+    keeps being admitted while bulk mail is turned away. Separately, every API
+    client has a token bucket of client_rate requests per second.
+    """
+
+    def __init__(
+        self,
+        limits: dict[str, float],
+        priority_limits: dict[int, dict[str, float]] | None = None,
+        client_rate: float = 0,
+        client_burst: float = 0,
+        refresh_interval: float = 2.0,
+        retry_after: float = 5.0,
+        sample: Callable[[], Awaitable[dict]] = sample_load,
+    ):
+        self.limits = limits
+        self.priority_limits = priority_limits or {}
+        self.client_rate = client_rate
+        self.client_burst = client_burst or client_rate
+        self.refresh_interval = refresh_interval
+        self.retry_after = retry_after
+        self.sample = sample
+        self.snapshot: dict = {}
+        self.sampled_at = 0.0
+        self.observed_at: dict[str, float] = {}  # per signal: when it was last read successfully
+        self._refresh_task: asyncio.Task | None = None
+        self._clients: OrderedDict[str, TokenBucket] = OrderedDict()
+        self.admitted = 0
+        self.rejected: Counter[str] = Counter()
+        self.sample_errors = 0
+
+    @property
+    def enabled(self) -> bool:
+        return any(self.limits.values()) or bool(self.priority_limits) or self.client_rate > 0
+
+    def limits_for(self, priority: int) -> dict[str, float]:
+        return {**self.limits, **self.priority_limits.get(priority, {})}
+
+    async def refresh(self) -> None:
+        try:
+            sample = await self.sample()
+        except Exception as e:
+            self.sample_errors += 1
+            logger.warning({"status": "admission_sample_failed", "error": str(e)})
+            return
+        now = time.monotonic()
+        self.sampled_at = now
+        for signal, value in sample.items():
+            if value is not None:
+                self.snapshot[signal] = value
+                self.observed_at[signal] = now
+
+    async def load(self) -> dict:
+        """The cached load view; refreshed in the background once it is older than refresh_interval.
+
+        Signals not read successfully for STALE_INTERVALS refreshes are left
+        out (fail open on that signal); the others keep shedding.
+        """
+        age = time.monotonic() - self.sampled_at
+        if age >= self.refresh_interval and (self._refresh_task is None or self._refresh_task.done()):
+            self._refresh_task = asyncio.create_task(self.refresh())
+            if not self.sampled_at:
+                # First request: wait for a view rather than admitting blind
+                await asyncio.wait([self._refresh_task], timeout=self.refresh_interval)
+        oldest = time.monotonic() - self.refresh_interval * STALE_INTERVALS
+        return {signal: value for signal, value in self.snapshot.items() if self.observed_at.get(signal, 0) >= oldest}
+
+    def _client_bucket(self, client: str) -> TokenBucket:
+        bucket = self._clients.get(client)
+        if bucket is None:
+            bucket = self._clients[client] = TokenBucket(self.client_rate, self.client_burst)
+            if len(self._clients) > MAX_CLIENTS:
+                self._clients.popitem(last=False)
+        else:
+            self._clients.move_to_end(client)
+        return bucket
+
+    async def admit(self, priority: int, client: str | None) -> None:
+        """Raise Rejected(reason, retry_after) when the request should get a 429."""
+        if not self.enabled:
+            return
+        load = await self.load()
+        for signal, limit in self.limits_for(priority).items():
+            value = load.get(signal)
+            if limit and value is not None and value >= limit:
+                self.rejected[signal] += 1
+                raise Rejected(f"{signal} {value:g} is over the limit of {limit:g} for priority {priority}", self.retry_after)
+
+        if self.client_rate > 0 and client:
+            wait = self._client_bucket(client).try_acquire()
+            if wait > 0:
+                self.rejected["client_rate"] += 1
+                raise Rejected(f"Client rate limit of {self.client_rate:g}/s exceeded", wait)
+        self.admitted += 1
+
+    def stats(self) -> dict:
+        return {
+            "enabled": self.enabled,
+            "load": self.snapshot,
+            "load_age_seconds": round(time.monotonic() - self.sampled_at, 1) if self.sampled_at else None,
+            "limits": self.limits,
+            "priority_limits": self.priority_limits,
+            "admitted": self.admitted,
+            "rejected": dict(self.rejected),
+            "clients": len(self._clients),
+            "sample_errors": self.sample_errors,
+        }
+
+
+def priority_limits_config() -> dict[int, dict[str, float]]:
+    """ADMISSION_PRIORITY_LIMITS: {"2": {"queue_depth": 0, "lag_seconds": 600}}; unlisted signals use the defaults."""
+    raw = json.loads(settings.admission_priority_limits) if settings.admission_priority_limits else {}
+    limits = {int(priority): {signal: float(value) for signal, value in signals.items()} for priority, signals in raw.items()}
+    for signals in limits.values():
+        unknown = set(signals) - set(SIGNALS)
+        if unknown:
+            raise ValueError(f"ADMISSION_PRIORITY_LIMITS: unknown signal(s) {', '.join(sorted(unknown))}")
+    return limits
+
+
+admission = AdmissionController(
+    {
+        "queue_depth": settings.admission_max_queue_depth,
+        "outbox_bytes": settings.admission_max_outbox_bytes,
+        "lag_seconds": settings.admission_max_lag_seconds,
+    },
+    priority_limits_config(),
+    client_rate=settings.admission_client_rate,
+    client_burst=settings.admission_client_burst,
+    refresh_interval=settings.admission_refresh_interval,
+    retry_after=settings.admission_retry_after,
+)
@@ -0,0 +1,298 @@
+import asyncio
+import math
+import time
+import uuid
+from typing import Awaitable, Callable, Protocol
+import aio_pika
+from app.config import settings
+from app.services.broadcast import broadcast, declare_fanout, keep_trying, listen
+from app.utils.logger import get_logger
+
+logger = get_logger("autoscaler")
+
+# A worker whose report is older than this many intervals is left out of the fleet
+STALE_REPORTS = 3
+# Tags this process's reports, so that its own FleetScaling does not count them twice
+ORIGIN = uuid.uuid4().hex
+
+
+class ScalablePool(Protocol):
+    target: int
+    processed: int
+    last_pickup: tuple[float, float] | None
+
+    def resize(self, target: int) -> None: ...
+
+
+class ConsumerAutoscaler:
+    """Sizes in-process consumer tasks and prefetch from the queue backlog.
+
+    Every `interval` seconds the queue depth is sampled with passive declares
+    on a separate channel, and the consume rate is taken from the pool's
+    processed counter. The target is to drain the backlog within
+    `target_drain` seconds on top of the arrival rate:
+
+        needed_rate = arrival_rate + depth / target_drain
+        tasks       = needed_rate / (per-task rate * consumers sharing the queue)
+
+    `desired_replicas` is the number of processes running at max_tasks that
+    would meet needed_rate, for an external autoscaler (KEDA, HPA) to read.
+    Each sample is also reported on AUTOSCALER_REPORTS_EXCHANGE, where the
+    API processes' FleetScaling adds up the fleet.
+    """
+
+    def __init__(
+        self,
+        pool: ScalablePool,
+        connection: aio_pika.abc.AbstractConnection,
+        consume_channel: aio_pika.abc.AbstractChannel,
+        queue_names: list[str],
+    ):
+        self.pool = pool
+        self.connection = connection
+        self.consume_channel = consume_channel
+        self.queue_names = queue_names
+        self.min_tasks = max(1, settings.consumer_tasks_min)
+        self.max_tasks = max(self.min_tasks, settings.consumer_tasks_max)
+        self.interval = settings.autoscale_interval
+        self.target_drain = settings.autoscale_target_drain_seconds
+
+        self.depth = 0
+        self.queue_depths: dict[str, int] = {}
+        self.consumers = 0
+        self.consume_rate = 0.0
+        self.arrival_rate = 0.0
+        self.task_rate: float | None = None
+        self.prefetch = 0
+        self.desired_replicas = 1
+        self._last_depth: int | None = None
+        self._last_processed = 0
+        self._last_sample = time.monotonic()
+        self._reports: aio_pika.abc.AbstractExchange | None = None
+
+    async def sample_depth(self, channel: aio_pika.abc.AbstractChannel) -> tuple[int, int]:
+        depth = consumers = 0
+        for name in self.queue_names:
+            queue = await channel.declare_queue(name, passive=True)
+            self.queue_depths[name] = queue.declaration_result.message_count or 0
+            depth += self.queue_depths[name]
+            consumers += queue.declaration_result.consumer_count or 0
+        return depth, consumers
+
+    def plan(self, depth: int, consumers: int, elapsed: float) -> int:
+        """Update rates from one sample and return the desired task count."""
+        processed = self.pool.processed - self._last_processed
+        self._last_processed = self.pool.processed
+        self.consume_rate = processed / elapsed if elapsed > 0 else 0.0
+
+        growth = (depth - self._last_depth) / elapsed if self._last_depth is not None and elapsed > 0 else 0.0
+        self._last_depth = depth
+        # Arrivals across the fleet, estimated from our consume rate and backlog growth
+        sharing = max(1.0, consumers / max(1, len(self.queue_names)))
+        self.arrival_rate = max(0.0, self.consume_rate * sharing + growth)
+        self.depth, self.consumers = depth, consumers
+
+        # Per-task rate is only meaningful while tasks are saturated by a backlog
+        if processed and self.pool.target and depth:
+            observed = self.consume_rate / self.pool.target
+            self.task_rate = observed if self.task_rate is None else 0.7 * self.task_rate + 0.3 * observed
+
+        needed_rate = self.arrival_rate + depth / self.target_drain
+        if self.task_rate:
+            fleet_tasks = needed_rate / self.task_rate
+            self.desired_replicas = max(1, math.ceil(fleet_tasks / self.max_tasks))
+            desired = math.ceil(fleet_tasks / sharing)
+        elif depth:
+            # No throughput data yet: grow geometrically until the backlog moves
+            desired = self.pool.target * 2
+        else:
+            desired = self.min_tasks
+
+        # Shrink one step at a time so a momentary lull does not thrash the pool
+        if desired < self.pool.target:
+            desired = max(desired, self.pool.target - 1)
+        return min(max(desired, self.min_tasks), self.max_tasks)
+
+    async def apply(self, tasks: int) -> None:
+        if tasks != self.pool.target:
+            logger.info({"status": "consumer_scaled", "from": self.pool.target, "to": tasks, "depth": self.depth})
+            self.pool.resize(tasks)
+        prefetch = min(max(tasks * settings.consumer_prefetch_per_task, settings.consumer_prefetch_min), settings.consumer_prefetch_max)
+        if prefetch != self.prefetch:
+            # global_ makes the limit channel-wide and applies it to running consumers
+            await self.consume_channel.set_qos(prefetch_count=prefetch, global_=True)
+            self.prefetch = prefetch
+
+    async def run(self) -> None:
+        await self.apply(self.pool.target or self.min_tasks)
+        channel = await self.connection.channel()
+        try:
+            while True:
+                await asyncio.sleep(self.interval)
+                try:
+                    depth, consumers = await self.sample_depth(channel)
+                except Exception as e:
+                    logger.warning({"status": "autoscale_sample_failed", "error": str(e)})
+                    if channel.is_closed:
+                        channel = await self.connection.channel()
+                    continue
+                now = time.monotonic()
+                tasks = self.plan(depth, consumers, now - self._last_sample)
+                self._last_sample = now
+                await self.apply(tasks)
+                await self.report(channel)
+        finally:
+            if not channel.is_closed:
+                await channel.close()
+
+    async def report(self, channel: aio_pika.abc.AbstractChannel) -> None:
+        if not settings.autoscaler_reports_exchange:
+            return
+        try:
+            if self._reports is None:
+                self._reports = await declare_fanout(channel, settings.autoscaler_reports_exchange)
+            # A report nobody has read within a few intervals only describes the past
+            await broadcast(self._reports, ORIGIN, {"stats": self.stats()}, expiration=self.interval * STALE_REPORTS)
+        except Exception as e:
+            self._reports = None
+            logger.warning({"status": "autoscale_report_failed", "error": str(e)})
+
+    def queue_wait(self) -> float | None:
+        """How long the oldest waiting message has been queued, at least.
+
+        The age of the last message picked up plus the time since: messages
+        behind it are younger, but while a backlog stays unconsumed (stuck
+        consumers included) the head keeps ageing from there.
+        """
+        if not self.depth:
+            return 0.0
+        if self.pool.last_pickup is None:
+            return None
+        age, picked_at = self.pool.last_pickup
+        return age + time.monotonic() - picked_at
+
+    def stats(self) -> dict:
+        drain = self.depth / self.consume_rate if self.consume_rate else None
+        wait = self.queue_wait()
+        return {
+            "enabled": True,
+            "queue_depth": self.depth,
+            "queue_consumers": self.consumers,
+            "consume_rate": round(self.consume_rate, 2),
+            "arrival_rate": round(self.arrival_rate, 2),
+            "per_task_rate": round(self.task_rate, 3) if self.task_rate else None,
+            "drain_seconds": round(drain, 1) if drain is not None else None,
+            "queue_wait_seconds": round(wait, 1) if wait is not None else None,
+            "queue_depths": self.queue_depths,
+            "tasks": self.pool.target,
+            "max_tasks": self.max_tasks,
+            "prefetch": self.prefetch,
+            "desired_replicas": self.desired_replicas,
+        }
+
+
+class FleetScaling:
+    """The consumer fleet as seen from an API process, built from the workers' reports.
+
+    Consumers run in other processes (SERVICE_ROLE=worker), so /scaling and
+    the admission lag cannot come from an in-process autoscaler. Every worker
+    reports its last sample; the fleet's depth is the broker's (each queue is
+    counted once), its consume rate the sum of the workers', and the arrival
+    rate that plus the depth growth between reports. desired_replicas then
+    follows the same formula as a single autoscaler, over the whole fleet.
+    """
+
+    def __init__(self, interval: float | None = None, target_drain: float | None = None, origin: str = ORIGIN):
+        self.interval = settings.autoscale_interval if interval is None else interval
+        self.target_drain = settings.autoscale_target_drain_seconds if target_drain is None else target_drain
+        self.origin = origin
+        self.reports: dict[str, tuple[float, dict]] = {}
+        # Per queue, whichever worker reports it: last (time, depth) and the growth since the one before
+        self._queue_samples: dict[str, tuple[float, int]] = {}
+        self._queue_growth: dict[str, float] = {}
+        self.received = 0
+
+    def record(self, origin: str, stats: dict, now: float | None = None) -> None:
+        now = time.monotonic() if now is None else now
+        self.reports[origin] = (now, stats)
+        self.received += 1
+        for name, depth in (stats.get("queue_depths") or {}).items():
+            last = self._queue_samples.get(name)
+            if last is None or now - last[0] >= self.interval:
+                if last is not None:
+                    self._queue_growth[name] = (depth - last[1]) / (now - last[0])
+                self._queue_samples[name] = (now, depth)
+
+    def live(self, now: float | None = None) -> list[dict]:
+        oldest = (time.monotonic() if now is None else now) - self.interval * STALE_REPORTS
+        for origin in [origin for origin, (at, _) in self.reports.items() if at < oldest]:
+            del self.reports[origin]
+        return [stats for _, stats in self.reports.values()]
+
+    @staticmethod
+    def _queue_depths(reports: list[dict]) -> dict[str, int]:
+        depths: dict[str, int] = {}
+        for stats in reports:
+            for name, depth in (stats.get("queue_depths") or {}).items():
+                depths[name] = max(depth, depths.get(name, 0))
+        return depths
+
+    def stats(self, local: dict | None = None, now: float | None = None) -> dict:
+        """Fleet totals; local is this process's own autoscaler (SERVICE_ROLE=both)."""
+        reports = self.live(now) + ([local] if local else [])
+        if not reports:
+            return {"enabled": False}
+        depths = self._queue_depths(reports)
+        depth = sum(depths.values())
+        growth = sum(self._queue_growth.get(name, 0.0) for name in depths)
+        consumers = max(stats.get("queue_consumers", 0) for stats in reports)
+        consume_rate = sum(stats.get("consume_rate", 0.0) for stats in reports)
+        arrival_rate = max(0.0, consume_rate + growth)
+        task_rates = [stats["per_task_rate"] for stats in reports if stats.get("per_task_rate")]
+        task_rate = sum(task_rates) / len(task_rates) if task_rates else None
+        waits = [stats["queue_wait_seconds"] for stats in reports if stats.get("queue_wait_seconds") is not None]
+        max_tasks = max(stats.get("max_tasks", settings.consumer_tasks_max) for stats in reports)
+        if task_rate:
+            needed_rate = arrival_rate + depth / self.target_drain
+            desired = max(1, math.ceil(needed_rate / task_rate / max(1, max_tasks)))
+        else:
+            desired = max(stats.get("desired_replicas", 1) for stats in reports)
+        return {
+            "enabled": True,
+            "workers": len(reports),
+            "queue_depth": depth,
+            "queue_consumers": consumers,
+            "consume_rate": round(consume_rate, 2),
+            "arrival_rate": round(arrival_rate, 2),
+            "per_task_rate": round(task_rate, 3) if task_rate else None,
+            "drain_seconds": round(depth / consume_rate, 1) if consume_rate else None,
+            "queue_wait_seconds": max(waits) if waits else None,
+            "tasks": sum(stats.get("tasks", 0) for stats in reports),
+            "desired_replicas": desired,
+        }
+
+    def _on_report(self, event: dict) -> None:
+        self.record(str(event["origin"]), event["stats"])
+
+    async def listen(self, channel: aio_pika.abc.AbstractChannel) -> None:
+        await listen(channel, settings.autoscaler_reports_exchange, self.origin, self._on_report)
+
+    async def run(self, open_channel: Callable[[], Awaitable[aio_pika.abc.AbstractChannel]]) -> None:
+        """listen() on a channel from open_channel, retrying until the broker is reachable."""
+        async def start() -> None:
+            await self.listen(await open_channel())
+
+        await keep_trying(start, "fleet_scaling")
+
+
+# Set by the running consumer so the API can report it
+active_autoscaler: ConsumerAutoscaler | None = None
+# Reports from consumers in other processes (API processes listen for them)
+fleet = FleetScaling()
+
+
+def autoscaler_stats() -> dict:
+    local = active_autoscaler.stats() if active_autoscaler else None
+    if not fleet.reports:
+        return local or {"enabled": False}
+    return fleet.stats(local)
@@ -0,0 +1,113 @@
+import asyncio
+from typing import Any, Awaitable, Callable
+from app.utils.logger import get_logger
+
+logger = get_logger("batch_publisher")
+
+# Upper bounds of the batch fill ratio histogram
+FILL_BUCKETS = (0.1, 0.25, 0.5, 0.75, 1.0)
+
+
+class BatchPublisher:
+    """Coalesces single publishes into pipelined batches.
+
+    Callers await submit(); messages collect in a buffer that is flushed after
+    linger_ms or as soon as max_batch messages are waiting. send_batch receives
+    the whole batch and returns one result (or exception) per message, which is
+    handed back to the matching caller.
+    """
+
+    def __init__(
+        self,
+        send_batch: Callable[[list[dict]], Awaitable[list[Any]]],
+        linger_ms: float,
+        max_batch: int,
+    ):
+        self.send_batch = send_batch
+        self.linger = linger_ms / 1000
+        self.max_batch = max(1, max_batch)
+        self._buffer: list[tuple[dict, asyncio.Future]] = []
+        self._timer: asyncio.TimerHandle | None = None
+        self._inflight: set[asyncio.Task] = set()
+
+        self.batches = 0
+        self.messages = 0
+        self.flushed_full = 0
+        self.flushed_linger = 0
+        self.fill_histogram = [0] * len(FILL_BUCKETS)
+
+    async def submit(self, message: dict) -> Any:
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._buffer.append((message, future))
+
+        if len(self._buffer) >= self.max_batch:
+            self._flush(full=True)
+        elif self._timer is None:
+            self._timer = loop.call_later(self.linger, self._flush)
+        return await future
+
+    def _flush(self, full: bool = False) -> None:
+        if self._timer:
+            self._timer.cancel()
+            self._timer = None
+        batch, self._buffer = self._buffer[:self.max_batch], self._buffer[self.max_batch:]
+        if not batch:
+            return
+        if self._buffer:
+            self._timer = asyncio.get_running_loop().call_later(self.linger, self._flush)
+
+        self._record(len(batch), full)
+        task = asyncio.create_task(self._send(batch))
+        self._inflight.add(task)
+        task.add_done_callback(self._inflight.discard)
+
+    async def _send(self, batch: list[tuple[dict, asyncio.Future]]) -> None:
+        try:
+            results = await self.send_batch([message for message, _ in batch])
+        except Exception as e:
+            logger.error({"status": "batch_publish_failed", "size": len(batch), "error": str(e)})
+            results = [e] * len(batch)
+
+        for (_, future), result in zip(batch, results):
+            if future.done():
+                continue
+            if isinstance(result, BaseException):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+
+    def _record(self, size: int, full: bool) -> None:
+        self.batches += 1
+        self.messages += size
+        if full:
+            self.flushed_full += 1
+        else:
+            self.flushed_linger += 1
+        fill = size / self.max_batch
+        for index, bound in enumerate(FILL_BUCKETS):
+            if fill <= bound:
+                self.fill_histogram[index] += 1
+                break
+
+    async def flush(self) -> None:
+        """Send whatever is buffered and wait for every in-flight batch."""
+        while self._buffer:
+            self._flush()
+        if self._inflight:
+            await asyncio.gather(*self._inflight, return_exceptions=True)
+
+    def stats(self) -> dict:
+        return {
+            "linger_ms": self.linger * 1000,
+            "max_batch": self.max_batch,
+            "batches": self.batches,
+            "messages": self.messages,
+            "avg_batch_size": round(self.messages / self.batches, 2) if self.batches else 0,
+            "avg_fill_ratio": round(self.messages / (self.batches * self.max_batch), 3) if self.batches else 0,
+            "fill_histogram": dict(zip((f"<={bound}" for bound in FILL_BUCKETS), self.fill_histogram)),
+            "flushed_full": self.flushed_full,
+            "flushed_linger": self.flushed_linger,
+            "buffered": len(self._buffer),
+            "inflight_batches": len(self._inflight),
+        }
@@ -0,0 +1,76 @@
+import asyncio
+import json
+from typing import Awaitable, Callable
+import aio_pika
+from app.utils.logger import get_logger
+
+logger = get_logger("broadcast")
+
+# Listener queues drop their oldest events past this many (a slow process loses signals, not memory)
+QUEUE_LIMIT = 10_000
+
+
+async def declare_fanout(channel: aio_pika.abc.AbstractChannel, name: str) -> aio_pika.abc.AbstractExchange:
+    return await channel.declare_exchange(name, aio_pika.ExchangeType.FANOUT, durable=True)
+
+
+async def broadcast(exchange: aio_pika.abc.AbstractExchange, origin: str, payload: dict, expiration: float | None = None) -> None:
+    """Publish payload to every listening process; transient, unconfirmed."""
+    body = json.dumps({**payload, "origin": origin}, default=str).encode()
+    await exchange.publish(
+        aio_pika.Message(
+            body=body,
+            content_type="application/json",
+            delivery_mode=aio_pika.DeliveryMode.NOT_PERSISTENT,
+            expiration=expiration,
+        ),
+        routing_key="",
+    )
+
+
+async def listen(
+    channel: aio_pika.abc.AbstractChannel,
+    exchange_name: str,
+    origin: str,
+    on_event: Callable[[dict], None],
+    limit: int = QUEUE_LIMIT,
+) -> aio_pika.abc.AbstractExchange:
+    """Bind an exclusive queue to the fanout and call on_event for other origins' payloads.
+
+    payload["origin"] says which process published it.
+    """
+    exchange = await declare_fanout(channel, exchange_name)
+    queue = await channel.declare_queue(
+        exclusive=True,
+        auto_delete=True,
+        arguments={"x-max-length": limit, "x-overflow": "drop-head"},
+    )
+    await queue.bind(exchange)
+
+    async def on_message(message: aio_pika.abc.AbstractIncomingMessage) -> None:
+        try:
+            payload = json.loads(message.body)
+        except ValueError:
+            return
+        # The fanout hands a process its own publications too
+        if payload.get("origin") == origin:
+            return
+        try:
+            on_event(payload)
+        except Exception as e:
+            logger.warning({"status": "broadcast_event_failed", "exchange": exchange_name, "error": str(e)})
+
+    await queue.consume(on_message, no_ack=True)
+    logger.info({"status": "broadcast_listening", "exchange": exchange_name, "queue": queue.name})
+    return exchange
+
+
+async def keep_trying(start: Callable[[], Awaitable[None]], name: str, retry: float = 5) -> None:
+    """Run start() until it succeeds (the broker may come up after this process)."""
+    while True:
+        try:
+            await start()
+            return
+        except Exception as e:
+            logger.warning({"status": "broadcast_unavailable", "listener": name, "error": str(e)})
+            await asyncio.sleep(retry)
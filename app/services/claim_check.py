@@ -0,0 +1,128 @@
+import asyncio
+import hashlib
+import time
+from collections import OrderedDict
+from datetime import datetime
+from app.config import settings
+from app.services.content_store import ContentStore, DatabaseContentStore, attachment_store, make_content_store
+from app.utils.logger import get_logger
+
+logger = get_logger("claim_check")
+
+body_store = make_content_store("bodies", settings.body_store_dir)
+
+
+async def claim_check(message: dict, store: ContentStore | DatabaseContentStore | None = None, threshold: int | None = None) -> dict:
+    """Swap a large body for a reference to the blob store.
+
+    The queue message then carries body_ref = {id, size, sha256} instead of
+    the body, so its size no longer depends on the content. Identical bodies
+    (a campaign) are stored once.
+    """
+    threshold = settings.claim_check_threshold if threshold is None else threshold
+    body = message.get("body")
+    if not threshold or not isinstance(body, str):
+        return message
+    data = body.encode("utf-8")
+    if len(data) <= threshold:
+        return message
+
+    digest, size, _ = await (store or body_store).put_bytes(data, {"content_type": "text/plain; charset=utf-8"})
+    checked = {key: value for key, value in message.items() if key != "body"}
+    checked["body_ref"] = {"id": digest, "size": size, "sha256": digest}
+    return checked
+
+
+async def retain_content(message: dict, send_at: datetime | None = None, expires_at: datetime | None = None) -> None:
+    """Keep the message's claim-checked body and attachments until it can no longer be sent.
+
+    That is CONTENT_RETENTION_SECONDS after it goes out (send_at for a
+    scheduled send), or its expires_at when that is later.
+    """
+    retention = settings.content_retention_seconds
+    if not retention:
+        return
+    until = (send_at.timestamp() if send_at else time.time()) + retention
+    if expires_at:
+        until = max(until, expires_at.timestamp())
+    blobs = [(body_store, message["body_ref"]["id"])] if message.get("body_ref") else []
+    blobs += [(attachment_store, digest) for digest in message.get("attachments") or []]
+    for store, digest in blobs:
+        await store.retain(digest, until)
+
+
+class BodyCache:
+    """Byte-bounded LRU of resolved bodies, keyed by content id."""
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self._entries: OrderedDict[str, tuple[str, int]] = OrderedDict()
+        self._loading: dict[str, asyncio.Future] = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: str) -> str | None:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry[0]
+
+    def put(self, key: str, value: str, size: int) -> None:
+        if size > self.max_bytes or key in self._entries:
+            return
+        self._entries[key] = (value, size)
+        self.bytes += size
+        while self.bytes > self.max_bytes:
+            _, (_, evicted) = self._entries.popitem(last=False)
+            self.bytes -= evicted
+
+    def stats(self) -> dict:
+        return {
+            "entries": len(self._entries),
+            "bytes": self.bytes,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+
+body_cache = BodyCache(settings.body_cache_bytes)
+
+
+async def resolve_body(ref: dict, store: ContentStore | DatabaseContentStore | None = None, cache: BodyCache | None = None) -> str:
+    """Load a claim-checked body, verifying its hash; concurrent loads of one id share a read."""
+    store = store or body_store
+    cache = cache or body_cache
+    digest = ref["id"]
+    cached = cache.get(digest)
+    if cached is not None:
+        return cached
+
+    pending = cache._loading.get(digest)
+    if pending is not None:
+        return await asyncio.shield(pending)
+
+    cache.misses += 1
+    future = asyncio.get_running_loop().create_future()
+    cache._loading[digest] = future
+    try:
+        data = await store.read_bytes(digest)
+        if hashlib.sha256(data).hexdigest() != ref.get("sha256", digest):
+            raise ValueError(f"Body {digest} failed hash verification")
+        body = data.decode("utf-8")
+        cache.put(digest, body, len(data))
+        future.set_result(body)
+        return body
+    except asyncio.CancelledError:
+        future.cancel()
+        raise
+    except Exception as e:
+        future.set_exception(e)
+        # Mark retrieved so a load nobody else awaited does not log "never retrieved"
+        future.exception()
+        raise
+    finally:
+        del cache._loading[digest]
@@ -0,0 +1,132 @@
+import asyncio
+import time
+from contextlib import asynccontextmanager
+from aiosmtplib import SMTPRecipientRefused, SMTPRecipientsRefused, SMTPResponseException
+from app.config import settings
+from app.utils.logger import get_logger
+
+logger = get_logger("concurrency")
+
+
+def is_temporary_rejection(error: BaseException) -> bool:
+    """True for 4xx SMTP replies such as 421/450/451/452 ("try again later")."""
+    if isinstance(error, SMTPRecipientsRefused):
+        return any(400 <= r.code < 500 for r in error.recipients)
+    if isinstance(error, SMTPResponseException):
+        return 400 <= error.code < 500
+    return False
+
+
+def is_recipient_rejection(error: BaseException) -> bool:
+    """True for 5xx RCPT refusals: the address is bad, so no relay or retry will help."""
+    if isinstance(error, SMTPRecipientsRefused):
+        return bool(error.recipients) and all(r.code >= 500 for r in error.recipients)
+    if isinstance(error, SMTPRecipientRefused):
+        return error.code >= 500
+    return False
+
+
+class AdaptiveConcurrencyLimiter:
+    """AIMD limit on in-flight SMTP transactions.
+
+    While latency stays within `tolerance` x the baseline RTT the limit grows
+    by roughly one per limit's worth of successes (additive increase). A
+    temporary rejection multiplies it by `backoff`; rising RTT trims it by 10%,
+    at most once per RTT: the transactions completing within one RTT of a
+    trim were started under the old limit, so their latency says nothing
+    about the new one. The baseline is the lowest RTT seen, re-seeded from
+    the smoothed RTT every `baseline_window` seconds so it can follow a relay
+    that got slower.
+    """
+
+    def __init__(
+        self,
+        initial: int,
+        min_limit: int,
+        max_limit: int,
+        tolerance: float = 2.0,
+        backoff: float = 0.5,
+        baseline_window: float = 60.0,
+    ):
+        self.min_limit = max(1, min_limit)
+        self.max_limit = max(self.min_limit, max_limit)
+        self.limit = float(min(max(initial, self.min_limit), self.max_limit))
+        self.tolerance = tolerance
+        self.backoff = backoff
+        self.baseline_window = baseline_window
+
+        self.in_flight = 0
+        self._condition = asyncio.Condition()
+        self.min_rtt: float | None = None
+        self.smoothed_rtt: float | None = None
+        self._baseline_reset = time.monotonic()
+        self._latency_hold_until = 0.0
+
+        self.successes = 0
+        self.rejections = 0
+        self.latency_backoffs = 0
+
+    async def acquire(self) -> None:
+        async with self._condition:
+            await self._condition.wait_for(lambda: self.in_flight < int(self.limit))
+            self.in_flight += 1
+
+    async def release(self) -> None:
+        async with self._condition:
+            self.in_flight -= 1
+            self._condition.notify_all()
+
+    @asynccontextmanager
+    async def slot(self):
+        """Hold one in-flight slot; the outcome of the block feeds the limit."""
+        await self.acquire()
+        started = time.monotonic()
+        try:
+            yield
+        except BaseException as e:
+            if is_temporary_rejection(e):
+                self.on_rejection()
+            raise
+        else:
+            self.on_success(time.monotonic() - started)
+        finally:
+            await self.release()
+
+    def on_success(self, rtt: float) -> None:
+        self.successes += 1
+        now = time.monotonic()
+        if now - self._baseline_reset > self.baseline_window and self.smoothed_rtt is not None:
+            self.min_rtt = self.smoothed_rtt
+            self._baseline_reset = now
+        self.min_rtt = rtt if self.min_rtt is None else min(self.min_rtt, rtt)
+        self.smoothed_rtt = rtt if self.smoothed_rtt is None else 0.8 * self.smoothed_rtt + 0.2 * rtt
+
+        if self.smoothed_rtt > self.min_rtt * self.tolerance:
+            # Held for the smoothed RTT, which is never shorter than the baseline one
+            if now >= self._latency_hold_until:
+                self._latency_hold_until = now + self.smoothed_rtt
+                self.latency_backoffs += 1
+                self._set_limit(self.limit * 0.9)
+        elif self.in_flight >= int(self.limit) - 1:
+            # Only grow when the current limit is actually being used
+            self._set_limit(self.limit + 1 / self.limit)
+
+    def on_rejection(self) -> None:
+        self.rejections += 1
+        self._set_limit(self.limit * self.backoff)
+        logger.warning({"status": "smtp_concurrency_backoff", "limit": int(self.limit)})
+
+    def _set_limit(self, value: float) -> None:
+        self.limit = min(max(value, self.min_limit), self.max_limit)
+
+    def stats(self) -> dict:
+        return {
+            "limit": int(self.limit),
+            "in_flight": self.in_flight,
+            "min_rtt_ms": round(self.min_rtt * 1000, 1) if self.min_rtt else None,
+            "smoothed_rtt_ms": round(self.smoothed_rtt * 1000, 1) if self.smoothed_rtt else None,
+            "successes": self.successes,
+            "temporary_rejections": self.rejections,
+            "latency_backoffs": self.latency_backoffs,
+        }
+
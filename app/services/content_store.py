@@ -0,0 +1,396 @@
+import asyncio
+import hashlib
+import json
+import os
+import re
+import tempfile
+import time
+import uuid
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+from typing import AsyncIterator
+from sqlalchemy import case, delete, insert, select, update
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import async_sessionmaker
+from app.config import settings
+from app.models import ContentBlob, ContentChunk, utcnow
+from app.utils.logger import get_logger
+
+logger = get_logger("content_store")
+
+DIGEST_REGEX = re.compile(r"^[0-9a-f]{64}$")
+STORES = ("database", "file")
+# content_chunk row size; a multiple of 57 like mime_stream.READ_CHUNK
+CHUNK_BYTES = 57 * 4 * 1024
+# Sizes remembered for size_hint() (traffic capture), which must not query
+MAX_SIZE_HINTS = 10_000
+
+
+class ContentTooLarge(ValueError):
+    pass
+
+
+class ContentStore:
+    """Local content-addressed blob store keyed by SHA-256.
+
+    Identical content is stored once: a second upload of the same bytes only
+    costs the hashing pass. Blobs live at <root>/<2 hex>/<digest> with an
+    optional <digest>.json metadata sidecar (first writer wins).
+
+    With a retention, a blob's mtime is the time it may be deleted: every
+    write (first or deduplicated) and every retain() pushes it out, never in,
+    and sweep() removes the blobs whose time has passed.
+    """
+
+    def __init__(self, root: str, retention: float | None = None):
+        self.root = root
+        self.retention = settings.content_retention_seconds if retention is None else retention
+
+    @property
+    def name(self) -> str:
+        return self.root
+
+    def path(self, digest: str) -> str:
+        if not DIGEST_REGEX.match(digest or ""):
+            raise ValueError(f"Invalid content id: {digest!r}")
+        return os.path.join(self.root, digest[:2], digest)
+
+    async def exists(self, digest: str) -> bool:
+        try:
+            return os.path.exists(self.path(digest))
+        except ValueError:
+            return False
+
+    def size_hint(self, digest: str) -> int | None:
+        try:
+            return os.path.getsize(self.path(digest))
+        except (OSError, ValueError):
+            return None
+
+    async def metadata(self, digest: str) -> dict:
+        try:
+            with open(self.path(digest) + ".json") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+
+    async def put_stream(
+        self,
+        chunks: AsyncIterator[bytes],
+        metadata: dict | None = None,
+        max_bytes: int | None = None,
+    ) -> tuple[str, int, bool]:
+        """Store a stream; returns (digest, size, deduplicated)."""
+        tmp_dir = os.path.join(self.root, "tmp")
+        os.makedirs(tmp_dir, exist_ok=True)
+        tmp_path = os.path.join(tmp_dir, uuid.uuid4().hex)
+        hasher = hashlib.sha256()
+        size = 0
+
+        try:
+            with open(tmp_path, "wb") as f:
+                async for chunk in chunks:
+                    size += len(chunk)
+                    if max_bytes and size > max_bytes:
+                        raise ContentTooLarge(f"Content exceeds {max_bytes} bytes")
+                    hasher.update(chunk)
+                    await asyncio.to_thread(f.write, chunk)
+            digest = hasher.hexdigest()
+            return digest, size, await asyncio.to_thread(self._commit, tmp_path, digest, metadata)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    async def put_bytes(self, data: bytes, metadata: dict | None = None) -> tuple[str, int, bool]:
+        async def single():
+            yield data
+
+        return await self.put_stream(single(), metadata)
+
+    def _commit(self, tmp_path: str, digest: str, metadata: dict | None) -> bool:
+        final = self.path(digest)
+        deduplicated = os.path.exists(final)
+        if not deduplicated:
+            os.makedirs(os.path.dirname(final), exist_ok=True)
+            if metadata:
+                with open(final + ".json", "w") as f:
+                    json.dump(metadata, f)
+            os.replace(tmp_path, final)
+        if self.retention:
+            self._retain(digest, time.time() + self.retention)
+        return deduplicated
+
+    async def retain(self, digest: str, until: float) -> None:
+        """Keep the blob until the given epoch time; an earlier time than it already has is ignored."""
+        await asyncio.to_thread(self._retain, digest, until)
+
+    def _retain(self, digest: str, until: float) -> None:
+        path = self.path(digest)
+        try:
+            if os.stat(path).st_mtime < until:
+                os.utime(path, (until, until))
+        except FileNotFoundError:
+            pass
+
+    async def sweep(self, now: float | None = None) -> int:
+        """Delete the blobs (and sidecars) whose retention has run out; returns how many."""
+        return await asyncio.to_thread(self._sweep, now)
+
+    def _sweep(self, now: float | None = None) -> int:
+        now = time.time() if now is None else now
+        removed = 0
+        if not os.path.isdir(self.root):
+            return removed
+        for prefix in os.listdir(self.root):
+            directory = os.path.join(self.root, prefix)
+            if len(prefix) != 2 or not os.path.isdir(directory):
+                continue
+            for name in os.listdir(directory):
+                if not DIGEST_REGEX.match(name):
+                    continue
+                path = os.path.join(directory, name)
+                try:
+                    if os.stat(path).st_mtime >= now:
+                        continue
+                    os.remove(path)
+                    removed += 1
+                    os.remove(path + ".json")
+                except FileNotFoundError:
+                    pass
+        return removed
+
+    async def iter_chunks(self, digest: str, chunk_size: int = 64 * 1024) -> AsyncIterator[bytes]:
+        with open(self.path(digest), "rb") as f:
+            while chunk := await asyncio.to_thread(f.read, chunk_size):
+                yield chunk
+
+    async def read_bytes(self, digest: str) -> bytes:
+        def read() -> bytes:
+            with open(self.path(digest), "rb") as f:
+                return f.read()
+
+        return await asyncio.to_thread(read)
+
+
+class DatabaseContentStore:
+    """ContentStore in the database, so API and worker processes share every blob.
+
+    Same interface and deduplication as the file store. A blob is a
+    content_blob row keyed by (store, SHA-256) plus CHUNK_BYTES content_chunk
+    rows: uploads are hashed while spooled to a temporary file, then written
+    chunk by chunk, and reads fetch one chunk per query without holding a
+    pooled connection while the caller (an SMTP DATA upload) consumes it.
+    keep_until plays the part of the file store's mtime.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        session_factory: async_sessionmaker | None = None,
+        retention: float | None = None,
+        chunk_bytes: int = CHUNK_BYTES,
+    ):
+        self.name = name
+        self._session_factory = session_factory
+        self.retention = settings.content_retention_seconds if retention is None else retention
+        self.chunk_bytes = chunk_bytes
+        self._sizes: OrderedDict[str, int] = OrderedDict()
+        self._schema_ready = False
+        self._schema_lock = asyncio.Lock()
+
+    @property
+    def session_factory(self) -> async_sessionmaker:
+        if self._session_factory is None:
+            from app.db import AsyncSessionLocal
+            self._session_factory = AsyncSessionLocal
+        return self._session_factory
+
+    def session(self):
+        from app.db import session_scope
+        return session_scope(self.session_factory)
+
+    async def create_schema(self) -> None:
+        async with self._schema_lock:
+            if self._schema_ready:
+                return
+            async with self.session() as session:
+                conn = await session.connection()
+                for table in (ContentBlob.__table__, ContentChunk.__table__):
+                    await conn.run_sync(table.create, checkfirst=True)
+                await session.commit()
+            self._schema_ready = True
+
+    def _blob(self, digest: str):
+        return (ContentBlob.store == self.name) & (ContentBlob.digest == digest)
+
+    def _remember(self, digest: str, size: int) -> None:
+        self._sizes[digest] = size
+        self._sizes.move_to_end(digest)
+        if len(self._sizes) > MAX_SIZE_HINTS:
+            self._sizes.popitem(last=False)
+
+    def size_hint(self, digest: str) -> int | None:
+        """Size of a blob this process has written or checked; never queries."""
+        return self._sizes.get(digest)
+
+    def _lease(self) -> datetime | None:
+        return utcnow() + timedelta(seconds=self.retention) if self.retention else None
+
+    async def exists(self, digest: str) -> bool:
+        if not DIGEST_REGEX.match(digest or ""):
+            return False
+        async with self.session() as session:
+            size = await session.scalar(select(ContentBlob.size).where(self._blob(digest)))
+        if size is None:
+            return False
+        self._remember(digest, size)
+        return True
+
+    async def metadata(self, digest: str) -> dict:
+        async with self.session() as session:
+            meta = await session.scalar(select(ContentBlob.meta).where(self._blob(digest)))
+        return meta or {}
+
+    async def put_stream(
+        self,
+        chunks: AsyncIterator[bytes],
+        metadata: dict | None = None,
+        max_bytes: int | None = None,
+    ) -> tuple[str, int, bool]:
+        """Store a stream; returns (digest, size, deduplicated)."""
+        await self.create_schema()
+        hasher = hashlib.sha256()
+        size = 0
+        spool = await asyncio.to_thread(tempfile.TemporaryFile)
+        try:
+            async for chunk in chunks:
+                size += len(chunk)
+                if max_bytes and size > max_bytes:
+                    raise ContentTooLarge(f"Content exceeds {max_bytes} bytes")
+                hasher.update(chunk)
+                await asyncio.to_thread(spool.write, chunk)
+            digest = hasher.hexdigest()
+            deduplicated = await self._extend(digest, self._lease()) or await self._insert(spool, digest, size, metadata)
+        finally:
+            spool.close()
+        self._remember(digest, size)
+        return digest, size, deduplicated
+
+    async def put_bytes(self, data: bytes, metadata: dict | None = None) -> tuple[str, int, bool]:
+        async def single():
+            yield data
+
+        return await self.put_stream(single(), metadata)
+
+    async def _extend(self, digest: str, until: datetime | None) -> bool:
+        """Push keep_until out to until (never in, never off NULL); True when the blob exists."""
+        async with self.session() as session:
+            if until is None:
+                found = await session.scalar(select(ContentBlob.size).where(self._blob(digest))) is not None
+            else:
+                keep_until = case((ContentBlob.keep_until < until, until), else_=ContentBlob.keep_until)
+                result = await session.execute(update(ContentBlob).where(self._blob(digest)).values(keep_until=keep_until))
+                found = result.rowcount > 0
+            await session.commit()
+        return found
+
+    async def _insert(self, spool, digest: str, size: int, metadata: dict | None) -> bool:
+        """Write a new blob; True when a concurrent upload of the same content got there first."""
+        await asyncio.to_thread(spool.seek, 0)
+        async with self.session() as session:
+            try:
+                await session.execute(insert(ContentBlob).values(
+                    store=self.name, digest=digest, size=size, meta=metadata or None, keep_until=self._lease(),
+                ))
+                seq = 0
+                while chunk := await asyncio.to_thread(spool.read, self.chunk_bytes):
+                    await session.execute(insert(ContentChunk).values(store=self.name, digest=digest, seq=seq, data=chunk))
+                    seq += 1
+                await session.commit()
+            except IntegrityError:
+                await session.rollback()
+                return True
+        return False
+
+    async def iter_chunks(self, digest: str, chunk_size: int = 64 * 1024) -> AsyncIterator[bytes]:
+        if not await self.exists(digest):
+            raise FileNotFoundError(f"No content {digest} in {self.name}")
+        buffer = bytearray()
+        seq = 0
+        while True:
+            async with self.session() as session:
+                data = await session.scalar(select(ContentChunk.data).where(
+                    ContentChunk.store == self.name, ContentChunk.digest == digest, ContentChunk.seq == seq
+                ))
+            if data is None:
+                break
+            buffer += data
+            seq += 1
+            while len(buffer) >= chunk_size:
+                yield bytes(buffer[:chunk_size])
+                del buffer[:chunk_size]
+        if buffer:
+            yield bytes(buffer)
+
+    async def read_bytes(self, digest: str) -> bytes:
+        return b"".join([chunk async for chunk in self.iter_chunks(digest, self.chunk_bytes)])
+
+    async def retain(self, digest: str, until: float) -> None:
+        """Keep the blob until the given epoch time; an earlier time than it already has is ignored."""
+        await self._extend(digest, datetime.fromtimestamp(until, timezone.utc))
+
+    async def sweep(self, now: float | None = None) -> int:
+        """Delete the blobs whose retention has run out; returns how many."""
+        now = datetime.fromtimestamp(time.time() if now is None else now, timezone.utc)
+        async with self.session() as session:
+            removed = (await session.scalars(
+                delete(ContentBlob)
+                .where(ContentBlob.store == self.name, ContentBlob.keep_until < now)
+                .returning(ContentBlob.digest)
+            )).all()
+            if removed:
+                await session.execute(delete(ContentChunk).where(
+                    ContentChunk.store == self.name, ContentChunk.digest.in_(removed)
+                ))
+            await session.commit()
+        for digest in removed:
+            self._sizes.pop(digest, None)
+        return len(removed)
+
+
+def make_content_store(name: str, directory: str) -> ContentStore | DatabaseContentStore:
+    """CONTENT_STORE=database (shared by every process) or file (directory on this host or a shared volume)."""
+    if settings.content_store not in STORES:
+        raise ValueError(f"CONTENT_STORE must be one of {', '.join(STORES)}, got {settings.content_store!r}")
+    if settings.content_store == "file":
+        return ContentStore(directory)
+    return DatabaseContentStore(name)
+
+
+def check_content_store(role: str) -> None:
+    """Refuse a file store that split api/worker processes would not share."""
+    if settings.content_store == "file" and role != "both" and not settings.content_dir_shared:
+        raise RuntimeError(
+            f"CONTENT_STORE=file keeps attachments and bodies on this host, out of reach of the other "
+            f"SERVICE_ROLE={role} processes: use CONTENT_STORE=database, or put ATTACHMENT_DIR and "
+            f"BODY_STORE_DIR on a volume every process mounts and set CONTENT_DIR_SHARED=true"
+        )
+
+
+attachment_store = make_content_store("attachments", settings.attachment_dir)
+
+
+async def run_content_sweeper(stores: list) -> None:
+    """Delete expired blobs from the stores every CONTENT_SWEEP_INTERVAL seconds, forever.
+
+    Run by API processes; the stores are shared, so workers have no copy of their own to sweep.
+    """
+    while True:
+        for store in stores:
+            try:
+                removed = await store.sweep()
+                if removed:
+                    logger.info({"status": "content_swept", "store": store.name, "removed": removed})
+            except Exception as e:
+                logger.error({"status": "content_sweep_failed", "store": store.name, "error": str(e)})
+        await asyncio.sleep(settings.content_sweep_interval)
@@ -0,0 +1,137 @@
+import base64
+import hashlib
+import re
+import time
+from functools import lru_cache
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import padding
+from app.config import settings
+
+_WSP = re.compile(rb"[ \t]+")
+_HEADER_WSP = re.compile(r"[ \t\r\n]+")
+
+
+# Headers whose values repeat across messages; their canonical form is cached
+REPEATING_HEADERS = frozenset({"from", "reply-to", "sender", "subject", "mime-version"})
+
+
+def canonical_header(name: str, value: str) -> str:
+    """Relaxed header canonicalization (RFC 6376 3.4.2)."""
+    return f"{name.strip().lower()}:{_HEADER_WSP.sub(' ', value).strip()}\r\n"
+
+
+cached_canonical_header = lru_cache(maxsize=4096)(canonical_header)
+
+
+class RelaxedBodyHasher:
+    """Incremental relaxed body canonicalization + SHA-256 (RFC 6376 3.4.4).
+
+    Fed in arbitrary chunks, so a streamed message can be hashed without
+    holding it in memory. Trailing empty lines are held back until a
+    non-empty line shows they were not trailing after all.
+    """
+
+    def __init__(self):
+        self._hash = hashlib.sha256()
+        self._partial = b""
+        self._empty_lines = 0
+
+    def _line(self, line: bytes) -> None:
+        line = _WSP.sub(b" ", line).rstrip(b" ")
+        if not line:
+            self._empty_lines += 1
+            return
+        if self._empty_lines:
+            self._hash.update(b"\r\n" * self._empty_lines)
+            self._empty_lines = 0
+        self._hash.update(line + b"\r\n")
+
+    def update(self, chunk: bytes) -> None:
+        lines = (self._partial + chunk).split(b"\r\n")
+        self._partial = lines.pop()
+        for line in lines:
+            self._line(line)
+
+    def digest(self) -> str:
+        if self._partial:
+            self._line(self._partial)
+            self._partial = b""
+        return base64.b64encode(self._hash.digest()).decode()
+
+
+def body_hash(body: bytes) -> str:
+    hasher = RelaxedBodyHasher()
+    hasher.update(body)
+    return hasher.digest()
+
+
+def split_message(message: bytes) -> tuple[bytes, bytes]:
+    header_block, _, body = message.partition(b"\r\n\r\n")
+    return header_block + b"\r\n", body
+
+
+def parse_headers(header_block: bytes) -> list[tuple[str, str]]:
+    """(name, raw value) pairs from a CRLF header block, folded lines joined."""
+    headers: list[tuple[str, str]] = []
+    for line in header_block.decode("utf-8", "replace").split("\r\n"):
+        if not line:
+            continue
+        if line[0] in " \t" and headers:
+            name, value = headers[-1]
+            headers[-1] = (name, f"{value}\r\n{line}")
+        else:
+            name, _, value = line.partition(":")
+            headers.append((name, value))
+    return headers
+
+
+class DkimSigner:
+    """rsa-sha256, relaxed/relaxed DKIM signatures; the key is parsed once."""
+
+    def __init__(self, domain: str, selector: str, private_key_pem: bytes, signed_headers: list[str]):
+        self.domain = domain
+        self.selector = selector
+        self.key = serialization.load_pem_private_key(private_key_pem, password=None)
+        self.signed_headers = [name.strip().lower() for name in signed_headers if name.strip()]
+
+    def signature(self, header_block: bytes, bh: str) -> bytes:
+        """The DKIM-Signature header line for a message with this header block and body hash."""
+        present: dict[str, tuple[str, str]] = {}
+        for name, value in parse_headers(header_block):
+            present[name.strip().lower()] = (name, value)  # the last instance is signed
+        names = [name for name in self.signed_headers if name in present]
+
+        value = (
+            f" v=1; a=rsa-sha256; c=relaxed/relaxed; d={self.domain}; s={self.selector};"
+            f" t={int(time.time())}; h={':'.join(names)}; bh={bh};\r\n\tb="
+        )
+        signed = "".join(
+            (cached_canonical_header if name in REPEATING_HEADERS else canonical_header)(*present[name]) for name in names
+        )
+        signed += canonical_header("DKIM-Signature", value).removesuffix("\r\n")
+        signature = self.key.sign(signed.encode(), padding.PKCS1v15(), hashes.SHA256())
+        return f"DKIM-Signature:{value}{base64.b64encode(signature).decode()}\r\n".encode()
+
+    def sign(self, message: bytes) -> bytes:
+        """Prepend a DKIM-Signature to a CRLF-terminated message."""
+        header_block, body = split_message(message)
+        return self.signature(header_block, body_hash(body)) + message
+
+
+def private_key_pem() -> bytes | None:
+    if settings.dkim_private_key:
+        # Env vars usually carry the PEM with literal \n
+        return settings.dkim_private_key.replace("\\n", "\n").encode()
+    if settings.dkim_private_key_path:
+        with open(settings.dkim_private_key_path, "rb") as f:
+            return f.read()
+    return None
+
+
+@lru_cache(maxsize=1)
+def get_signer() -> DkimSigner | None:
+    """The configured signer, or None when DKIM_DOMAIN / the key are not set."""
+    pem = private_key_pem()
+    if not settings.dkim_domain or not pem:
+        return None
+    return DkimSigner(settings.dkim_domain, settings.dkim_selector, pem, settings.dkim_headers.split(":"))
@@ -1,22 +1,112 @@
 import asyncio
 import re
-from aiosmtplib import SMTP, SMTPException
-from email.mime.text import MIMEText
-from email.mime.multipart import MIMEMultipart
+import time
+from typing import Awaitable, Callable, TypeVar
+from aiosmtplib import SMTP, SMTPException, SMTPRecipientRefused
 from app.config import settings
 from app.utils.logger import get_logger
-from app.services.circuit_breaker import CircuitBreaker
+from app.services.rate_limiter import send_rate_limiter
+from app.services.concurrency import is_recipient_rejection, is_temporary_rejection
+from app.services.content_store import attachment_store
+from app.services.mime_stream import iter_mime_message, iter_signed_mime_message, stream_data
+from app.services.render_pool import render_pool
+from app.services.relay_router import Relay, relay_router
+from app.services.suppression import suppression
+from app.utils.profiling import stage_timer
+from app.utils import tracing
 
 logger = get_logger("email_sender")
 EMAIL_REGEX = re.compile(r"^[^@]+@[^@]+\.[^@]+$")
-circuit = CircuitBreaker(failure_threshold=3, recovery_time=20)  # 3 failures open circuit for 20 sec
 
-async def send_email_async(to_email: str, subject: str, body: str, html: bool = False):
+T = TypeVar("T")
+
+
+class NoRelayAvailable(SMTPException):
+    pass
+
+
+def _mime_stream(recipient_header: str, subject: str, body: str, html: bool, attachments: list[str]):
+    if render_pool.signing:
+        return iter_signed_mime_message(
+            settings.email_from, recipient_header, subject, body, html, attachments, attachment_store, render_pool.signature
+        )
+    return iter_mime_message(settings.email_from, recipient_header, subject, body, html, attachments, attachment_store)
+
+
+async def _open_smtp(relay: Relay) -> SMTP:
+    smtp = SMTP(
+        hostname=relay.host,
+        port=relay.port,
+        start_tls=relay.start_tls,  # STARTTLS on 587-style relays
+        use_tls=relay.use_tls,      # Implicit SSL, e.g. Gmail on 465
+        timeout=relay.timeout
+    )
+    with stage_timer("smtp.connect"):
+        await smtp.connect()
+    if relay.user:
+        try:
+            with stage_timer("smtp.login"):
+                await smtp.login(relay.user, relay.password)
+        except BaseException:
+            smtp.close()
+            raise
+    return smtp
+
+async def _run_on_relays(transaction: Callable[[SMTP], Awaitable[T]], tokens: int = 1) -> tuple[T, Relay]:
+    """
+    Runs one SMTP transaction, failing over across relays within the same attempt.
+    Each relay try spends send-rate tokens and holds a slot of that relay's
+    adaptive (AIMD) concurrency limit. Bad-recipient errors are not failed over.
     """
-    Sends an email asynchronously via Gmail SMTP over SSL (port 465)
-    Implements retries with exponential backoff and circuit breaker protection.
+    last_error: Exception | None = None
+    for relay in relay_router.failover_order():
+        started = time.monotonic()
+        try:
+            # Every SMTP attempt spends its tokens of the global send budget
+            with stage_timer("smtp.rate_wait"), tracing.span("rate_wait", tokens=tokens):
+                for _ in range(tokens):
+                    await send_rate_limiter.acquire()
+                if relay.bucket is not None:
+                    await relay.bucket.acquire(tokens)
+
+            started = time.monotonic()
+            with tracing.span("smtp", relay=relay.name, recipients=tokens):
+                async with relay.concurrency.slot():
+                    smtp = await _open_smtp(relay)
+                    try:
+                        result = await transaction(smtp)
+                        with stage_timer("smtp.quit"):
+                            await smtp.quit()
+                    finally:
+                        # Failed mid-transaction (or on QUIT): drop the connection instead of leaking it
+                        if smtp.is_connected:
+                            smtp.close()
+            relay.record_success(time.monotonic() - started)
+            return result, relay
+
+        except Exception as e:
+            if is_recipient_rejection(e):
+                relay.record_success(time.monotonic() - started)
+                raise
+            relay.record_failure(e)
+            last_error = e
+            logger.warning("smtp_relay_failed", extra={"relay": relay.name, "error": str(e)})
+
+    raise last_error or NoRelayAvailable("Circuit breaker is OPEN on every SMTP relay")
+
+async def send_email_async(
+    to_email: str,
+    subject: str,
+    body: str,
+    html: bool = False,
+    attachments: list[str] | None = None,
+):
+    """
+    Sends an email asynchronously through the SMTP relay pool
+    Implements retries with exponential backoff, relay failover and per-relay circuit breakers.
+    Attachments are content-store ids, streamed into the DATA phase chunk by chunk.
     """
-    if not circuit.allow_request():
+    if not relay_router.available():
         logger.warning("circuit_open", extra={"to_email": to_email})
         return False, "Circuit breaker is OPEN"
 
@@ -27,42 +117,169 @@ async def send_email_async(to_email: str, subject: str, body: str, html: bool =
         logger.warning("invalid_email_format", extra={"to_email": to_email})
         return False, "Invalid email address format"
 
-    msg = MIMEMultipart("alternative")
-    msg["From"] = settings.email_from
-    msg["To"] = to_email
-    msg["Subject"] = subject
-    msg.attach(MIMEText(body, "html" if html else "plain"))
+    missing = [digest for digest in attachments or [] if not await attachment_store.exists(digest)]
+    if missing:
+        return False, f"Unknown attachment id(s): {', '.join(missing)}"
+
+    data = None
+    if not attachments:
+        # Serialized (and DKIM-signed) once, in the render pool when configured
+        with stage_timer("smtp.build_mime"), tracing.span("render"):
+            data = await render_pool.render(
+                {"from": settings.email_from, "to": to_email, "subject": subject, "body": body, "html": html}
+            )
+
+    async def transaction(smtp: SMTP) -> None:
+        with stage_timer("smtp.send_message"):
+            if attachments:
+                await smtp.mail(settings.email_from)
+                await smtp.rcpt(to_email)
+                await stream_data(smtp, _mime_stream(to_email, subject, body, html, attachments), timeout=60)
+            else:
+                await smtp.sendmail(settings.email_from, [to_email], data)
 
     for attempt in range(1, settings.max_retry_attempts + 1):
         try:
-            # Gmail SSL (port 465) configuration
-            smtp = SMTP(
-                hostname=settings.smtp_host,
-                port=settings.smtp_port,  # 465 for SSL
-                start_tls=False,         # Disable STARTTLS for port 465
-                use_tls=settings.use_ssl,            # Enable SSL
-                timeout=10
-            )
-            await smtp.connect()
-            if settings.smtp_user:
-                await smtp.login(settings.smtp_user, settings.smtp_pass)
-            await smtp.send_message(msg)
-            await smtp.quit()
-
-            circuit.record_success()
-            logger.info("email_sent", extra={"to_email": to_email, "subject": subject, "attempt": attempt})
+            _, relay = await _run_on_relays(transaction)
+            logger.info("email_sent", extra={"to_email": to_email, "subject": subject, "attempt": attempt, "relay": relay.name})
             return True, None
 
         except Exception as e:
-            circuit.record_failure()
-            logger.error(
-                "smtp_error",
-                extra={"attempt": attempt, "to_email": to_email, "error": str(e)}
-            )
+            if is_recipient_rejection(e):
+                logger.warning("recipient_rejected", extra={"to_email": to_email, "error": str(e)})
+                suppression.record_bounce(to_email, str(e))
+                return False, str(e)
+            if is_temporary_rejection(e):
+                # 421/451-style throttling: the relay is healthy, so back off without tripping the circuit
+                logger.warning(
+                    "smtp_temporary_rejection",
+                    extra={"attempt": attempt, "to_email": to_email, "error": str(e)}
+                )
+            else:
+                logger.error(
+                    "smtp_error",
+                    extra={"attempt": attempt, "to_email": to_email, "error": str(e)}
+                )
             await asyncio.sleep(2 ** attempt)  # Exponential backoff
 
     logger.error(
         "email_failed_after_retries",
         extra={"to_email": to_email, "attempts": settings.max_retry_attempts}
     )
-    return False, f"Failed after {settings.max_retry_attempts} attempts"
\ No newline at end of file
+    return False, f"Failed after {settings.max_retry_attempts} attempts"
+
+# Merged envelopes carry many recipients, so none of them is named in the header
+UNDISCLOSED_RECIPIENTS = "undisclosed-recipients:;"
+
+async def send_email_group_async(
+    recipients: list[str],
+    subject: str,
+    body: str,
+    html: bool = False,
+    attachments: list[str] | None = None,
+) -> dict[str, tuple[bool, str | None]]:
+    """
+    Sends identical content to many recipients in one SMTP transaction
+    (MAIL FROM, one RCPT TO per recipient, a single DATA upload). A group of
+    one goes through send_email_async instead.
+    Returns (success, error) per recipient. 5xx RCPT replies fail only that
+    recipient; 4xx replies and transaction-level errors are retried with backoff.
+    """
+    recipients = list(dict.fromkeys(recipients))
+    if len(recipients) == 1:
+        # Nothing was merged: send it as a plain message with its real To header
+        return {recipients[0]: await send_email_async(recipients[0], subject, body, html, attachments)}
+    if not subject or not body:
+        return {r: (False, "Recipient, subject, and body must be provided") for r in recipients}
+    missing = [digest for digest in attachments or [] if not await attachment_store.exists(digest)]
+    if missing:
+        return {r: (False, f"Unknown attachment id(s): {', '.join(missing)}") for r in recipients}
+
+    results: dict[str, tuple[bool, str | None]] = {}
+    pending = []
+    for r in recipients:
+        if r and EMAIL_REGEX.match(r):
+            pending.append(r)
+        else:
+            results[r] = (False, "Invalid email address format")
+
+    data = None
+    if not attachments and pending:
+        with stage_timer("smtp.build_mime"), tracing.span("render"):
+            data = await render_pool.render(
+                {"from": settings.email_from, "to": UNDISCLOSED_RECIPIENTS, "subject": subject, "body": body, "html": html}
+            )
+
+    async def transaction(smtp: SMTP) -> tuple[list[str], list[str], dict[str, str]]:
+        accepted, deferred, refused = [], [], {}
+        with stage_timer("smtp.send_message"):
+            await smtp.mail(settings.email_from)
+            for r in pending:
+                try:
+                    await smtp.rcpt(r)
+                    accepted.append(r)
+                except SMTPRecipientRefused as e:
+                    if 400 <= e.code < 500:
+                        deferred.append(r)
+                    else:
+                        refused[r] = str(e)
+            if accepted:
+                if attachments:
+                    await stream_data(smtp, _mime_stream(UNDISCLOSED_RECIPIENTS, subject, body, html, attachments), timeout=60)
+                else:
+                    await smtp.data(data)
+            else:
+                await smtp.rset()
+        return accepted, deferred, refused
+
+    for attempt in range(1, settings.max_retry_attempts + 1):
+        if not pending:
+            break
+        if not relay_router.available():
+            logger.warning("circuit_open", extra={"recipients": len(pending)})
+            results.update({r: (False, "Circuit breaker is OPEN") for r in pending})
+            return results
+
+        try:
+            # Relay quotas count recipients, not transactions
+            (accepted, deferred, refused), relay = await _run_on_relays(transaction, tokens=len(pending))
+            results.update({r: (True, None) for r in accepted})
+            results.update({r: (False, error) for r, error in refused.items()})
+            for r, error in refused.items():
+                suppression.record_bounce(r, error)
+            logger.info(
+                "email_group_sent",
+                extra={
+                    "subject": subject,
+                    "relay": relay.name,
+                    "accepted": len(accepted),
+                    "deferred": len(deferred),
+                    "attempt": attempt,
+                }
+            )
+            pending = deferred
+            if deferred:
+                relay.concurrency.on_rejection()
+
+        except Exception as e:
+            if is_temporary_rejection(e):
+                logger.warning(
+                    "smtp_temporary_rejection",
+                    extra={"attempt": attempt, "recipients": len(pending), "error": str(e)}
+                )
+            else:
+                logger.error(
+                    "smtp_error",
+                    extra={"attempt": attempt, "recipients": len(pending), "error": str(e)}
+                )
+
+        if pending:
+            await asyncio.sleep(2 ** attempt)  # Exponential backoff
+
+    if pending:
+        logger.error(
+            "email_failed_after_retries",
+            extra={"recipients": len(pending), "attempts": settings.max_retry_attempts}
+        )
+        results.update({r: (False, f"Failed after {settings.max_retry_attempts} attempts") for r in pending})
+    return results
@@ -1,10 +1,15 @@
+from app.config import settings
 from app.services.email_sender import send_email_async
+from app.services.envelope_merger import envelope_merger
 from app.utils.logger import get_logger
 
 logger = get_logger("email_service")
 
-async def send_email(recipient: str, subject: str, body: str):
-    success, error = await send_email_async(to_email=recipient, subject=subject, body=body)
+async def send_email(recipient: str, subject: str, body: str, attachments: list[str] | None = None):
+    if settings.envelope_merge_enabled:
+        success, error = await envelope_merger.send(recipient, subject, body, attachments)
+    else:
+        success, error = await send_email_async(to_email=recipient, subject=subject, body=body, attachments=attachments)
     if not success:
         logger.error("email_send_failed", extra={"recipient": recipient, "subject": subject, "error": error})
         raise Exception(error)
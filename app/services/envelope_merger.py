@@ -0,0 +1,93 @@
+import hashlib
+from typing import Awaitable, Callable
+from app.config import settings
+from app.services.batch_publisher import BatchPublisher
+from app.utils.logger import get_logger
+
+logger = get_logger("envelope_merger")
+
+SendGroup = Callable[..., Awaitable[dict[str, tuple[bool, str | None]]]]
+
+# Idle groups are pruned once this many distinct keys have been seen
+MAX_IDLE_GROUPS = 1024
+
+
+def merge_key(recipient: str, subject: str, body: str, attachments: list[str] | None) -> str:
+    """Messages share an envelope only with identical content and the same recipient domain."""
+    domain = recipient.rsplit("@", 1)[-1].lower()
+    content = hashlib.blake2b(digest_size=16)
+    for part in (subject, body, *(attachments or [])):
+        content.update(part.encode("utf-8"))
+        content.update(b"\0")
+    return f"{domain}:{content.hexdigest()}"
+
+
+class EnvelopeMerger:
+    """Coalesces identical messages into multi-recipient SMTP transactions.
+
+    Each merge key gets its own BatchPublisher: messages collect for up to
+    linger_ms (or until max_recipients are waiting) and go out as one
+    MAIL FROM / many RCPT TO / one DATA. The per-recipient result is handed
+    back to the caller that submitted that recipient, so every request_id
+    still gets its own delivered/failed status and DLQ handling.
+
+    A group can only be as large as the number of messages in flight at
+    once, i.e. the consumer pool's task count.
+    """
+
+    def __init__(self, send_group: SendGroup | None = None, linger_ms: float | None = None, max_recipients: int | None = None):
+        self._send_group = send_group
+        self.linger_ms = settings.envelope_linger_ms if linger_ms is None else linger_ms
+        self.max_recipients = max_recipients or settings.envelope_max_recipients
+        self.groups: dict[str, BatchPublisher] = {}
+        self.transactions = 0
+        self.recipients = 0
+
+    async def send_group(self, recipients, subject, body, attachments):
+        if self._send_group is None:
+            from app.services.email_sender import send_email_group_async
+            self._send_group = send_email_group_async
+        return await self._send_group(recipients, subject, body, attachments=attachments)
+
+    def _batcher(self, subject: str, body: str, attachments: list[str] | None) -> BatchPublisher:
+        async def send_batch(recipients: list[str]) -> list[tuple[bool, str | None]]:
+            self.transactions += 1
+            self.recipients += len(recipients)
+            results = await self.send_group(recipients, subject, body, attachments)
+            return [results.get(r, (False, "No result for recipient")) for r in recipients]
+
+        return BatchPublisher(send_batch, self.linger_ms, self.max_recipients)
+
+    def _prune(self) -> None:
+        for key in [key for key, group in self.groups.items() if not group._buffer and not group._inflight]:
+            del self.groups[key]
+
+    async def send(
+        self,
+        recipient: str,
+        subject: str,
+        body: str,
+        attachments: list[str] | None = None,
+    ) -> tuple[bool, str | None]:
+        key = merge_key(recipient, subject, body, attachments)
+        group = self.groups.get(key)
+        if group is None:
+            if len(self.groups) >= MAX_IDLE_GROUPS:
+                self._prune()
+            group = self.groups[key] = self._batcher(subject, body, attachments)
+        try:
+            return await group.submit(recipient)
+        except Exception as e:
+            return False, str(e)
+
+    def stats(self) -> dict:
+        return {
+            "enabled": settings.envelope_merge_enabled,
+            "transactions": self.transactions,
+            "recipients": self.recipients,
+            "avg_recipients_per_transaction": round(self.recipients / self.transactions, 2) if self.transactions else 0,
+            "open_groups": len(self.groups),
+        }
+
+
+envelope_merger = EnvelopeMerger()
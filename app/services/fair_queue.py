@@ -0,0 +1,152 @@
+import asyncio
+import time
+from collections import deque
+from typing import Any, Callable
+from app.services.tenants import DEFAULT_TENANT, tenant_cap, tenant_weight
+
+# Smoothing for the per-tenant latency EWMAs
+EWMA_ALPHA = 0.1
+# Idle lanes of tenants beyond this many are forgotten (tenant names come from clients)
+MAX_LANES = 1000
+
+
+class TenantLane:
+    def __init__(self, weight: float, cap: int):
+        self.weight = max(weight, 0.01)
+        self.cap = cap
+        self.items: deque[tuple[float, Any]] = deque()
+        self.deficit = 0.0
+        self.in_flight = 0
+        self.dispatched = 0
+        self.wait_ms: float | None = None
+        self.service_ms: float | None = None
+        self.latency_ms: float | None = None
+
+    def eligible(self) -> bool:
+        return bool(self.items) and (not self.cap or self.in_flight < self.cap)
+
+
+class FairBuffer:
+    """Local delivery buffer dispatched by deficit round-robin across tenants.
+
+    Each tenant has its own FIFO lane. Visiting a lane adds its weight to the
+    lane's deficit and every dispatched message costs 1, so over time tenants
+    are served in proportion to their weights whatever their backlog. A lane
+    at its max_in_flight cap is skipped (keeping its deficit) until one of its
+    deliveries finishes. A configured tenant (TENANTS) with a 200k backlog
+    therefore only delays its own messages. Unconfigured tenants share the
+    FIFO email.queue: the buffer can only reorder the messages prefetched from
+    it, so one of them with a large backlog still delays the others.
+
+    Drop-in for the asyncio.Queue the pool used: put()/get()/qsize(), plus
+    done(tenant) when a delivery finishes.
+    """
+
+    def __init__(
+        self,
+        tenant_of: Callable[[Any], str],
+        weight_of: Callable[[str], float] = tenant_weight,
+        cap_of: Callable[[str], int] = tenant_cap,
+    ):
+        self.tenant_of = tenant_of
+        self.weight_of = weight_of
+        self.cap_of = cap_of
+        self.lanes: dict[str, TenantLane] = {}
+        self._active: deque[str] = deque()  # round-robin order of lanes with work
+        self._changed = asyncio.Condition()
+        self._size = 0
+
+    def _lane(self, tenant: str) -> TenantLane:
+        lane = self.lanes.get(tenant)
+        if lane is None:
+            lane = self.lanes[tenant] = TenantLane(self.weight_of(tenant), self.cap_of(tenant))
+        return lane
+
+    def qsize(self) -> int:
+        return self._size
+
+    async def put(self, item: Any) -> None:
+        tenant = self.tenant_of(item) or DEFAULT_TENANT
+        lane = self._lane(tenant)
+        if not lane.items and tenant not in self._active:
+            self._active.append(tenant)
+        lane.items.append((time.monotonic(), item))
+        self._size += 1
+        async with self._changed:
+            self._changed.notify()
+
+    def _next(self) -> tuple[str, Any] | None:
+        # Each full rotation adds weight to every eligible lane, so this terminates
+        # as soon as any lane is eligible.
+        if not any(self.lanes[t].eligible() for t in self._active):
+            return None
+        while True:
+            tenant = self._active[0]
+            lane = self.lanes[tenant]
+            if not lane.items:
+                self._active.popleft()
+                lane.deficit = 0.0
+                continue
+            if lane.eligible() and lane.deficit >= 1:
+                lane.deficit -= 1
+                enqueued, item = lane.items.popleft()
+                lane.in_flight += 1
+                lane.dispatched += 1
+                wait = (time.monotonic() - enqueued) * 1000
+                lane.wait_ms = wait if lane.wait_ms is None else (1 - EWMA_ALPHA) * lane.wait_ms + EWMA_ALPHA * wait
+                self._size -= 1
+                if not lane.items:
+                    self._active.popleft()
+                    lane.deficit = 0.0
+                return tenant, item
+            # Out of credit (or capped): refill and move to the back of the rotation
+            if lane.eligible():
+                lane.deficit += lane.weight
+            self._active.rotate(-1)
+
+    async def get(self) -> tuple[str, Any]:
+        async with self._changed:
+            while (picked := self._next()) is None:
+                await self._changed.wait()
+            return picked
+
+    def take_all(self) -> list[tuple[str, Any]]:
+        """Remove every item not dispatched yet (e.g. to hand it back to the broker on shutdown)."""
+        items = [(tenant, item) for tenant, lane in self.lanes.items() for _, item in lane.items]
+        for lane in self.lanes.values():
+            lane.items.clear()
+            lane.deficit = 0.0
+        self._active.clear()
+        self._size = 0
+        return items
+
+    async def done(self, tenant: str, service_seconds: float | None = None, latency_seconds: float | None = None) -> None:
+        """Release the tenant's in-flight slot; latency is publish-to-done when known."""
+        lane = self.lanes[tenant]
+        lane.in_flight -= 1
+        if service_seconds is not None:
+            ms = service_seconds * 1000
+            lane.service_ms = ms if lane.service_ms is None else (1 - EWMA_ALPHA) * lane.service_ms + EWMA_ALPHA * ms
+        if latency_seconds is not None:
+            ms = latency_seconds * 1000
+            lane.latency_ms = ms if lane.latency_ms is None else (1 - EWMA_ALPHA) * lane.latency_ms + EWMA_ALPHA * ms
+        if not lane.items and not lane.in_flight and len(self.lanes) > MAX_LANES:
+            del self.lanes[tenant]
+        async with self._changed:
+            # A capped lane may be eligible again
+            self._changed.notify()
+
+    def stats(self) -> dict:
+        return {
+            tenant: {
+                "weight": lane.weight,
+                "max_in_flight": lane.cap,
+                "backlog": len(lane.items),
+                "in_flight": lane.in_flight,
+                "dispatched": lane.dispatched,
+                "buffer_wait_ms": round(lane.wait_ms, 1) if lane.wait_ms is not None else None,
+                "service_ms": round(lane.service_ms, 1) if lane.service_ms is not None else None,
+                "end_to_end_ms": round(lane.latency_ms, 1) if lane.latency_ms is not None else None,
+            }
+            for tenant, lane in self.lanes.items()
+        }
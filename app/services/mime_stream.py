@@ -0,0 +1,174 @@
+import base64
+import re
+import uuid
+from email.header import Header
+from email.utils import formatdate, make_msgid
+from typing import AsyncIterator, Awaitable, Callable
+from urllib.parse import quote
+from aiosmtplib import SMTP, SMTPDataError, SMTPResponse, SMTPServerDisconnected, SMTPStatus
+from app.services.content_store import ContentStore
+from app.services.dkim import RelaxedBodyHasher, split_message
+
+# 57 raw bytes encode to one 76-character base64 line
+B64_LINE_BYTES = 57
+READ_CHUNK = B64_LINE_BYTES * 1024
+CONTENT_TYPE_REGEX = re.compile(r"^[\w.+-]+/[\w.+-]+$")
+
+
+def _b64_lines(data: bytes) -> bytes:
+    encoded = base64.b64encode(data)
+    return b"".join(encoded[i:i + 76] + b"\r\n" for i in range(0, len(encoded), 76))
+
+
+def _header(name: str, value: str) -> bytes:
+    # A line break would end the header early: injected headers, or a "." line ending DATA
+    if "\r" in value or "\n" in value:
+        raise ValueError(f"{name} header may not contain CR or LF")
+    if not value.isascii():
+        value = Header(value, "utf-8").encode()
+    return f"{name}: {value}\r\n".encode()
+
+
+def _filename_params(filename: str) -> str:
+    if filename.isascii() and filename.isprintable() and '"' not in filename and "\\" not in filename:
+        return f'filename="{filename}"'
+    # RFC 2231: percent-encoding also neutralizes quotes and line breaks
+    return f"filename*=utf-8''{quote(filename, safe='')}"
+
+
+def _content_type(value: str | None) -> str:
+    return value if value and CONTENT_TYPE_REGEX.match(value) else "application/octet-stream"
+
+
+async def iter_mime_message(
+    sender: str,
+    recipient: str,
+    subject: str,
+    body: str,
+    html: bool,
+    attachment_ids: list[str],
+    store: ContentStore,
+    boundary: str | None = None,
+    date: str | None = None,
+    message_id: str | None = None,
+) -> AsyncIterator[bytes]:
+    """Yield a multipart/mixed message in chunks, attachments base64-encoded on the fly.
+
+    Every part is base64 and header values with CR/LF raise ValueError, so the
+    caller-supplied text cannot add headers or lines. Passing boundary, date and
+    message_id makes the output byte-for-byte repeatable.
+    """
+    boundary = boundary or f"=_{uuid.uuid4().hex}"
+    yield b"".join([
+        _header("From", sender),
+        _header("To", recipient),
+        _header("Subject", subject),
+        _header("Date", date or formatdate(localtime=False)),
+        _header("Message-ID", message_id or make_msgid()),
+        b"MIME-Version: 1.0\r\n",
+        f'Content-Type: multipart/mixed; boundary="{boundary}"\r\n\r\n'.encode(),
+        f"--{boundary}\r\n".encode(),
+        f"Content-Type: text/{'html' if html else 'plain'}; charset=utf-8\r\n".encode(),
+        b"Content-Transfer-Encoding: base64\r\n\r\n",
+        _b64_lines(body.encode("utf-8")),
+    ])
+
+    for digest in attachment_ids:
+        meta = await store.metadata(digest)
+        filename = meta.get("filename") or digest[:12]
+        yield b"".join([
+            f"--{boundary}\r\n".encode(),
+            f"Content-Type: {_content_type(meta.get('content_type'))}\r\n".encode(),
+            f"Content-Disposition: attachment; {_filename_params(filename)}\r\n".encode(),
+            b"Content-Transfer-Encoding: base64\r\n\r\n",
+        ])
+        async for chunk in store.iter_chunks(digest, READ_CHUNK):
+            # READ_CHUNK is a multiple of 57, so only the last chunk can carry padding
+            yield _b64_lines(chunk)
+
+    yield f"--{boundary}--\r\n".encode()
+
+
+async def iter_signed_mime_message(
+    sender: str,
+    recipient: str,
+    subject: str,
+    body: str,
+    html: bool,
+    attachment_ids: list[str],
+    store: ContentStore,
+    sign: Callable[[bytes, str], Awaitable[bytes | None]],
+) -> AsyncIterator[bytes]:
+    """iter_mime_message preceded by a DKIM-Signature header.
+
+    The signature needs the body hash before the first byte is sent, so the
+    message is generated twice with the same boundary, Date and Message-ID:
+    once into an incremental body hasher, once onto the wire. Attachments are
+    read twice but never held in memory.
+    """
+    fixed = {
+        "boundary": f"=_{uuid.uuid4().hex}",
+        "date": formatdate(localtime=False),
+        "message_id": make_msgid(),
+    }
+    args = (sender, recipient, subject, body, html, attachment_ids, store)
+    header_block = None
+    hasher = RelaxedBodyHasher()
+    async for chunk in iter_mime_message(*args, **fixed):
+        if header_block is None:
+            # The first chunk holds the whole header block
+            header_block, chunk = split_message(chunk)
+        hasher.update(chunk)
+
+    signature = await sign(header_block, hasher.digest())
+    if signature:
+        yield signature
+    async for chunk in iter_mime_message(*args, **fixed):
+        yield chunk
+
+
+async def dot_stuff(chunks: AsyncIterator[bytes]) -> AsyncIterator[bytes]:
+    """Double every "." that starts a line (RFC 5321 4.5.2), across chunk boundaries.
+
+    Also ends the stream with CRLF, so the terminating ".\r\n" is always a line of its own.
+    """
+    line_start = True
+    async for chunk in chunks:
+        if not chunk:
+            continue
+        chunk = chunk.replace(b"\n.", b"\n..")
+        if line_start and chunk.startswith(b"."):
+            chunk = b"." + chunk
+        line_start = chunk.endswith(b"\n")
+        yield chunk
+    if not line_start:
+        yield b"\r\n"
+
+
+async def stream_data(smtp: SMTP, chunks: AsyncIterator[bytes], timeout: float | None = None) -> SMTPResponse:
+    """SMTP DATA phase fed from an async iterator instead of one bytes object.
+
+    Mirrors SMTPProtocol.execute_data_command, but drains the transport after
+    each chunk so memory stays bounded by the chunk size. Chunks must be
+    CRLF-terminated; they are dot-stuffed on the way out.
+    """
+    protocol = smtp.protocol
+    if protocol is None or protocol._command_lock is None:
+        raise SMTPServerDisconnected("Connection lost")
+
+    async with protocol._command_lock:
+        protocol.write(b"DATA\r\n")
+        start_response = await protocol.read_response(timeout=timeout)
+        if start_response.code != SMTPStatus.start_input:
+            raise SMTPDataError(start_response.code, start_response.message)
+
+        async for chunk in dot_stuff(chunks):
+            protocol.write(chunk)
+            await protocol._drain_helper()
+
+        protocol.write(b".\r\n")
+        response = await protocol.read_response(timeout=timeout)
+        if response.code != SMTPStatus.completed:
+            raise SMTPDataError(response.code, response.message)
+
+    return response
@@ -0,0 +1,410 @@
+import asyncio
+import json
+try:
+    import fcntl
+except ImportError:  # Windows: one process per OUTBOX_DIR (serve.py enforces it)
+    fcntl = None
+import mmap
+import os
+import struct
+import zlib
+from typing import IO
+from app.config import settings
+from app.utils.logger import get_logger
+
+logger = get_logger("outbox")
+
+# Record frame: payload length, crc32 of payload, payload
+HEADER = struct.Struct("<II")
+CHECKPOINT_FILE = "checkpoint"
+LOCK_FILE = "lock"
+MAX_SLOTS = 64
+
+
+def claim_slot(root: str) -> tuple[str, IO | None]:
+    """The lowest outbox directory under root that no live process holds.
+
+    Slot 0 is root itself, slot n is root/<n>. Each is guarded by an exclusive
+    flock held for the life of the process (the OS drops it when the process
+    dies), so sibling API_WORKERS processes never write the same segments or
+    checkpoint, and a restarted process takes over, and relays, a dead one's slot.
+    """
+    os.makedirs(root, exist_ok=True)
+    if fcntl is None:
+        return root, None
+    for slot in range(MAX_SLOTS):
+        directory = root if slot == 0 else os.path.join(root, str(slot))
+        os.makedirs(directory, exist_ok=True)
+        lock = open(os.path.join(directory, LOCK_FILE), "a")
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            lock.close()
+            continue
+        return directory, lock
+    raise RuntimeError(f"Every outbox slot under {root} is held by another process")
+
+
+def orphaned_slots(root: str, in_use: int) -> list[tuple[str, IO]]:
+    """Slots numbered in_use and up that no live process holds, locked for the caller.
+
+    These were left by processes that are not coming back (API_WORKERS was
+    lowered): claim_slot hands out the lowest free slot, so nobody would
+    relay what they still hold.
+    """
+    if fcntl is None:
+        return []
+    claimed = []
+    for slot in range(max(1, in_use), MAX_SLOTS):
+        directory = os.path.join(root, str(slot))
+        if not os.path.isdir(directory):
+            continue
+        lock = open(os.path.join(directory, LOCK_FILE), "a")
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            lock.close()
+            continue
+        claimed.append((directory, lock))
+    return claimed
+
+
+class SegmentLog:
+    """Append-only log split into numbered segment files.
+
+    Appends are queued and written by a single flusher that fsyncs once per
+    group, so concurrent callers share one fsync. Readers map committed bytes
+    with mmap and never see a record before it is durable.
+    """
+
+    def __init__(self, directory: str, segment_bytes: int, group_commit_ms: float):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.group_commit = group_commit_ms / 1000
+        os.makedirs(directory, exist_ok=True)
+
+        segments = self.segments()
+        self.active = segments[-1] if segments else 0
+        self.committed = self._recover(self.active)
+        self._file = open(self._path(self.active), "ab")
+
+        self._pending: list[tuple[bytes, asyncio.Future]] = []
+        self._wakeup = asyncio.Event()
+        self.committed_event = asyncio.Event()
+        self._flusher: asyncio.Task | None = None
+        self._closed = False
+
+        self.appends = 0
+        self.fsyncs = 0
+
+    def _path(self, segment: int) -> str:
+        return os.path.join(self.directory, f"{segment:012d}.log")
+
+    def segments(self) -> list[int]:
+        return sorted(int(name[:-4]) for name in os.listdir(self.directory) if name.endswith(".log"))
+
+    def _recover(self, segment: int) -> int:
+        """Return the end of the last complete record, truncating a torn tail."""
+        path = self._path(segment)
+        if not os.path.exists(path):
+            open(path, "wb").close()
+            return 0
+        size = os.path.getsize(path)
+        end = 0
+        if size:
+            with open(path, "rb") as f, mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ) as view:
+                while end + HEADER.size <= size:
+                    length, crc = HEADER.unpack_from(view, end)
+                    stop = end + HEADER.size + length
+                    if stop > size or zlib.crc32(view[end + HEADER.size:stop]) != crc:
+                        break
+                    end = stop
+        if end != size:
+            logger.warning({"status": "outbox_torn_tail", "segment": segment, "truncated_bytes": size - end})
+            with open(path, "r+b") as f:
+                f.truncate(end)
+        return end
+
+    def start(self) -> None:
+        if self._flusher is None or self._flusher.done():
+            self._flusher = asyncio.create_task(self._flush_loop())
+
+    async def close(self) -> None:
+        """Stop the flusher after it has made every queued append durable."""
+        self._closed = True
+        self._wakeup.set()
+        if self._flusher:
+            await self._flusher
+        await self._flush()
+        self._file.close()
+
+    async def append(self, payload: bytes) -> None:
+        """Resolve once the record is fsynced."""
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append((HEADER.pack(len(payload), zlib.crc32(payload)) + payload, future))
+        self._wakeup.set()
+        await future
+
+    async def _flush_loop(self) -> None:
+        while not self._closed:
+            await self._wakeup.wait()
+            if self.group_commit and not self._closed:
+                await asyncio.sleep(self.group_commit)
+            self._wakeup.clear()
+            await self._flush()
+
+    async def _flush(self) -> None:
+        batch, self._pending = self._pending, []
+        if not batch:
+            return
+        try:
+            if self.committed >= self.segment_bytes:
+                self._rotate()
+            self.committed = await asyncio.to_thread(self._write, [frame for frame, _ in batch], self.committed)
+        except Exception as e:
+            logger.error({"status": "outbox_write_failed", "error": str(e)})
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        self.appends += len(batch)
+        self.fsyncs += 1
+        for _, future in batch:
+            if not future.done():
+                future.set_result(None)
+        self.committed_event.set()
+
+    def _rotate(self) -> None:
+        # On the loop thread, so a reader never sees the new segment number with the old file's offsets
+        self._file.close()
+        self._file = open(self._path(self.active + 1), "ab")
+        self.active, self.committed = self.active + 1, 0
+
+    def _write(self, frames: list[bytes], size: int) -> int:
+        # Runs in a worker thread; the loop keeps accepting appends meanwhile
+        data = b"".join(frames)
+        try:
+            self._file.write(data)
+            self._file.flush()
+            os.fsync(self._file.fileno())
+        except Exception:
+            # Part of the batch may be on disk (or stuck in the buffer): cut the file back
+            # to the last committed record so later appends land where offsets expect them
+            try:
+                self._file.close()
+            except Exception:
+                pass
+            os.truncate(self._path(self.active), size)
+            self._file = open(self._path(self.active), "ab")
+            raise
+        return size + len(data)
+
+    async def read(self, position: tuple[int, int], limit: int) -> tuple[list[bytes], tuple[int, int]]:
+        """Read up to limit committed records starting at (segment, offset).
+
+        The open and mmap run in a worker thread. The active segment and its
+        committed end are taken on the loop thread first, so a rotation while
+        the thread reads cannot pair the new segment number with old offsets.
+        """
+        return await asyncio.to_thread(self._read, position, limit, self.active, self.committed)
+
+    def _read(self, position: tuple[int, int], limit: int, active: int, committed: int) -> tuple[list[bytes], tuple[int, int]]:
+        segment, offset = position
+        records: list[bytes] = []
+        while len(records) < limit:
+            end = committed if segment == active else os.path.getsize(self._path(segment))
+            if offset >= end:
+                if segment >= active:
+                    break
+                segment, offset = segment + 1, 0
+                continue
+            with open(self._path(segment), "rb") as f, mmap.mmap(f.fileno(), end, access=mmap.ACCESS_READ) as view:
+                while offset < end and len(records) < limit:
+                    length, _ = HEADER.unpack_from(view, offset)
+                    start = offset + HEADER.size
+                    records.append(view[start:start + length])
+                    offset = start + length
+        return records, (segment, offset)
+
+    def backlog_bytes(self, position: tuple[int, int]) -> int:
+        segment, offset = position
+        total = 0
+        for number in self.segments():
+            if number < segment:
+                continue
+            end = self.committed if number == self.active else os.path.getsize(self._path(number))
+            total += end - (offset if number == segment else 0)
+        return max(total, 0)
+
+    def truncate_before(self, segment: int) -> None:
+        """Delete segments that the relay has fully forwarded."""
+        for number in self.segments():
+            if number < segment and number != self.active:
+                os.remove(self._path(number))
+
+
+class Outbox:
+    """Durable local outbox in front of the broker.
+
+    /send_email appends to the segment log and returns; the relay forwards
+    records to RabbitMQ in batches and only advances its checkpoint after the
+    broker confirmed them, so delivery is at-least-once and a restart replays
+    everything after the last checkpoint.
+    """
+
+    def __init__(self):
+        self.log: SegmentLog | None = None
+        self.directory = settings.outbox_dir
+        self._lock: IO | None = None
+        self.position: tuple[int, int] = (0, 0)
+        self._relay: asyncio.Task | None = None
+        self._orphans: asyncio.Task | None = None
+        self._draining = False
+        self.relayed = 0
+        self.relay_errors = 0
+        self._consecutive_errors = 0
+        self.last_error: str | None = None
+
+    @property
+    def enabled(self) -> bool:
+        return self.log is not None
+
+    def _checkpoint_path(self) -> str:
+        return os.path.join(self.directory, CHECKPOINT_FILE)
+
+    def _load_checkpoint(self) -> tuple[int, int]:
+        try:
+            with open(self._checkpoint_path()) as f:
+                segment, offset = f.read().split()
+                return int(segment), int(offset)
+        except (FileNotFoundError, ValueError):
+            segments = self.log.segments() if self.log else []
+            return (segments[0] if segments else 0), 0
+
+    def _save_checkpoint(self, position: tuple[int, int]) -> None:
+        tmp = self._checkpoint_path() + ".tmp"
+        with open(tmp, "w") as f:
+            f.write(f"{position[0]} {position[1]}")
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self._checkpoint_path())
+
+    def _open(self, directory: str, lock: IO | None) -> None:
+        self.directory, self._lock = directory, lock
+        self.log = SegmentLog(self.directory, settings.outbox_segment_bytes, settings.outbox_group_commit_ms)
+        self.position = self._load_checkpoint()
+
+    async def start(self) -> None:
+        self._open(*claim_slot(settings.outbox_dir))
+        self.log.start()
+        self._relay = asyncio.create_task(self._relay_loop())
+        self._orphans = asyncio.create_task(self.drain_orphans())
+        logger.info({"status": "outbox_started", "dir": self.directory, "position": list(self.position)})
+
+    async def drain_orphans(self, in_use: int | None = None) -> int:
+        """Relay what slots above the API_WORKERS in use still hold, then release them.
+
+        A slot whose relay fails keeps its records and checkpoint; the next
+        start tries it again.
+        """
+        in_use = max(1, settings.api_workers) if in_use is None else in_use
+        relayed = 0
+        for directory, lock in await asyncio.to_thread(orphaned_slots, settings.outbox_dir, in_use):
+            orphan = Outbox()
+            try:
+                orphan._open(directory, lock)
+                orphan._draining = True
+                await orphan._relay_loop()
+            except Exception as e:
+                logger.error({"status": "outbox_orphan_drain_failed", "dir": directory, "error": str(e)})
+            finally:
+                await orphan.stop()
+            relayed += orphan.relayed
+            if orphan.relayed:
+                logger.info({"status": "outbox_orphan_drained", "dir": directory, "relayed": orphan.relayed})
+        return relayed
+
+    async def stop(self, timeout: float = 5) -> None:
+        """Forward what is left (up to timeout) so a publish is not cut off before its checkpoint."""
+        if self._orphans:
+            self._orphans.cancel()
+            await asyncio.gather(self._orphans, return_exceptions=True)
+            self._orphans = None
+        if self._relay:
+            self._draining = True
+            if self.log:
+                self.log.committed_event.set()
+            try:
+                await asyncio.wait_for(self._relay, timeout)
+            except (asyncio.CancelledError, asyncio.TimeoutError):
+                pass
+            self._relay = None
+            self._draining = False
+        if self.log:
+            await self.log.close()
+        self.log = None
+        if self._lock:
+            self._lock.close()  # releases the flock: the slot is free for the next process
+            self._lock = None
+
+    async def append(self, message: dict) -> None:
+        if not self.log:
+            raise RuntimeError("Outbox is not started")
+        await self.log.append(json.dumps(message).encode())
+
+    async def _relay_loop(self) -> None:
+        # Imported lazily so the outbox can be used without a broker client loaded
+        from app.services.queue_publisher import publish_batch
+
+        assert self.log
+        while True:
+            records, next_position = await self.log.read(self.position, settings.outbox_relay_batch)
+            if not records:
+                if self._draining:
+                    return
+                self.log.committed_event.clear()
+                try:
+                    await asyncio.wait_for(self.log.committed_event.wait(), timeout=1)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            try:
+                results = await publish_batch([json.loads(record) for record in records])
+                errors = [result for result in results if isinstance(result, Exception)]
+                if errors:
+                    raise errors[0]
+            except Exception as e:
+                self.relay_errors += 1
+                self._consecutive_errors += 1
+                self.last_error = str(e)
+                logger.error({"status": "outbox_relay_failed", "error": str(e), "pending": len(records)})
+                if self._draining:
+                    return  # relayed after the next start
+                await asyncio.sleep(min(30, 2 ** min(self._consecutive_errors, 5)))
+                continue
+
+            self._consecutive_errors = 0
+            self.relayed += len(records)
+            await asyncio.to_thread(self._save_checkpoint, next_position)
+            if next_position[0] != self.position[0]:
+                self.log.truncate_before(next_position[0])
+            self.position = next_position
+
+    def stats(self) -> dict:
+        if not self.log:
+            return {"enabled": False}
+        return {
+            "enabled": True,
+            "dir": self.directory,
+            "appended": self.log.appends,
+            "fsyncs": self.log.fsyncs,
+            "records_per_fsync": round(self.log.appends / self.log.fsyncs, 2) if self.log.fsyncs else 0,
+            "relayed": self.relayed,
+            "backlog_bytes": self.log.backlog_bytes(self.position),
+            "relay_errors": self.relay_errors,
+            "last_error": self.last_error,
+        }
+
+
+outbox = Outbox()
@@ -1,19 +1,324 @@
 import asyncio
+import itertools
+import time
+from contextlib import contextmanager
+from datetime import datetime, timezone
 import aio_pika
 import json
+from collections import Counter
 from app.services.email_service import send_email
+from app.services.claim_check import resolve_body
+from app.services.queue_publisher import is_expired
 from app.config import settings
-from app.utils.logger import get_logger
+from app.services import autoscaler
+from app.services.fair_queue import FairBuffer
+from app.services.sharding import assigned_shards, declare_email_queues
+from app.services.tenants import DEFAULT_TENANT, TENANT_HEADER, declare_tenant_queues, tenant_queue_name
+from app.services.status_hub import status_bus, status_hub
+from app.services.status_store import record_final_status
+from app.models import EmailStatusEnum
+from app.services.suppression import suppression
+from app.services.webhooks import notify
+from app.utils.logger import get_logger, record_context
+from app.utils.profiling import stage_timer
+from app.utils import tracing
 
 logger = get_logger("queue_consumer")
 
 # In-memory status tracking
 email_status_store: dict[str, str] = {}
 
-async def consume() -> None:
+# Messages shed past their expires_at, by what happened to them
+expired_counts: Counter[str] = Counter()
+
+def set_status(request_id: str, status: str, **fields) -> None:
+    """Record a status transition and push it to stream subscribers."""
+    email_status_store[request_id] = status
+    status_hub.publish(request_id, status, **fields)
+
+async def finish(data: dict, request_id: str, status: str, **fields) -> None:
+    """A delivery's final status: in memory, on the stream, to its webhook and, if enabled, to email_status."""
+    set_status(request_id, status, **fields)
+    notify(data, request_id, status, **fields)
+    if settings.status_store_enabled:
+        await record_final_status(data, EmailStatusEnum(status), fields.get("error"))
+
+async def dead_letter(
+    channel: aio_pika.abc.AbstractChannel,
+    message: aio_pika.abc.AbstractIncomingMessage,
+    request_id: str,
+    reason: str,
+) -> None:
+    try:
+        await channel.default_exchange.publish(
+            aio_pika.Message(
+                body=message.body,
+                delivery_mode=aio_pika.DeliveryMode.PERSISTENT,
+                headers={"x-dead-letter-reason": reason},
+            ),
+            routing_key=settings.dead_letter_queue_name
+        )
+        logger.info({"status": "sent_to_dlq", "request_id": request_id, "reason": reason})
+    except Exception as dlq_error:
+        logger.error({"status": "dlq_failed", "error": str(dlq_error), "request_id": request_id})
+
+async def process_message(
+    channel: aio_pika.abc.AbstractChannel,
+    message: aio_pika.abc.AbstractIncomingMessage,
+    data: dict | None = None,
+) -> None:
+    async with message.process():
+        data = data or {}
+        try:
+            data = data or json.loads(message.body.decode())
+            request_id = str(data.get("request_id") or data.get("to") or "unknown")
+            set_status(request_id, "pending")
+
+            recipient = data.get("to")
+            reason = suppression.check(recipient) if recipient else None
+            if reason:
+                # Suppressed after it was queued (e.g. a hard bounce since): drop, not a failure
+                await finish(data, request_id, "suppressed")
+                logger.info({"status": "email_suppressed", "request_id": request_id, "match": reason})
+                return
+
+            if is_expired(data):
+                # Past its deadline (e.g. an OTP after a backlog): spend no capacity on it
+                action = "dead_lettered" if settings.expired_action == "dead_letter" else "dropped"
+                expired_counts[action] += 1
+                await finish(data, request_id, "expired", expires_at=data["expires_at"])
+                logger.info({"status": "email_expired", "request_id": request_id, "expires_at": data["expires_at"], "action": action})
+                if action == "dead_lettered":
+                    await dead_letter(channel, message, request_id, "expired")
+                return
+
+            subject = data.get("subject")
+            body = data.get("body")
+            if body is None and data.get("body_ref"):
+                # Claim-checked body: fetched from the blob store (LRU-cached) only now
+                with stage_timer("consume.resolve_body"), tracing.span("resolve_body"):
+                    body = await resolve_body(data["body_ref"])
+
+            if not recipient or not subject or not body:
+                raise ValueError(f"Missing required email field in message: {data}")
+
+            with stage_timer("consume.send_email"):
+                await send_email(
+                    recipient=recipient,
+                    subject=subject,
+                    body=body,
+                    attachments=data.get("attachments"),
+                )
+
+            await finish(data, request_id, "delivered")
+            with stage_timer("consume.log"):
+                logger.info({"status": "email_delivered", "request_id": request_id})
+
+        except Exception as e:
+            request_id = str(data.get("request_id") or data.get("to") or "unknown")
+            await finish(data, request_id, "failed", error=str(e))
+            logger.error({"status": "email_failed", "error": str(e), "request_id": request_id})
+
+            await dead_letter(channel, message, request_id, "failed")
+
+        with stage_timer("consume.sleep"):
+            await asyncio.sleep(0.01)
+
+
+def message_age(message: aio_pika.abc.AbstractIncomingMessage) -> float | None:
+    """Seconds since publish, from the AMQP timestamp (1 s resolution)."""
+    published = getattr(message, "timestamp", None)
+    if not isinstance(published, datetime):
+        return None
+    if published.tzinfo is None:
+        published = published.replace(tzinfo=timezone.utc)
+    return max(0.0, (datetime.now(timezone.utc) - published).total_seconds())
+
+
+@contextmanager
+def delivery_context(message: aio_pika.abc.AbstractIncomingMessage, data: dict | None):
+    """Restore the publisher's trace and request_id around one delivery.
+
+    Records the time between publish and pickup as a queue_wait span; the
+    delivery itself runs inside a consume span.
+    """
+    body = data if isinstance(data, dict) else {}
+    headers = message.headers or {}
+    parent = tracing.extract(headers, body.get("traceparent"))
+    token = tracing.activate(parent)
+    record_context.request_id = str(body.get("request_id") or body.get("to") or "") or None
+    try:
+        published_at = headers.get(tracing.PUBLISHED_AT_HEADER)
+        if parent is not None and published_at:
+            tracing.record_span(
+                "queue_wait", float(published_at) / 1000, time.time(), queue=getattr(message, "routing_key", None)
+            )
+        with tracing.span("consume"):
+            yield
+    finally:
+        tracing.deactivate(token)
+        record_context.request_id = None
+
+
+def message_tenant(message: aio_pika.abc.AbstractIncomingMessage) -> str:
+    return str((message.headers or {}).get(TENANT_HEADER) or DEFAULT_TENANT)
+
+
+class ConsumerPool:
+    """Resizable set of worker tasks draining the local delivery buffer.
+
+    The buffer is dispatched by weighted deficit round-robin across tenants
+    (see FairBuffer). Deliveries for the same recipient are serialized through
+    a FIFO lock taken in dispatch order, so per-recipient ordering within a
+    tenant survives any number of tasks.
+    """
+
+    def __init__(self, channel: aio_pika.abc.AbstractChannel):
+        self.channel = channel
+        self.buffer = FairBuffer(message_tenant)
+        self.workers: dict[int, asyncio.Task] = {}
+        self.target = 0
+        self.processed = 0
+        # (age in seconds, monotonic time) of the last delivery picked up, for the autoscaler's queue wait
+        self.last_pickup: tuple[float, float] | None = None
+        self._busy: set[int] = set()
+        self._ids = itertools.count()
+        self._key_locks: dict[str, asyncio.Lock] = {}
+        self._key_refs: dict[str, int] = {}
+        self.draining = False
+
+    @property
+    def in_flight(self) -> int:
+        return len(self._busy)
+
+    def resize(self, target: int) -> None:
+        self.target = max(0, target)
+        while len(self.workers) < self.target:
+            worker_id = next(self._ids)
+            self.workers[worker_id] = asyncio.create_task(self._worker(worker_id))
+        # Idle workers stop now; busy ones retire after their current delivery
+        idle = [worker_id for worker_id in self.workers if worker_id not in self._busy]
+        for worker_id in idle[:max(0, len(self.workers) - self.target)]:
+            self.workers.pop(worker_id).cancel()
+
+    async def stop(self) -> None:
+        tasks = list(self.workers.values())
+        self.workers.clear()
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def drain(self, timeout: float) -> dict:
+        """Stop dispatching and let in-flight deliveries finish (ack included) within timeout.
+
+        Deliveries still in the local buffer were never started: they go back
+        to the broker. Whatever is still running at the deadline is cancelled.
+        """
+        self.draining = True
+        requeued = 0
+        for _, message in self.buffer.take_all():
+            try:
+                await message.nack(requeue=True)
+                requeued += 1
+            except Exception as e:
+                logger.warning({"status": "requeue_failed", "error": str(e)})
+        for worker_id, task in self.workers.items():
+            if worker_id not in self._busy:
+                task.cancel()
+        busy = [task for worker_id, task in self.workers.items() if worker_id in self._busy]
+        finished, unfinished = await asyncio.wait(busy, timeout=timeout) if busy else (set(), set())
+        for task in unfinished:
+            task.cancel()
+        await asyncio.gather(*self.workers.values(), return_exceptions=True)
+        self.workers.clear()
+        return {"requeued": requeued, "finished": len(finished), "cut_off": len(unfinished)}
+
+    async def _worker(self, worker_id: int) -> None:
+        while True:
+            tenant, message = await self.buffer.get()
+            self._busy.add(worker_id)
+            started = time.monotonic()
+            age = message_age(message)
+            if age is not None:
+                self.last_pickup = (age, started)
+            try:
+                await self._handle(message)
+            finally:
+                self._busy.discard(worker_id)
+                self.processed += 1
+                await self.buffer.done(tenant, time.monotonic() - started, message_age(message))
+            if self.draining:
+                return
+            if len(self.workers) > self.target:
+                self.workers.pop(worker_id, None)
+                return
+
+    async def _handle(self, message: aio_pika.abc.AbstractIncomingMessage) -> None:
+        try:
+            with stage_timer("consume.parse"):
+                data = json.loads(message.body.decode())
+        except ValueError:
+            data = None
+        with delivery_context(message, data):
+            await self._deliver(message, data)
+
+    async def _deliver(self, message: aio_pika.abc.AbstractIncomingMessage, data: dict | None) -> None:
+        key = str(data.get("to") or "").lower() if isinstance(data, dict) else ""
+        if not key:
+            await process_message(self.channel, message, data)
+            return
+
+        lock = self._key_locks.setdefault(key, asyncio.Lock())
+        self._key_refs[key] = self._key_refs.get(key, 0) + 1
+        try:
+            with stage_timer("consume.recipient_wait"), tracing.span("recipient_wait"):
+                await lock.acquire()
+            try:
+                await process_message(self.channel, message, data)
+            finally:
+                lock.release()
+        finally:
+            self._key_refs[key] -= 1
+            if not self._key_refs[key]:
+                del self._key_refs[key]
+                del self._key_locks[key]
+
+
+def expired_stats() -> dict:
+    return {"action": settings.expired_action, **expired_counts}
+
+
+def tenant_stats() -> dict:
+    """Per-tenant dispatch stats of the running pool, with broker depth for dedicated queues."""
+    scaler = autoscaler.active_autoscaler
+    if scaler is None:
+        return {}
+    stats = scaler.pool.buffer.stats()
+    for tenant, lane in stats.items():
+        queue = tenant_queue_name(tenant)
+        lane["queue_depth"] = scaler.queue_depths.get(queue) if queue else None
+    return stats
+
+
+async def consume_queue(queue: aio_pika.abc.AbstractQueue, pool: ConsumerPool) -> None:
+    logger.info({"status": "started_consuming", "queue": queue.name})
+    async with queue.iterator() as queue_iter:
+        async for message in queue_iter:
+            await pool.buffer.put(message)
+
+
+async def consume(stop: asyncio.Event | None = None) -> None:
+    """Consume until cancelled, or until `stop` is set: then drain and return.
+
+    Draining cancels the basic.consume of every queue (prefetched deliveries
+    are handed back), lets in-flight deliveries finish for up to
+    DRAIN_TIMEOUT seconds and only then closes the connection, so a
+    redeploy neither cuts an SMTP transaction short nor sends it twice.
+    """
     connection: aio_pika.abc.AbstractRobustConnection | None = None
     channel: aio_pika.abc.AbstractChannel | None = None
-    queue: aio_pika.abc.AbstractQueue | None = None
+    pool: ConsumerPool | None = None
+    status_events = False
 
     try:
         rabbitmq_url = settings.queue_host
@@ -23,59 +328,48 @@ async def consume() -> None:
         async with connection:
             channel = await connection.channel()
 
-            queue = await channel.declare_queue(
-                settings.email_queue_name,
-                durable=True,
-                arguments={"x-dead-letter-exchange": settings.dead_letter_queue_name},
+            # Declares the DLQ too; every assigned shard and tenant queue feeds the same worker pool
+            queues = await declare_email_queues(channel)
+            assigned = [queues[index] for index in assigned_shards(len(queues))]
+            assigned += await declare_tenant_queues(channel)
+
+            # Transitions reach the API processes' /status/stream over the status exchange
+            if status_bus.enabled:
+                status_events = await status_bus.attach(channel)
+
+            pool = ConsumerPool(channel)
+            pool.resize(settings.consumer_tasks_min)
+            autoscaler.active_autoscaler = autoscaler.ConsumerAutoscaler(
+                pool, connection, channel, [queue.name for queue in assigned]
             )
-# Ensure DLQ exists
-            await channel.declare_queue(settings.dead_letter_queue_name, durable=True)
-
-            logger.info({"status": "started_consuming", "queue": queue.name})
-
-            async with queue.iterator() as queue_iter:
-                async for message in queue_iter:
-                    async with message.process():
-                        data: dict = {}
-                        try:
-                            data = json.loads(message.body.decode())
-                            request_id = str(data.get("request_id") or data.get("to") or "unknown")
-                            email_status_store[request_id] = "pending"
-
-                            recipient = data.get("to")
-                            subject = data.get("subject")
-                            body = data.get("body")
-
-                            if not recipient or not subject or not body:
-                                raise ValueError(f"Missing required email field in message: {data}")
-
-                            await send_email(
-                                recipient=recipient,
-                                subject=subject,
-                                body=body
-                            )
-
-                            email_status_store[request_id] = "delivered"
-                            logger.info({"status": "email_delivered", "request_id": request_id})
-
-                        except Exception as e:
-                            request_id = str(data.get("request_id") or data.get("to") or "unknown")
-                            email_status_store[request_id] = "failed"
-                            logger.error({"status": "email_failed", "error": str(e), "request_id": request_id})
-
-                            try:
-                                await channel.default_exchange.publish(
-                                    aio_pika.Message(
-                                        body=message.body,
-                                        delivery_mode=aio_pika.DeliveryMode.PERSISTENT,
-                                    ),
-                                    routing_key=settings.dead_letter_queue_name
-                                )
-                                logger.info({"status": "sent_to_dlq", "request_id": request_id})
-                            except Exception as dlq_error:
-                                logger.error({"status": "dlq_failed", "error": str(dlq_error), "request_id": request_id})
-
-                        await asyncio.sleep(0.01)
+
+            tasks = [
+                asyncio.create_task(autoscaler.active_autoscaler.run()),
+                *(asyncio.create_task(consume_queue(queue, pool)) for queue in assigned),
+            ]
+            stopped = asyncio.create_task((stop or asyncio.Event()).wait())
+            try:
+                await asyncio.wait([*tasks, stopped], return_when=asyncio.FIRST_COMPLETED)
+                # No new deliveries: leaving queue.iterator() sends basic.cancel
+                for task in tasks:
+                    task.cancel()
+                await asyncio.gather(*tasks, return_exceptions=True)
+                if stopped.done():
+                    logger.info({"status": "consumer_draining", "in_flight": pool.in_flight, "timeout": settings.drain_timeout})
+                    result = await pool.drain(settings.drain_timeout)
+                    logger.info({"status": "consumer_drained", **result})
+                else:
+                    for task in tasks:
+                        if not task.cancelled() and task.exception():
+                            raise task.exception()
+            finally:
+                stopped.cancel()
+                for task in tasks:
+                    task.cancel()
+                await pool.stop()
+                autoscaler.active_autoscaler = None
+                if status_events:
+                    status_bus.detach()
 
     except asyncio.CancelledError:
         logger.info("Consumer cancelled gracefully")
@@ -1,65 +1,219 @@
 import asyncio
 import aio_pika
 import json
+import time
+from datetime import datetime, timezone
 from app.config import settings
+from app.services.batch_publisher import BatchPublisher
+from app.services.claim_check import claim_check, retain_content
+from app.services.sharding import declare_email_queues, get_exchange, route, shard_queue_names
+from app.services.tenants import DEFAULT_TENANT, TENANT_HEADER, declare_tenant_queues, tenant_config, tenant_queue_name
 from app.utils.logger import get_logger
+from app.utils.profiling import stage_timer
+from app.utils import tracing
 
 logger = get_logger("queue_publisher")
 
+# Persistent publisher connection shared by the API, the outbox relay and scripts
+_connection: aio_pika.abc.AbstractRobustConnection | None = None
+_channel: aio_pika.abc.AbstractChannel | None = None
+_channel_lock = asyncio.Lock()
+# Side channel for passive declares: a failed one closes its channel, never the publishing one
+_stats_channel: aio_pika.abc.AbstractChannel | None = None
 
-async def publish_email(
+
+async def get_channel() -> aio_pika.abc.AbstractChannel:
+    global _connection, _channel
+    async with _channel_lock:
+        if _channel is None or _channel.is_closed:
+            if _connection is None or _connection.is_closed:
+                rabbitmq_url = settings.queue_host
+                logger.info(f"🔍 Connecting to RabbitMQ at: {rabbitmq_url}")
+                _connection = await aio_pika.connect_robust(rabbitmq_url)
+            _channel = await _connection.channel()
+            # Ensure DLQ, the email shard queues and the dedicated tenant queues exist
+            await declare_email_queues(_channel)
+            await declare_tenant_queues(_channel)
+    return _channel
+
+
+async def queue_depths() -> dict[str, int]:
+    """Ready messages in every email shard and tenant queue."""
+    global _stats_channel
+    await get_channel()
+    if _stats_channel is None or _stats_channel.is_closed:
+        _stats_channel = await _connection.channel()
+    names = shard_queue_names() + [name for name in map(tenant_queue_name, tenant_config()) if name]
+    depths = {}
+    for name in names:
+        queue = await _stats_channel.declare_queue(name, passive=True)
+        depths[name] = queue.declaration_result.message_count or 0
+    return depths
+
+
+async def open_channel() -> aio_pika.abc.AbstractChannel:
+    """A new channel on the publisher connection, for consumers the API runs itself."""
+    await get_channel()
+    return await _connection.channel()
+
+
+async def close_publisher() -> None:
+    global _connection, _channel, _stats_channel
+    await batch_publisher.flush()
+    if _connection and not _connection.is_closed:
+        await _connection.close()
+    _connection = None
+    _channel = None
+    _stats_channel = None
+
+
+def build_message(
     to: str,
     subject: str,
     body: str,
     request_id: str | None = None,
     priority: int = 1,
-):
+    attachments: list[str] | None = None,
+    tenant: str | None = None,
+    meta: dict | None = None,
+    expires_at: datetime | None = None,
+) -> dict:
+    message = {
+        "to": to,
+        "subject": subject,
+        "body": body,
+        "request_id": request_id,
+        "priority": priority,
+    }
+    if attachments:
+        # Content-store ids only; the bytes never travel through the broker
+        message["attachments"] = attachments
+    if tenant and tenant != DEFAULT_TENANT:
+        message["tenant"] = tenant
+    if meta:
+        message["meta"] = meta
+    if expires_at:
+        # Delivery deadline (UTC, ISO 8601): after it the consumer sheds the message unsent
+        message["expires_at"] = expires_at.astimezone(timezone.utc).isoformat()
+    trace = tracing.current()
+    if trace is not None and trace.span_id is not None:
+        # Carried in the body too, so the context survives the outbox and the scheduler
+        message["traceparent"] = trace.traceparent
+    return message
+
+
+def message_expires_at(message: dict) -> datetime | None:
+    value = message.get("expires_at")
+    if not value:
+        return None
     try:
-        rabbitmq_url = settings.queue_host
-        logger.info(f"🔍 Connecting to RabbitMQ at: {rabbitmq_url}")
+        expires_at = datetime.fromisoformat(str(value))
+    except ValueError:
+        return None
+    return expires_at if expires_at.tzinfo else expires_at.replace(tzinfo=timezone.utc)
 
-        connection = await aio_pika.connect_robust(rabbitmq_url)
-        async with connection:
-            channel = await connection.channel()
 
-            # Ensure DLQ exists first
-            await channel.declare_queue(settings.dead_letter_queue_name, durable=True)
+def is_expired(message: dict, now: datetime | None = None) -> bool:
+    expires_at = message_expires_at(message)
+    return expires_at is not None and expires_at <= (now or datetime.now(timezone.utc))
 
-            # Declare main queue with DLX
-            await channel.declare_queue(
-                settings.email_queue_name,
-                durable=True,
-                arguments={"x-dead-letter-exchange": settings.dead_letter_queue_name},
-            )
 
-            message_body = json.dumps(
-                {
-                    "to": to,
-                    "subject": subject,
-                    "body": body,
-                    "request_id": request_id,
-                    "priority": priority,
-                }
-            ).encode()
-
-            await channel.default_exchange.publish(
+def message_headers(message: dict, published_at: int) -> dict | None:
+    """AMQP headers: tenant, correlation id and the trace context with the publish time (epoch ms)."""
+    headers = {}
+    if message.get("tenant"):
+        headers[TENANT_HEADER] = message["tenant"]
+    if message.get("request_id"):
+        headers["x-correlation-id"] = str(message["request_id"])
+    if message.get("traceparent"):
+        headers[tracing.TRACEPARENT_HEADER] = message["traceparent"]
+        headers[tracing.PUBLISHED_AT_HEADER] = published_at
+    return headers or None
+
+
+async def publish_batch(messages: list[dict]) -> list[str | Exception]:
+    """Publish messages pipelined on one channel and wait for all confirms.
+
+    Returns the routing key, or the exception, for each message in order.
+    """
+    channel = await get_channel()
+    exchanges: dict[str, aio_pika.abc.AbstractExchange] = {}
+    publishes = []
+    routing_keys = []
+
+    now = datetime.now(timezone.utc)
+    published_at = int(time.time() * 1000)
+
+    for message in messages:
+        tenant = message.get("tenant")
+        tenant_queue = tenant_queue_name(tenant) if tenant else None
+        if tenant_queue:
+            # Dedicated tenant queue: consumers dispatch it by weight, not FIFO behind others
+            exchange_name, routing_key = "", tenant_queue
+        else:
+            exchange_name, routing_key = route(message.get("to"), message.get("request_id"))
+        if exchange_name not in exchanges:
+            exchanges[exchange_name] = await get_exchange(channel, exchange_name)
+        routing_keys.append(routing_key)
+        publishes.append(
+            exchanges[exchange_name].publish(
                 aio_pika.Message(
-                    body=message_body,
+                    body=json.dumps(message).encode(),
                     delivery_mode=aio_pika.DeliveryMode.PERSISTENT,
+                    headers=message_headers(message, published_at),
+                    timestamp=now,
+                    # No per-message TTL: an expired message must reach the consumer to be recorded as expired
                 ),
-                routing_key=settings.email_queue_name,
+                routing_key=routing_key,
             )
+        )
 
-            logger.info(
-                {
-                    "status": "message_published",
-                    "queue": settings.email_queue_name,
-                    "to": to,
-                    "subject": subject,
-                    "request_id": request_id,
-                }
-            )
-            print(f"✅ Message published successfully to {settings.email_queue_name}")
+    with stage_timer("publish.confirm_batch"):
+        confirms = await asyncio.gather(*publishes, return_exceptions=True)
+    return [
+        confirm if isinstance(confirm, Exception) else routing_key
+        for confirm, routing_key in zip(confirms, routing_keys)
+    ]
+
+
+batch_publisher = BatchPublisher(
+    publish_batch,
+    linger_ms=settings.publish_linger_ms,
+    max_batch=settings.publish_batch_size,
+)
+
+
+async def publish_message(message: dict) -> str:
+    """Publish an already built message to its shard; returns the routing key."""
+    with stage_timer("publish.enqueue"), tracing.span("publish"):
+        return await batch_publisher.submit(message)
+
+
+async def publish_email(
+    to: str,
+    subject: str,
+    body: str,
+    request_id: str | None = None,
+    priority: int = 1,
+    attachments: list[str] | None = None,
+):
+    try:
+        with stage_timer("publish.build"):
+            message = build_message(to, subject, body, request_id, priority, attachments)
+        message = await claim_check(message)
+        await retain_content(message)
+        routing_key = await publish_message(message)
+
+        logger.info(
+            {
+                "status": "message_published",
+                "queue": routing_key,
+                "to": to,
+                "subject": subject,
+                "request_id": request_id,
+            }
+        )
+        print(f"✅ Message published successfully to {routing_key}")
 
     except Exception as e:
         error_msg = str(e)
@@ -83,5 +237,6 @@ if __name__ == "__main__":
             body="This is a test message from local script.",
             request_id="local-test-003",
         )
+        await close_publisher()
 
     asyncio.run(test_publish())
@@ -0,0 +1,174 @@
+import asyncio
+import time
+from app.config import settings
+from app.utils.logger import get_logger
+
+logger = get_logger("rate_limiter")
+
+# Token bucket refilled from the Redis server clock, so replicas with skewed
+# clocks still share one budget. Returns {granted, retry_after_ms}.
+TOKEN_BUCKET_LUA = """
+local rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local requested = tonumber(ARGV[3])
+local clock = redis.call("TIME")
+local now = clock[1] * 1000 + math.floor(clock[2] / 1000)
+local state = redis.call("HMGET", KEYS[1], "tokens", "ts")
+local tokens = tonumber(state[1]) or burst
+local ts = tonumber(state[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - ts) * rate / 1000)
+local granted = math.min(requested, math.floor(tokens))
+tokens = tokens - granted
+redis.call("HSET", KEYS[1], "tokens", tokens, "ts", now)
+redis.call("PEXPIRE", KEYS[1], math.ceil(burst * 1000 / rate) + 1000)
+local wait = 0
+if granted == 0 then
+  -- come back when a whole lease has refilled instead of polling per token
+  wait = math.ceil((math.min(requested, burst) - tokens) * 1000 / rate)
+end
+return {granted, wait}
+"""
+
+
+class TokenBucket:
+    """Process-local token bucket."""
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def try_acquire(self, tokens: float = 1) -> float:
+        """Take tokens if available; otherwise return seconds until they are."""
+        self._refill()
+        if self.tokens >= tokens:
+            self.tokens -= tokens
+            return 0.0
+        return (tokens - self.tokens) / self.rate
+
+    async def acquire(self, tokens: float = 1) -> None:
+        # More than a burst can never be available at once: charge it burst by burst
+        while tokens > 0:
+            chunk = min(tokens, self.burst)
+            while (wait := self.try_acquire(chunk)) > 0:
+                await asyncio.sleep(wait)
+            tokens -= chunk
+
+
+class DistributedRateLimiter:
+    """Global sends-per-second budget shared by every replica through Redis.
+
+    Tokens are leased from Redis `lease` at a time and spent locally, so only
+    one round trip is made per lease. Unused leased tokens expire after
+    lease_ttl seconds. While Redis is unreachable each process falls back to
+    its share of the budget (rate / fallback_replicas) and retries Redis after
+    retry_after seconds.
+    """
+
+    def __init__(
+        self,
+        rate: float,
+        burst: float,
+        lease: int,
+        key: str,
+        fallback_replicas: int = 1,
+        client=None,
+        lease_ttl: float = 1.0,
+        retry_after: float = 5.0,
+    ):
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self.lease = max(1, lease)
+        self.key = key
+        self.lease_ttl = lease_ttl
+        self.retry_after = retry_after
+        self.fallback = TokenBucket(rate / max(1, fallback_replicas), self.burst / max(1, fallback_replicas))
+
+        self._client = client
+        self._script = None
+        self._local_tokens = 0
+        self._leased_at = 0.0
+        self._lock = asyncio.Lock()
+        self._redis_down_until = 0.0
+
+        self.acquired = 0
+        self.round_trips = 0
+        self.fallback_acquired = 0
+        self.redis_errors = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.rate > 0
+
+    def _get_script(self):
+        if self._script is None:
+            if self._client is None:
+                import redis.asyncio as redis
+
+                self._client = redis.from_url(settings.redis_url)
+            self._script = self._client.register_script(TOKEN_BUCKET_LUA)
+        return self._script
+
+    def _take_local(self) -> bool:
+        if self._local_tokens and time.monotonic() - self._leased_at <= self.lease_ttl:
+            self._local_tokens -= 1
+            return True
+        self._local_tokens = 0
+        return False
+
+    async def acquire(self) -> None:
+        if not self.enabled:
+            return
+        while True:
+            if self._take_local():
+                self.acquired += 1
+                return
+
+            if not (self._client or settings.redis_url) or time.monotonic() < self._redis_down_until:
+                await self.fallback.acquire()
+                self.fallback_acquired += 1
+                self.acquired += 1
+                return
+
+            async with self._lock:
+                if self._local_tokens:
+                    continue
+                try:
+                    self.round_trips += 1
+                    granted, wait_ms = await self._get_script()(keys=[self.key], args=[self.rate, self.burst, self.lease])
+                except Exception as e:
+                    self.redis_errors += 1
+                    self._redis_down_until = time.monotonic() + self.retry_after
+                    logger.warning({"status": "rate_limiter_fallback", "error": str(e)})
+                    continue
+                if int(granted):
+                    self._local_tokens = int(granted)
+                    self._leased_at = time.monotonic()
+                    continue
+            await asyncio.sleep(int(wait_ms) / 1000)
+
+    def stats(self) -> dict:
+        return {
+            "enabled": self.enabled,
+            "rate": self.rate,
+            "acquired": self.acquired,
+            "redis_round_trips": self.round_trips,
+            "fallback_acquired": self.fallback_acquired,
+            "redis_errors": self.redis_errors,
+            "degraded": time.monotonic() < self._redis_down_until,
+        }
+
+
+send_rate_limiter = DistributedRateLimiter(
+    rate=settings.send_rate_limit,
+    burst=settings.send_rate_burst or settings.send_rate_limit,
+    lease=settings.send_rate_lease,
+    key=settings.send_rate_key,
+    fallback_replicas=settings.send_rate_fallback_replicas,
+)
@@ -0,0 +1,178 @@
+import json
+import random
+import time
+from app.config import settings
+from app.services.circuit_breaker import CircuitBreaker
+from app.services.concurrency import AdaptiveConcurrencyLimiter, is_temporary_rejection
+from app.services.rate_limiter import TokenBucket
+from app.utils.logger import get_logger
+
+logger = get_logger("relay_router")
+
+# Latency smoothing and the floor that keeps a brand-new relay from looking infinitely fast
+EWMA_ALPHA = 0.2
+MIN_LATENCY = 0.05
+
+
+class Relay:
+    """One SMTP relay with its own credentials, circuit breaker and limits."""
+
+    def __init__(
+        self,
+        name: str,
+        host: str,
+        port: int,
+        user: str = "",
+        password: str = "",
+        use_tls: bool = True,
+        start_tls: bool = False,
+        weight: float = 1.0,
+        max_concurrency: int | None = None,
+        rate: float = 0,
+        timeout: float = 10,
+    ):
+        self.name = name
+        self.host = host
+        self.port = port
+        self.user = user
+        self.password = password
+        self.use_tls = use_tls
+        self.start_tls = start_tls
+        self.weight = max(weight, 0.0)
+        self.timeout = timeout
+        self.circuit = CircuitBreaker(failure_threshold=3, recovery_time=20)  # 3 failures open circuit for 20 sec
+        self.concurrency = AdaptiveConcurrencyLimiter(
+            initial=settings.smtp_concurrency_initial,
+            min_limit=settings.smtp_concurrency_min,
+            max_limit=max_concurrency or settings.smtp_concurrency_max,
+            tolerance=settings.smtp_concurrency_tolerance,
+            backoff=settings.smtp_concurrency_backoff,
+        )
+        self.bucket = TokenBucket(rate, max(rate, 1)) if rate > 0 else None
+
+        self.latency: float | None = None
+        self.sent = 0
+        self.errors = 0
+        self.temporary_rejections = 0
+
+    def healthy(self) -> bool:
+        """Side-effect free version of circuit.allow_request()."""
+        circuit = self.circuit
+        return circuit.state != "OPEN" or time.time() - circuit.last_failure_time > circuit.recovery_time
+
+    def record_success(self, elapsed: float) -> None:
+        self.sent += 1
+        self.circuit.record_success()
+        self.latency = elapsed if self.latency is None else (1 - EWMA_ALPHA) * self.latency + EWMA_ALPHA * elapsed
+
+    def record_failure(self, error: BaseException) -> None:
+        if is_temporary_rejection(error):
+            # Throttled, not broken: make it less attractive without opening the circuit
+            self.temporary_rejections += 1
+            if self.latency is not None:
+                self.latency *= 2
+        else:
+            self.errors += 1
+            self.circuit.record_failure()
+
+    def stats(self) -> dict:
+        return {
+            "host": self.host,
+            "weight": self.weight,
+            "circuit": self.circuit.state,
+            "latency_ms": round(self.latency * 1000, 1) if self.latency is not None else None,
+            "sent": self.sent,
+            "errors": self.errors,
+            "temporary_rejections": self.temporary_rejections,
+            "concurrency": self.concurrency.stats(),
+        }
+
+
+def load_relays(raw: str | None = None) -> list[Relay]:
+    """SMTP_RELAYS is a JSON list of relay objects; without it the single SMTP_* relay is used."""
+    raw = settings.smtp_relays if raw is None else raw
+    if raw:
+        entries = json.loads(raw)
+        return [
+            Relay(
+                name=entry.get("name") or entry["host"],
+                host=entry["host"],
+                port=int(entry.get("port", 465)),
+                user=entry.get("user", ""),
+                password=entry.get("password", ""),
+                use_tls=entry.get("use_tls", True),
+                start_tls=entry.get("start_tls", False),
+                weight=float(entry.get("weight", 1)),
+                max_concurrency=entry.get("max_concurrency"),
+                rate=float(entry.get("rate", 0)),
+                timeout=float(entry.get("timeout", 10)),
+            )
+            for entry in entries
+        ]
+    return [
+        Relay(
+            name="default",
+            host=settings.smtp_host,
+            port=settings.smtp_port,
+            user=settings.smtp_user,
+            password=settings.smtp_pass,
+            use_tls=settings.use_ssl,
+        )
+    ]
+
+
+class RelayRouter:
+    """Picks a relay per transaction by weight, recent latency and health.
+
+    The effective weight of a relay is its configured weight scaled by how
+    fast it is relative to the fastest relay (EWMA of transaction time) and by
+    its free concurrency. Relays with an open circuit are skipped until the
+    breaker's recovery time has passed. failover_order() yields the remaining
+    relays one by one, so a failed transaction moves to the next relay in the
+    same attempt instead of going back to the queue.
+    """
+
+    def __init__(self, relays: list[Relay]):
+        if not relays:
+            raise ValueError("At least one SMTP relay is required")
+        self.relays = relays
+        self.failovers = 0
+
+    def effective_weight(self, relay: Relay, fastest: float) -> float:
+        speed = fastest / max(relay.latency, MIN_LATENCY) if relay.latency is not None else 1.0
+        limiter = relay.concurrency
+        headroom = max(0.1, 1 - limiter.in_flight / max(1, int(limiter.limit)))
+        return relay.weight * speed * headroom
+
+    def pick(self, exclude: set[str] = frozenset()) -> Relay | None:
+        candidates = [r for r in self.relays if r.name not in exclude and r.weight > 0 and r.healthy()]
+        if not candidates:
+            return None
+        if len(candidates) == 1:
+            return candidates[0]
+        latencies = [max(r.latency, MIN_LATENCY) for r in candidates if r.latency is not None]
+        fastest = min(latencies) if latencies else MIN_LATENCY
+        weights = [self.effective_weight(r, fastest) for r in candidates]
+        return random.choices(candidates, weights=weights)[0]
+
+    def failover_order(self):
+        tried: set[str] = set()
+        while (relay := self.pick(tried)) is not None:
+            if tried:
+                self.failovers += 1
+            tried.add(relay.name)
+            # Let the breaker move OPEN -> HALF-OPEN for the probe
+            relay.circuit.allow_request()
+            yield relay
+
+    def available(self) -> bool:
+        return any(r.weight > 0 and r.healthy() for r in self.relays)
+
+    def stats(self) -> dict:
+        return {
+            "failovers": self.failovers,
+            "relays": {relay.name: relay.stats() for relay in self.relays},
+        }
+
+
+relay_router = RelayRouter(load_relays())
@@ -0,0 +1,133 @@
+import asyncio
+import email.policy
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from email.header import Header
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+from email.utils import formatdate, make_msgid
+from typing import Any, Callable
+from app.config import settings
+from app.services.batch_publisher import BatchPublisher
+from app.services.dkim import get_signer
+from app.utils.logger import get_logger
+
+logger = get_logger("render_pool")
+
+
+def render_message(spec: dict) -> bytes:
+    """Serialize a text/html message with CRLF line endings, DKIM-signed when configured.
+
+    spec: {"from", "to", "subject", "body", "html"}. The bytes are sent as-is,
+    so the signature covers exactly what goes over the wire.
+    """
+    msg = MIMEMultipart("alternative")
+    msg["From"] = spec["from"]
+    msg["To"] = spec["to"]
+    subject = spec["subject"]
+    msg["Subject"] = subject if subject.isascii() else Header(subject, "utf-8").encode()
+    msg["Date"] = formatdate(localtime=False)
+    msg["Message-ID"] = make_msgid(domain=spec["from"].rpartition("@")[2] or None)
+    msg.attach(MIMEText(spec["body"], "html" if spec.get("html") else "plain"))
+    data = msg.as_bytes(policy=email.policy.SMTP)
+    signer = get_signer()
+    return signer.sign(data) if signer else data
+
+
+def _each(fn: Callable[[Any], bytes], items: list) -> list[bytes | Exception]:
+    results: list[bytes | Exception] = []
+    for item in items:
+        try:
+            results.append(fn(item))
+        except Exception as e:
+            results.append(e)
+    return results
+
+
+def render_batch(specs: list[dict]) -> list[bytes | Exception]:
+    return _each(render_message, specs)
+
+
+def sign_batch(items: list[tuple[bytes, str]]) -> list[bytes | Exception]:
+    signer = get_signer()
+    return _each(lambda item: signer.signature(*item), items)
+
+
+def _init_process() -> None:
+    # Parse the key once per pool process, not per message
+    get_signer()
+
+
+class RenderPool:
+    """MIME serialization and DKIM signing in a process pool.
+
+    RSA signing and serializing large HTML bodies are CPU-bound and would
+    stall the event loop. With processes > 0, jobs are coalesced by a
+    BatchPublisher (batch_size, linger_ms) and each batch costs one
+    round trip to a worker process. processes = 0 keeps the work inline.
+    """
+
+    def __init__(self, processes: int, batch_size: int, linger_ms: float):
+        self.processes = max(0, processes)
+        self._executor: ProcessPoolExecutor | None = None
+        self._render = BatchPublisher(self._run_batch(render_batch), linger_ms, batch_size)
+        self._sign = BatchPublisher(self._run_batch(sign_batch), linger_ms, batch_size)
+        self.pool_restarts = 0
+
+    @property
+    def signing(self) -> bool:
+        return get_signer() is not None
+
+    @property
+    def executor(self) -> ProcessPoolExecutor:
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.processes,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=_init_process,
+            )
+        return self._executor
+
+    def _run_batch(self, fn: Callable[[list], list]):
+        async def run(items: list) -> list:
+            try:
+                return await asyncio.get_running_loop().run_in_executor(self.executor, fn, items)
+            except BrokenProcessPool:
+                # A worker died; the next batch starts a fresh pool
+                logger.error({"status": "render_pool_broken", "batch": len(items)})
+                self._executor = None
+                self.pool_restarts += 1
+                raise
+        return run
+
+    async def render(self, spec: dict) -> bytes:
+        if not self.processes:
+            return render_message(spec)
+        return await self._render.submit(spec)
+
+    async def signature(self, header_block: bytes, body_hash: str) -> bytes | None:
+        """DKIM-Signature header for a streamed message, or None when DKIM is off."""
+        signer = get_signer()
+        if signer is None:
+            return None
+        if not self.processes:
+            return signer.signature(header_block, body_hash)
+        return await self._sign.submit((header_block, body_hash))
+
+    def close(self) -> None:
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+    def stats(self) -> dict:
+        return {
+            "processes": self.processes,
+            "dkim": self.signing,
+            "render": self._render.stats(),
+            "sign": self._sign.stats(),
+            "pool_restarts": self.pool_restarts,
+        }
+
+
+render_pool = RenderPool(settings.render_processes, settings.render_batch_size, settings.render_linger_ms)
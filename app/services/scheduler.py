@@ -0,0 +1,301 @@
+import asyncio
+import heapq
+import os
+import socket
+import time
+from datetime import datetime, timedelta, timezone
+from typing import Awaitable, Callable
+from sqlalchemy import delete, func, or_, select, update
+from sqlalchemy.ext.asyncio import async_sessionmaker
+from app.config import settings
+from app.models import ScheduledEmail, utcnow
+from app.services.rate_limiter import TokenBucket
+from app.utils.logger import get_logger
+
+logger = get_logger("scheduler")
+
+PublishBatch = Callable[[list[dict]], Awaitable[list]]
+
+RETRY_DELAY = 5.0
+
+
+def as_utc(value: datetime) -> datetime:
+    """Naive datetimes (and SQLite, which drops the offset) are taken as UTC."""
+    if value.tzinfo is None:
+        return value.replace(tzinfo=timezone.utc)
+    return value.astimezone(timezone.utc)
+
+
+class EmailScheduler:
+    """Holds future sends in the database and releases them when due.
+
+    Only the near horizon (the next `horizon` seconds) lives in memory, in a
+    min-heap keyed by send_at. Every `load_interval` the scheduler claims the
+    rows entering that window with one indexed range query on send_at, so the
+    cost per tick depends on what is about to be due, not on how many sends
+    are scheduled in total. Claims carry a lease that is renewed while rows
+    sit in the heap; rows of a crashed replica become claimable once their
+    lease lapses, and a node restarted under the same node_id releases its
+    old claims on start so they are picked up immediately. The node_id ends
+    in the process id, so sibling processes on one host (API_WORKERS) never
+    renew or release each other's claims.
+
+    Due messages go through a token bucket into email.queue, so a large
+    batch scheduled for 09:00 leaves at `release_rate` per second instead of
+    as one burst. Rows are deleted only after the broker confirmed them.
+    """
+
+    def __init__(
+        self,
+        session_factory: async_sessionmaker | None = None,
+        publish: PublishBatch | None = None,
+        node_id: str | None = None,
+        horizon: float | None = None,
+        load_interval: float | None = None,
+        load_batch: int | None = None,
+        max_in_memory: int | None = None,
+        lease: float | None = None,
+        release_rate: float | None = None,
+        release_burst: float | None = None,
+    ):
+        self._session_factory = session_factory
+        self._publish = publish
+        self.node_id = node_id or f"{settings.scheduler_node_id or socket.gethostname()}-{os.getpid()}"
+        self.horizon = settings.scheduler_horizon if horizon is None else horizon
+        self.load_interval = settings.scheduler_load_interval if load_interval is None else load_interval
+        self.load_batch = load_batch or settings.scheduler_load_batch
+        self.max_in_memory = max_in_memory or settings.scheduler_max_in_memory
+        self.lease = settings.scheduler_lease if lease is None else lease
+        rate = settings.scheduler_release_rate if release_rate is None else release_rate
+        burst = settings.scheduler_release_burst if release_burst is None else release_burst
+        self.bucket = TokenBucket(rate, burst) if rate > 0 else None
+
+        self.heap: list[tuple[float, int, dict]] = []
+        self.running = False
+        self._task: asyncio.Task | None = None
+        self._wakeup = asyncio.Event()
+        self.scheduled = 0
+        self.released = 0
+        self.publish_errors = 0
+
+    @property
+    def session_factory(self) -> async_sessionmaker:
+        if self._session_factory is None:
+            from app.db import AsyncSessionLocal
+            self._session_factory = AsyncSessionLocal
+        return self._session_factory
+
+    def session(self):
+        """A session_scope on session_factory, so pool waits show up in the DB stats."""
+        from app.db import session_scope
+        return session_scope(self.session_factory)
+
+    async def publish(self, messages: list[dict]) -> list:
+        if self._publish is None:
+            from app.services.queue_publisher import publish_batch
+            self._publish = publish_batch
+        return await self._publish(messages)
+
+    def _lease_until(self) -> datetime:
+        return utcnow() + timedelta(seconds=self.lease)
+
+    async def create_schema(self) -> None:
+        async with self.session() as session:
+            conn = await session.connection()
+            await conn.run_sync(ScheduledEmail.__table__.create, checkfirst=True)
+            await session.commit()
+
+    # Writes
+
+    async def schedule(self, message: dict, send_at: datetime) -> int:
+        """Persist a message for later; returns the schedule id."""
+        send_at = as_utc(send_at)
+        # Claim directly when it falls inside our horizon: no extra load round trip
+        claim = (
+            self.running
+            and send_at.timestamp() <= time.time() + self.horizon
+            and len(self.heap) < self.max_in_memory
+        )
+        row = ScheduledEmail(
+            request_id=message.get("request_id"),
+            send_at=send_at,
+            payload=message,
+            claimed_by=self.node_id if claim else None,
+            lease_until=self._lease_until() if claim else None,
+        )
+        async with self.session() as session:
+            session.add(row)
+            await session.commit()
+        self.scheduled += 1
+        if claim:
+            self._push(send_at.timestamp(), row.id, message)
+        return row.id
+
+    def _push(self, due: float, row_id: int, message: dict) -> None:
+        earliest = self.heap[0][0] if self.heap else None
+        heapq.heappush(self.heap, (due, row_id, message))
+        if earliest is None or due < earliest:
+            self._wakeup.set()
+
+    # Near-horizon loading
+
+    async def load(self) -> int:
+        """Claim rows due within the horizon into the heap; returns rows loaded."""
+        room = min(self.load_batch, self.max_in_memory - len(self.heap))
+        if room <= 0:
+            return 0
+        now = utcnow()
+        claimable = or_(ScheduledEmail.lease_until.is_(None), ScheduledEmail.lease_until < now)
+
+        async with self.session() as session:
+            rows = (await session.execute(
+                select(ScheduledEmail.id, ScheduledEmail.send_at, ScheduledEmail.payload)
+                .where(ScheduledEmail.send_at <= now + timedelta(seconds=self.horizon), claimable)
+                .order_by(ScheduledEmail.send_at, ScheduledEmail.id)
+                .limit(room)
+                .with_for_update(skip_locked=True)
+            )).all()
+            if rows:
+                await session.execute(
+                    update(ScheduledEmail)
+                    .where(ScheduledEmail.id.in_([row.id for row in rows]))
+                    .values(claimed_by=self.node_id, lease_until=self._lease_until())
+                )
+            await session.commit()
+
+        for row in rows:
+            self._push(as_utc(row.send_at).timestamp(), row.id, row.payload)
+        if rows:
+            logger.info({"status": "schedule_loaded", "rows": len(rows), "in_memory": len(self.heap)})
+        return len(rows)
+
+    async def renew_leases(self) -> None:
+        if not self.heap:
+            return
+        async with self.session() as session:
+            await session.execute(
+                update(ScheduledEmail)
+                .where(ScheduledEmail.claimed_by == self.node_id)
+                .values(lease_until=self._lease_until())
+            )
+            await session.commit()
+
+    # Release
+
+    async def release_due(self) -> int:
+        """Publish one batch of due messages; returns how many were released."""
+        if not self.heap or self.heap[0][0] > time.time():
+            return 0
+        limit = self.load_batch if self.bucket is None else max(1, int(self.bucket.burst))
+        batch = []
+        while self.heap and self.heap[0][0] <= time.time() and len(batch) < limit:
+            batch.append(heapq.heappop(self.heap))
+        if self.bucket is not None:
+            await self.bucket.acquire(len(batch))
+
+        try:
+            results = await self.publish([message for _, _, message in batch])
+        except Exception as e:
+            results = [e] * len(batch)
+
+        published = []
+        for item, result in zip(batch, results):
+            if isinstance(result, Exception):
+                self.publish_errors += 1
+                self._push(time.time() + RETRY_DELAY, item[1], item[2])
+                logger.error({"status": "scheduled_publish_failed", "schedule_id": item[1], "error": str(result)})
+            else:
+                published.append(item[1])
+
+        if published:
+            async with self.session() as session:
+                await session.execute(delete(ScheduledEmail).where(ScheduledEmail.id.in_(published)))
+                await session.commit()
+            self.released += len(published)
+        return len(published)
+
+    async def release_own_claims(self) -> int:
+        """After a restart our claims are no longer in memory; hand them back."""
+        async with self.session() as session:
+            result = await session.execute(
+                update(ScheduledEmail)
+                .where(ScheduledEmail.claimed_by == self.node_id)
+                .values(claimed_by=None, lease_until=None)
+            )
+            await session.commit()
+        return result.rowcount or 0
+
+    async def _run(self) -> None:
+        next_load = 0.0
+        while self.running:
+            self._wakeup.clear()
+            try:
+                if time.monotonic() >= next_load:
+                    await self.load()
+                    await self.renew_leases()
+                    next_load = time.monotonic() + self.load_interval
+                if await self.release_due():
+                    continue
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error({"status": "scheduler_error", "error": str(e)})
+                next_load = time.monotonic() + self.load_interval
+
+            timeout = max(0.0, next_load - time.monotonic())
+            if self.heap:
+                timeout = min(timeout, max(0.0, self.heap[0][0] - time.time()))
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    async def start(self) -> None:
+        await self.create_schema()
+        reclaimed = await self.release_own_claims()
+        if reclaimed:
+            logger.info({"status": "schedule_recovered", "rows": reclaimed})
+        self.running = True
+        self._task = asyncio.create_task(self._run())
+        logger.info({"status": "scheduler_started", "node_id": self.node_id, "horizon": self.horizon})
+
+    async def stop(self, timeout: float = 10) -> None:
+        """Let a release in progress finish, then hand the claimed rows back.
+
+        Cancelling between publish and delete would publish that batch again
+        from another node once our lease expires.
+        """
+        was_running, self.running = self.running, False
+        if self._task:
+            self._wakeup.set()
+            try:
+                await asyncio.wait_for(self._task, timeout)
+            except (asyncio.CancelledError, asyncio.TimeoutError):
+                pass
+            self._task = None
+        if was_running and self.heap:
+            # Another node can pick them up now instead of after the lease
+            self.heap.clear()
+            try:
+                released = await self.release_own_claims()
+                logger.info({"status": "schedule_handed_back", "rows": released})
+            except Exception as e:
+                logger.warning({"status": "schedule_hand_back_failed", "error": str(e)})
+
+    async def pending(self) -> int:
+        async with self.session() as session:
+            return (await session.execute(select(func.count()).select_from(ScheduledEmail))).scalar_one()
+
+    def stats(self) -> dict:
+        return {
+            "enabled": self.running,
+            "node_id": self.node_id,
+            "in_memory": len(self.heap),
+            "next_due_in": round(self.heap[0][0] - time.time(), 3) if self.heap else None,
+            "scheduled": self.scheduled,
+            "released": self.released,
+            "publish_errors": self.publish_errors,
+        }
+
+
+scheduler = EmailScheduler()
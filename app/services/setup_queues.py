@@ -1,11 +1,91 @@
 import asyncio
+import json
+import sys
 import aio_pika
 from app.config import settings
+from app.services.sharding import declare_email_queues, get_exchange, route, shard_count, shard_queue_names
 from app.utils.logger import get_logger
 
 logger = get_logger("queue_setup")
 
-async def recreate_queue():
+def copy_message(message: aio_pika.abc.AbstractIncomingMessage) -> aio_pika.Message:
+    """The message as it was published: body and every AMQP property.
+
+    The timestamp carries the queue wait and the admission lag, message_id and
+    correlation_id the publisher's ids, expiration and priority the broker's
+    handling. user_id is left out: the broker rejects one that is not the
+    migrating connection's own user.
+    """
+    return aio_pika.Message(
+        body=message.body,
+        headers=message.headers,
+        content_type=message.content_type,
+        content_encoding=message.content_encoding,
+        delivery_mode=message.delivery_mode or aio_pika.DeliveryMode.PERSISTENT,
+        priority=message.priority,
+        correlation_id=message.correlation_id,
+        reply_to=message.reply_to,
+        expiration=message.expiration,
+        message_id=message.message_id,
+        timestamp=message.timestamp,
+        type=message.type,
+        app_id=message.app_id,
+    )
+
+async def migrate_shards(channel: aio_pika.abc.AbstractChannel, previous_count: int, new_count: int) -> int:
+    """Move every message from the previous shard layout onto the new ring.
+
+    Each old queue is drained in order up to the depth it had when migration
+    started, so all messages of one recipient land on their new shard in their
+    original order. Stop the consumers and every publisher (API processes,
+    outbox relays, schedulers) before resharding, and restart them with the new
+    EMAIL_QUEUE_SHARDS: one still routing on the old ring interleaves its
+    messages with the migrated ones. A shard queue that still has consumers
+    stops the migration; a retired queue that received messages meanwhile is
+    kept and reported, and running again moves them.
+    """
+    moved = 0
+    old_names = shard_queue_names(previous_count)
+    new_names = set(shard_queue_names(new_count))
+
+    for name in old_names:
+        queue = await channel.declare_queue(name, passive=True)
+        if queue.declaration_result.consumer_count:
+            raise RuntimeError(f"{name} still has {queue.declaration_result.consumer_count} consumer(s): stop them before resharding")
+
+    for name in old_names:
+        queue = await channel.declare_queue(name, passive=True)
+        pending = queue.declaration_result.message_count or 0
+        for _ in range(pending):
+            message = await queue.get(fail=False)
+            if message is None:
+                break
+            data = json.loads(message.body.decode())
+            exchange_name, routing_key = route(data.get("to"), data.get("request_id"), new_count)
+            exchange = await get_exchange(channel, exchange_name)
+            await exchange.publish(copy_message(message), routing_key=routing_key)
+            await message.ack()
+            moved += 1
+        logger.info(f"🔀 Drained {pending} messages from {name}")
+
+        if name not in new_names:
+            queue = await channel.declare_queue(name, passive=True)
+            late = queue.declaration_result.message_count or 0
+            if late:
+                logger.error(f"❌ {name} received {late} messages while migrating: a publisher still uses the old shard count")
+                continue
+            await channel.queue_delete(name, if_empty=True)
+            logger.info(f"🗑 Deleted retired shard queue: {name}")
+
+    return moved
+
+async def recreate_queue(previous_shard_count: int | None = None):
+    """Recreate the email queues for the configured shard count.
+
+    Without previous_shard_count the queues are deleted and declared fresh.
+    With it, the old layout is migrated onto the new ring without losing
+    messages (EMAIL_QUEUE_SHARDS holds the new count).
+    """
     rabbitmq_url = settings.queue_host
     logger.info(f"🔍 Connecting to RabbitMQ at: {rabbitmq_url}")
     connection = await aio_pika.connect_robust(rabbitmq_url)
@@ -13,29 +93,29 @@ async def recreate_queue():
     async with connection:
         channel = await connection.channel()
 
-        # Delete existing queue (if exists)
-        try:
-            await channel.queue_delete(settings.email_queue_name)
-            logger.info(f"🗑 Deleted existing queue: {settings.email_queue_name}")
-        except Exception as e:
-            logger.warning(f"Queue delete skipped: {e}")
-
-        # Declare dead-letter queue first
-        await channel.declare_queue(
-            settings.dead_letter_queue_name,
-            durable=True
-        )
-        logger.info(f"✅ Dead-letter queue ready: {settings.dead_letter_queue_name}")
+        if previous_shard_count is not None and previous_shard_count != shard_count():
+            await declare_email_queues(channel)
+            logger.info(f"✅ Declared {shard_count()} shard(s), migrating from {previous_shard_count}")
+            moved = await migrate_shards(channel, previous_shard_count, shard_count())
+            logger.info(f"✅ Resharding complete, {moved} messages moved")
+            return
+
+        # Delete existing queue(s) (if exists)
+        for name in shard_queue_names():
+            try:
+                await channel.queue_delete(name)
+                logger.info(f"🗑 Deleted existing queue: {name}")
+            except Exception as e:
+                logger.warning(f"Queue delete skipped: {e}")
 
-        # Recreate main queue with proper dead-letter exchange
-        await channel.declare_queue(
-            settings.email_queue_name,
-            durable=True,
-            arguments={"x-dead-letter-exchange": settings.dead_letter_queue_name}
-        )
-        logger.info(f"✅ Queue recreated with DLX: {settings.email_queue_name}")
+        # Declare dead-letter queue first, then the shard queue(s) with DLX
+        await declare_email_queues(channel)
+        logger.info(f"✅ Dead-letter queue ready: {settings.dead_letter_queue_name}")
+        logger.info(f"✅ Queue(s) recreated with DLX: {', '.join(shard_queue_names())}")
 
     logger.info("All queues are properly set up.")
 
 if __name__ == "__main__":
-    asyncio.run(recreate_queue())
+    # python -m app.services.setup_queues [previous_shard_count]
+    previous = int(sys.argv[1]) if len(sys.argv) > 1 else None
+    asyncio.run(recreate_queue(previous))
@@ -0,0 +1,142 @@
+import bisect
+import hashlib
+from functools import lru_cache
+import aio_pika
+from app.config import settings
+from app.utils.logger import get_logger
+
+logger = get_logger("sharding")
+
+VIRTUAL_NODES = 64
+
+
+def _hash(value: str) -> int:
+    return int.from_bytes(hashlib.blake2b(value.encode(), digest_size=8).digest(), "big")
+
+
+class HashRing:
+    """Consistent-hash ring mapping routing keys onto shard indexes.
+
+    Each shard owns VIRTUAL_NODES points on the ring, so growing from N to N+1
+    shards only moves roughly 1/(N+1) of the keys. The ring runs in the
+    publisher; the broker only sees a direct exchange keyed by shard queue
+    name (no consistent-hash exchange plugin is needed).
+    """
+
+    def __init__(self, shard_count: int, vnodes: int = VIRTUAL_NODES):
+        self.shard_count = max(1, shard_count)
+        points = sorted(
+            (_hash(f"shard-{shard}#{vnode}"), shard)
+            for shard in range(self.shard_count)
+            for vnode in range(vnodes)
+        )
+        self._points = [point for point, _ in points]
+        self._shards = [shard for _, shard in points]
+
+    def shard_for(self, key: str) -> int:
+        if self.shard_count == 1:
+            return 0
+        index = bisect.bisect(self._points, _hash(key)) % len(self._points)
+        return self._shards[index]
+
+
+@lru_cache(maxsize=8)
+def get_ring(shard_count: int) -> HashRing:
+    return HashRing(shard_count)
+
+
+def shard_count() -> int:
+    return max(1, settings.email_queue_shards)
+
+
+def shard_queue_name(index: int, count: int | None = None) -> str:
+    if (count or shard_count()) <= 1:
+        return settings.email_queue_name
+    return f"{settings.email_queue_name}.shard.{index}"
+
+
+def shard_queue_names(count: int | None = None) -> list[str]:
+    count = count or shard_count()
+    return [shard_queue_name(index, count) for index in range(count)]
+
+
+def shard_key(to: str | None, request_id: str | None) -> str:
+    """Key hashed onto the ring; recipient keeps per-recipient ordering."""
+    if settings.email_shard_key == "request_id" and request_id:
+        return request_id
+    return (to or request_id or "").strip().lower()
+
+
+def route(to: str | None, request_id: str | None, count: int | None = None) -> tuple[str, str]:
+    """Return (exchange_name, routing_key) for a message. "" is the default exchange."""
+    count = count or shard_count()
+    if count <= 1:
+        return "", settings.email_queue_name
+    index = get_ring(count).shard_for(shard_key(to, request_id))
+    return settings.email_shard_exchange, shard_queue_name(index, count)
+
+
+def assigned_shards(count: int | None = None) -> list[int]:
+    """Shards this process consumes: EMAIL_SHARD_IDS if set, otherwise all of them.
+
+    Shard queues are single-active-consumer, so when every worker subscribes to
+    every shard the broker hands each shard to exactly one live consumer and
+    fails it over automatically.
+    """
+    count = count or shard_count()
+    if settings.email_shard_ids:
+        ids = [int(part) for part in settings.email_shard_ids.split(",") if part.strip()]
+        return [index for index in ids if 0 <= index < count]
+    return list(range(count))
+
+
+async def get_exchange(channel: aio_pika.abc.AbstractChannel, exchange_name: str) -> aio_pika.abc.AbstractExchange:
+    if not exchange_name:
+        return channel.default_exchange
+    return await channel.declare_exchange(exchange_name, aio_pika.ExchangeType.DIRECT, durable=True)
+
+
+async def declare_dead_letter_queue(channel: aio_pika.abc.AbstractChannel) -> aio_pika.abc.AbstractQueue:
+    """The DLQ, bound to the fanout exchange that the email queues name as x-dead-letter-exchange.
+
+    Both use DEAD_LETTER_QUEUE_NAME (exchanges and queues have separate
+    namespaces). Without the exchange the broker drops what it dead-letters.
+    """
+    exchange = await channel.declare_exchange(settings.dead_letter_queue_name, aio_pika.ExchangeType.FANOUT, durable=True)
+    queue = await channel.declare_queue(settings.dead_letter_queue_name, durable=True)
+    await queue.bind(exchange)
+    return queue
+
+
+async def declare_email_queues(
+    channel: aio_pika.abc.AbstractChannel, count: int | None = None
+) -> list[aio_pika.abc.AbstractQueue]:
+    """Declare the DLQ and every email shard queue, returned in shard order."""
+    count = count or shard_count()
+
+    await declare_dead_letter_queue(channel)
+
+    if count <= 1:
+        queue = await channel.declare_queue(
+            settings.email_queue_name,
+            durable=True,
+            arguments={"x-dead-letter-exchange": settings.dead_letter_queue_name},
+        )
+        return [queue]
+
+    exchange = await get_exchange(channel, settings.email_shard_exchange)
+    queues = []
+    for name in shard_queue_names(count):
+        queue = await channel.declare_queue(
+            name,
+            durable=True,
+            arguments={
+                "x-dead-letter-exchange": settings.dead_letter_queue_name,
+                "x-single-active-consumer": True,
+            },
+        )
+        await queue.bind(exchange, routing_key=name)
+        queues.append(queue)
+
+    logger.info({"status": "shards_declared", "exchange": settings.email_shard_exchange, "shards": count})
+    return queues
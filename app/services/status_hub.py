@@ -0,0 +1,210 @@
+import asyncio
+import itertools
+import json
+import time
+import uuid
+from typing import AsyncIterator, Awaitable, Callable, Iterable
+import aio_pika
+from app.config import settings
+from app.services.broadcast import broadcast, declare_fanout, keep_trying, listen
+from app.utils.logger import get_logger
+
+logger = get_logger("status_hub")
+
+
+class StatusEvent:
+    """One status transition, serialized once and shared by every subscriber."""
+
+    __slots__ = ("seq", "request_id", "status", "payload")
+
+    def __init__(self, seq: int, request_id: str, status: str, fields: dict):
+        self.seq = seq
+        self.request_id = request_id
+        self.status = status
+        data = {"request_id": request_id, "status": status, "ts": time.time(), **fields}
+        self.payload = f"id: {seq}\nevent: status\ndata: {json.dumps(data)}\n\n".encode()
+
+
+class Subscription:
+    """Bounded per-subscriber buffer.
+
+    A slow subscriber never blocks publishers: when its buffer is full the
+    oldest event is dropped and the client receives a `lagged` event with the
+    number of transitions it missed, so it can fall back to /status.
+    """
+
+    def __init__(self, request_ids: frozenset[str] | None, maxsize: int):
+        self.request_ids = request_ids
+        self.queue: asyncio.Queue[StatusEvent] = asyncio.Queue(maxsize)
+        self.dropped = 0
+
+    def offer(self, event: StatusEvent) -> None:
+        if self.queue.full():
+            self.queue.get_nowait()
+            self.dropped += 1
+        self.queue.put_nowait(event)
+
+    async def stream(self, heartbeat: float) -> AsyncIterator[bytes]:
+        while True:
+            try:
+                event = await asyncio.wait_for(self.queue.get(), timeout=heartbeat)
+            except asyncio.TimeoutError:
+                yield b": keepalive\n\n"
+                continue
+            if self.dropped:
+                yield f"event: lagged\ndata: {json.dumps({'dropped': self.dropped})}\n\n".encode()
+                self.dropped = 0
+            yield event.payload
+
+
+class StatusHub:
+    """In-process pub/sub fanning status transitions out to stream subscribers.
+
+    With a StatusEventBus attached, publish() also hands each transition to
+    the bus, and the bus delivers what other processes published.
+    """
+
+    def __init__(self):
+        self._seq = itertools.count(1)
+        self._all: set[Subscription] = set()
+        self._by_request: dict[str, set[Subscription]] = {}
+        self.published = 0
+        self.bus: "StatusEventBus | None" = None
+
+    def subscribe(self, request_ids: Iterable[str] | None = None, maxsize: int | None = None) -> Subscription:
+        ids = frozenset(request_ids) if request_ids else None
+        subscription = Subscription(ids, maxsize or settings.status_stream_buffer)
+        if ids is None:
+            self._all.add(subscription)
+        else:
+            for request_id in ids:
+                self._by_request.setdefault(request_id, set()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription) -> None:
+        if subscription.request_ids is None:
+            self._all.discard(subscription)
+            return
+        for request_id in subscription.request_ids:
+            subscribers = self._by_request.get(request_id)
+            if subscribers is not None:
+                subscribers.discard(subscription)
+                if not subscribers:
+                    del self._by_request[request_id]
+
+    def publish(self, request_id: str, status: str, **fields) -> None:
+        self.deliver(request_id, status, **fields)
+        if self.bus is not None:
+            self.bus.send(request_id, status, fields)
+
+    def deliver(self, request_id: str, status: str, **fields) -> None:
+        """Fan out to this process's subscribers only."""
+        targeted = self._by_request.get(request_id)
+        if not self._all and not targeted:
+            return
+        event = StatusEvent(next(self._seq), request_id, status, fields)
+        self.published += 1
+        for subscription in self._all:
+            subscription.offer(event)
+        if targeted:
+            for subscription in targeted:
+                subscription.offer(event)
+
+    def stats(self) -> dict:
+        return {
+            "published": self.published,
+            "subscribers_all": len(self._all),
+            "subscribed_request_ids": len(self._by_request),
+        }
+
+
+class StatusEventBus:
+    """Carries status transitions between processes over a RabbitMQ fanout exchange.
+
+    Deliveries happen in worker processes and streams are served by API
+    processes, so every process publishes its transitions to the exchange and
+    every API process binds an exclusive queue to it and feeds the other
+    processes' events into its hub (its own come back too, and are skipped).
+    Events are transient and unconfirmed, and the queue drops its oldest
+    events when a process falls behind: the stream is best effort, /status
+    stays the source of truth.
+    """
+
+    def __init__(self, hub: StatusHub, exchange_name: str | None = None):
+        self.hub = hub
+        self.exchange_name = settings.status_events_exchange if exchange_name is None else exchange_name
+        self.origin = uuid.uuid4().hex
+        # Called with (request_id, status) for every event from another process
+        self.listeners: list[Callable[[str, str], None]] = []
+        self._exchange: aio_pika.abc.AbstractExchange | None = None
+        self._sending: set[asyncio.Task] = set()
+        self.sent = 0
+        self.received = 0
+        self.send_errors = 0
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.exchange_name)
+
+    async def attach(self, channel: aio_pika.abc.AbstractChannel) -> bool:
+        """Publish this process's transitions on channel (worker processes).
+
+        False (and nothing to detach) when the process already listens.
+        """
+        if self._exchange is not None:
+            return False
+        self._exchange = await declare_fanout(channel, self.exchange_name)
+        self.hub.bus = self
+        return True
+
+    def detach(self) -> None:
+        self._exchange = None
+        self.hub.bus = None
+
+    async def listen(self, channel: aio_pika.abc.AbstractChannel) -> None:
+        """Publish on channel and deliver every other process's transitions to the hub (API processes)."""
+        self._exchange = await listen(channel, self.exchange_name, self.origin, self._on_event)
+        self.hub.bus = self
+
+    async def run(self, open_channel: Callable[[], Awaitable[aio_pika.abc.AbstractChannel]]) -> None:
+        """listen() on a channel from open_channel, retrying until the broker is reachable."""
+        async def start() -> None:
+            await self.listen(await open_channel())
+
+        await keep_trying(start, "status_bus")
+
+    def send(self, request_id: str, status: str, fields: dict) -> None:
+        if self._exchange is None:
+            return
+        task = asyncio.get_running_loop().create_task(
+            self._publish(self._exchange, {"request_id": request_id, "status": status, "fields": fields})
+        )
+        self._sending.add(task)
+        task.add_done_callback(self._sending.discard)
+
+    async def _publish(self, exchange: aio_pika.abc.AbstractExchange, event: dict) -> None:
+        try:
+            await broadcast(exchange, self.origin, event)
+            self.sent += 1
+        except Exception as e:
+            self.send_errors += 1
+            logger.warning({"status": "status_event_publish_failed", "error": str(e)})
+
+    def _on_event(self, event: dict) -> None:
+        self.received += 1
+        request_id, status = str(event["request_id"]), str(event["status"])
+        for listener in self.listeners:
+            listener(request_id, status)
+        self.hub.deliver(request_id, status, **(event.get("fields") or {}))
+
+    def stats(self) -> dict:
+        return {
+            "exchange": self.exchange_name if self._exchange is not None else None,
+            "sent": self.sent,
+            "received": self.received,
+            "send_errors": self.send_errors,
+        }
+
+
+status_hub = StatusHub()
+status_bus = StatusEventBus(status_hub)
@@ -0,0 +1,257 @@
+import asyncio
+from datetime import date, datetime, timezone
+from sqlalchemy import select, text, tuple_, update
+from sqlalchemy.ext.asyncio import AsyncConnection, AsyncSession
+from app.config import settings
+from app.db import session_scope
+from app.models import Base, EmailBody, EmailStatus, EmailStatusEnum, utcnow
+from app.services.claim_check import resolve_body
+from app.utils.logger import get_logger
+
+logger = get_logger("status_store")
+
+Cursor = tuple[datetime, int]
+
+# Monthly partitioned tables; a month of bodies is dropped with its statuses
+PARTITIONED_TABLES = (EmailStatus.__tablename__, EmailBody.__tablename__)
+
+
+# Partition maintenance (Postgres only; other dialects keep a single table)
+
+def _add_months(month: date, count: int) -> date:
+    index = month.year * 12 + month.month - 1 + count
+    return date(index // 12, index % 12 + 1, 1)
+
+
+def partition_name(month: date, table: str = EmailStatus.__tablename__) -> str:
+    return f"{table}_{month.year}_{month.month:02d}"
+
+
+def _is_postgres(conn: AsyncConnection) -> bool:
+    return conn.dialect.name == "postgresql"
+
+
+async def ensure_partitions(conn: AsyncConnection, months_ahead: int | None = None, today: date | None = None) -> list[str]:
+    """Create the current month's partitions and the next months_ahead ones."""
+    if not _is_postgres(conn):
+        return []
+    months_ahead = settings.status_partitions_ahead if months_ahead is None else months_ahead
+    current = (today or datetime.now(timezone.utc).date()).replace(day=1)
+    created = []
+    for table in PARTITIONED_TABLES:
+        for offset in range(months_ahead + 1):
+            start = _add_months(current, offset)
+            name = partition_name(start, table)
+            await conn.execute(text(
+                f"CREATE TABLE IF NOT EXISTS {name} PARTITION OF {table} "
+                f"FOR VALUES FROM ('{start.isoformat()}') TO ('{_add_months(start, 1).isoformat()}')"
+            ))
+            created.append(name)
+    return created
+
+
+async def list_partitions(conn: AsyncConnection, parent: str = EmailStatus.__tablename__) -> list[str]:
+    result = await conn.execute(text(
+        "SELECT child.relname FROM pg_inherits "
+        "JOIN pg_class parent ON pg_inherits.inhparent = parent.oid "
+        "JOIN pg_class child ON pg_inherits.inhrelid = child.oid "
+        "WHERE parent.relname = :parent ORDER BY child.relname"
+    ), {"parent": parent})
+    return [row[0] for row in result]
+
+
+async def drop_expired_partitions(conn: AsyncConnection, retention_months: int | None = None, today: date | None = None) -> list[str]:
+    """Detach and drop whole monthly partitions older than the retention window."""
+    if not _is_postgres(conn):
+        return []
+    retention_months = settings.status_retention_months if retention_months is None else retention_months
+    cutoff = _add_months((today or datetime.now(timezone.utc).date()).replace(day=1), -retention_months)
+    dropped = []
+    for table in PARTITIONED_TABLES:
+        for name in await list_partitions(conn, table):
+            try:
+                year, month = name.rsplit("_", 2)[-2:]
+                start = date(int(year), int(month), 1)
+            except ValueError:
+                continue
+            if start < cutoff:
+                await conn.execute(text(f"ALTER TABLE {table} DETACH PARTITION {name}"))
+                await conn.execute(text(f"DROP TABLE {name}"))
+                dropped.append(name)
+    if dropped:
+        logger.info({"status": "partitions_dropped", "partitions": dropped})
+    return dropped
+
+
+async def create_status_schema(conn: AsyncConnection) -> None:
+    await conn.run_sync(Base.metadata.create_all)
+    await ensure_partitions(conn)
+
+
+async def run_retention_job(engine) -> None:
+    """Keep future partitions in place and drop expired ones, forever."""
+    while True:
+        try:
+            async with engine.begin() as conn:
+                await create_status_schema(conn)
+                await drop_expired_partitions(conn)
+        except Exception as e:
+            logger.error({"status": "retention_job_failed", "error": str(e)})
+        await asyncio.sleep(settings.status_maintenance_interval)
+
+
+# Writes
+
+async def record_email(
+    session: AsyncSession,
+    request_id: str,
+    to_email: str,
+    subject: str | None,
+    body: str | None,
+    status: EmailStatusEnum = EmailStatusEnum.queued,
+    meta: dict | None = None,
+    body_ref: dict | None = None,
+    created_at: datetime | None = None,
+) -> EmailStatus:
+    """Insert a status row; a claim-checked body is stored as its reference only."""
+    offload = settings.status_offload_body and body is not None
+    created_at = created_at or utcnow()
+    if body_ref:
+        meta = {**(meta or {}), "body_ref": body_ref}
+    row = EmailStatus(
+        request_id=request_id,
+        to_email=to_email,
+        subject=subject,
+        body=None if offload else body,
+        status=status,
+        meta=meta or {},
+        created_at=created_at,
+    )
+    session.add(row)
+    if offload:
+        session.add(EmailBody(request_id=request_id, created_at=created_at, body=body))
+    await session.commit()
+    return row
+
+
+async def update_status(
+    session: AsyncSession,
+    request_id: str,
+    created_at: datetime,
+    status: EmailStatusEnum,
+    error: str | None = None,
+) -> bool:
+    """Move one row (request_id, created_at: a single partition) to status; False if it is gone."""
+    result = await session.execute(
+        update(EmailStatus)
+        .where(EmailStatus.request_id == request_id, EmailStatus.created_at == created_at)
+        .values(status=status, last_error=error, updated_at=utcnow())
+    )
+    await session.commit()
+    return bool(result.rowcount)
+
+
+async def get_body(session: AsyncSession, row: EmailStatus) -> str | None:
+    if row.body is not None:
+        return row.body
+    if (row.meta or {}).get("body_ref"):
+        return await resolve_body(row.meta["body_ref"])
+    return await session.scalar(
+        select(EmailBody.body).where(EmailBody.request_id == row.request_id, EmailBody.created_at == row.created_at)
+    )
+
+
+# Used by /send_email and the consumer when STATUS_STORE_ENABLED
+
+def message_request_id(message: dict) -> str:
+    return str(message.get("request_id") or message.get("to") or "unknown")
+
+
+async def record_message(message: dict, status: EmailStatusEnum) -> None:
+    """Insert the row of a message about to be queued or scheduled.
+
+    Stamps message["status_created_at"] so the consumer updates exactly this
+    row (and only its partition), even when a request_id is reused.
+    """
+    created_at = utcnow()
+    async with session_scope() as session:
+        await record_email(
+            session,
+            message_request_id(message),
+            message["to"],
+            message.get("subject"),
+            message.get("body"),
+            status,
+            meta=message.get("meta"),
+            body_ref=message.get("body_ref"),
+            created_at=created_at,
+        )
+    message["status_created_at"] = created_at.isoformat()
+
+
+async def record_final_status(message: dict, status: EmailStatusEnum, error: str | None = None) -> None:
+    """Consumer side; never fails the delivery it reports on."""
+    created_at = message.get("status_created_at")
+    if not created_at:
+        return  # published without a row (STATUS_STORE_ENABLED was off at the API)
+    request_id = message_request_id(message)
+    try:
+        async with session_scope() as session:
+            found = await update_status(session, request_id, datetime.fromisoformat(created_at), status, error)
+        if not found:
+            logger.warning({"status": "status_row_missing", "request_id": request_id, "created_at": created_at})
+    except Exception as e:
+        logger.error({"status": "status_store_failed", "request_id": request_id, "error": str(e)})
+
+
+# Keyset-paginated reads, newest first. Pass the returned cursor back as `after`.
+
+async def _page(session: AsyncSession, query, after: Cursor | None, limit: int) -> tuple[list[EmailStatus], Cursor | None]:
+    if after is not None:
+        query = query.where(tuple_(EmailStatus.created_at, EmailStatus.id) < tuple_(*after))
+    query = query.order_by(EmailStatus.created_at.desc(), EmailStatus.id.desc()).limit(limit)
+    rows = list((await session.execute(query)).scalars())
+    cursor = (rows[-1].created_at, rows[-1].id) if len(rows) == limit else None
+    return rows, cursor
+
+
+async def get_status(session: AsyncSession, request_id: str, since: datetime | None = None) -> EmailStatus | None:
+    """Latest row for request_id; `since` lets Postgres prune old partitions."""
+    query = select(EmailStatus).where(EmailStatus.request_id == request_id)
+    if since is not None:
+        query = query.where(EmailStatus.created_at >= since)
+    rows, _ = await _page(session, query, None, 1)
+    return rows[0] if rows else None
+
+
+async def list_by_recipient(
+    session: AsyncSession,
+    to_email: str,
+    after: Cursor | None = None,
+    limit: int = 100,
+    status: EmailStatusEnum | None = None,
+) -> tuple[list[EmailStatus], Cursor | None]:
+    query = select(EmailStatus).where(EmailStatus.to_email == to_email)
+    if status is not None:
+        query = query.where(EmailStatus.status == status)
+    return await _page(session, query, after, limit)
+
+
+async def list_by_status(
+    session: AsyncSession,
+    status: EmailStatusEnum,
+    after: Cursor | None = None,
+    limit: int = 100,
+) -> tuple[list[EmailStatus], Cursor | None]:
+    return await _page(session, select(EmailStatus).where(EmailStatus.status == status), after, limit)
+
+
+async def list_between(
+    session: AsyncSession,
+    start: datetime,
+    end: datetime,
+    after: Cursor | None = None,
+    limit: int = 100,
+) -> tuple[list[EmailStatus], Cursor | None]:
+    query = select(EmailStatus).where(EmailStatus.created_at >= start, EmailStatus.created_at < end)
+    return await _page(session, query, after, limit)
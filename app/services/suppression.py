@@ -0,0 +1,337 @@
+import asyncio
+import hashlib
+import math
+from array import array
+from bisect import bisect_left
+from datetime import datetime, timedelta
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import async_sessionmaker
+from app.config import settings
+from app.models import SuppressionEntry, utcnow
+from app.utils.logger import get_logger
+
+logger = get_logger("suppression")
+
+REFRESH_OVERLAP = 30
+
+
+def normalize(value: str) -> str:
+    """Lower-cased address, or "@domain" for a domain entry ("example.com" or "@example.com")."""
+    value = value.strip().lower()
+    if "@" not in value:
+        return f"@{value}"
+    return value
+
+
+def hash64(value: str) -> int:
+    return int.from_bytes(hashlib.blake2b(value.encode("utf-8"), digest_size=8).digest(), "little")
+
+
+class BloomFilter:
+    """Bit array with k probes derived from one 64-bit hash (double hashing)."""
+
+    def __init__(self, capacity: int, error_rate: float):
+        capacity = max(capacity, 1024)
+        self.size = max(64, int(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.probes = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+
+    def _positions(self, h: int):
+        h1, h2 = h & 0xFFFFFFFF, (h >> 32) | 1
+        for i in range(self.probes):
+            yield (h1 + i * h2) % self.size
+
+    def add(self, h: int) -> None:
+        for bit in self._positions(h):
+            self.bits[bit >> 3] |= 1 << (bit & 7)
+
+    def __contains__(self, h: int) -> bool:
+        bits = self.bits
+        return all(bits[bit >> 3] & (1 << (bit & 7)) for bit in self._positions(h))
+
+
+class SuppressionList:
+    """Suppressed addresses and domains as 64-bit hashes.
+
+    The bulk of the list is a sorted array('Q') (8 bytes per entry) with a
+    Bloom filter in front, so the usual case, an address that is not
+    suppressed, is answered from a few bit probes without touching the array.
+    Changes since the last build live in small added/removed sets and are
+    folded in by compact() once they grow past `compact_threshold`, so an
+    update never needs a full reload.
+    """
+
+    def __init__(self, error_rate: float | None = None, compact_threshold: int = 50_000):
+        self.error_rate = error_rate or settings.suppression_bloom_error_rate
+        self.compact_threshold = compact_threshold
+        self.base = array("Q")
+        self.bloom = BloomFilter(0, self.error_rate)
+        self.added: set[int] = set()
+        self.removed: set[int] = set()
+        self.reasons: dict[int, str] = {}  # only for delta entries, for reporting
+        self._journal: list[tuple[int, str | None, bool]] | None = None  # changes made while compact_async runs
+        self.lookups = 0
+        self.hits = 0
+
+    def build(self, hashes) -> None:
+        """Replace the base set; any pending delta is kept on top."""
+        base = array("Q", sorted(set(hashes)))
+        bloom = BloomFilter(len(base), self.error_rate)
+        for h in base:
+            bloom.add(h)
+        self.base, self.bloom = base, bloom
+
+    def build_from_values(self, values) -> int:
+        self.build(hash64(normalize(value)) for value in values if value.strip())
+        return len(self.base)
+
+    def _in_base(self, h: int) -> bool:
+        if h not in self.bloom:
+            return False
+        index = bisect_left(self.base, h)
+        return index < len(self.base) and self.base[index] == h
+
+    def _contains(self, h: int) -> bool:
+        if h in self.removed:
+            return False
+        return h in self.added or self._in_base(h)
+
+    def check(self, address: str) -> str | None:
+        """Return "address" or "domain" when the recipient is suppressed, else None."""
+        self.lookups += 1
+        address = address.strip().lower()
+        if self._contains(hash64(address)):
+            self.hits += 1
+            return "address"
+        domain = address.rpartition("@")[2]
+        if domain and self._contains(hash64(f"@{domain}")):
+            self.hits += 1
+            return "domain"
+        return None
+
+    def add(self, value: str, reason: str | None = None) -> None:
+        self._apply(hash64(normalize(value)), reason, True)
+
+    def remove(self, value: str) -> None:
+        self._apply(hash64(normalize(value)), None, False)
+
+    def _apply(self, h: int, reason: str | None, active: bool) -> None:
+        if self._journal is not None:
+            self._journal.append((h, reason, active))
+        if active:
+            self.removed.discard(h)
+            if not self._in_base(h):
+                self.added.add(h)
+            if reason:
+                self.reasons[h] = reason
+        else:
+            self.added.discard(h)
+            self.reasons.pop(h, None)
+            if self._in_base(h):
+                self.removed.add(h)
+
+    def needs_compaction(self) -> bool:
+        return len(self.added) + len(self.removed) > self.compact_threshold
+
+    def _merge(self, added: set[int], removed: set[int]) -> tuple[array, BloomFilter]:
+        base = array("Q", sorted({h for h in self.base if h not in removed} | added))
+        bloom = BloomFilter(len(base), self.error_rate)
+        for h in base:
+            bloom.add(h)
+        return base, bloom
+
+    def _swap(self, merged: tuple[array, BloomFilter], added: set[int], removed: set[int]) -> None:
+        self.base, self.bloom = merged
+        self.added -= added
+        self.removed -= removed
+
+    def compact(self) -> None:
+        """Fold the delta into a new sorted array and filter."""
+        added, removed = set(self.added), set(self.removed)
+        self._swap(self._merge(added, removed), added, removed)
+
+    async def compact_async(self) -> None:
+        """compact() with the rebuild in a thread; deltas are snapshotted on the loop.
+
+        Changes made during the rebuild were judged against the old base, so
+        they are journaled and applied again on top of the new one.
+        """
+        if self._journal is not None:
+            return  # already compacting
+        added, removed = set(self.added), set(self.removed)
+        self._journal = []
+        try:
+            merged = await asyncio.to_thread(self._merge, added, removed)
+            self._swap(merged, added, removed)
+        finally:
+            journal, self._journal = self._journal, None
+        for h, reason, active in journal:
+            self._apply(h, reason, active)
+
+    def stats(self) -> dict:
+        return {
+            "entries": len(self.base) + len(self.added) - len(self.removed),
+            "base_entries": len(self.base),
+            "delta_added": len(self.added),
+            "delta_removed": len(self.removed),
+            "memory_bytes": self.base.itemsize * len(self.base) + len(self.bloom.bits),
+            "bloom_probes": self.bloom.probes,
+            "lookups": self.lookups,
+            "hits": self.hits,
+        }
+
+
+class SuppressionService:
+    """Keeps a SuppressionList in sync with its source (file or Postgres).
+
+    With the database source, writes go to the suppression table and to the
+    local list at once; other replicas poll rows changed since their last
+    watermark (updated_at index) every `refresh_interval` seconds.
+    """
+
+    def __init__(self, session_factory: async_sessionmaker | None = None, source: str | None = None):
+        self._session_factory = session_factory
+        self.source = settings.suppression_source if source is None else source
+        self.list = SuppressionList()
+        self.watermark: datetime | None = None
+        self.loaded = False
+        self._task: asyncio.Task | None = None
+        self._pending: set[asyncio.Task] = set()
+
+    @property
+    def enabled(self) -> bool:
+        return self.source in ("file", "database")
+
+    @property
+    def writable(self) -> bool:
+        """Only database writes reach other processes; the file is edited out of band."""
+        return self.source == "database"
+
+    @property
+    def session_factory(self) -> async_sessionmaker:
+        if self._session_factory is None:
+            from app.db import AsyncSessionLocal
+            self._session_factory = AsyncSessionLocal
+        return self._session_factory
+
+    def session(self):
+        """A session_scope on session_factory, so pool waits show up in the DB stats."""
+        from app.db import session_scope
+        return session_scope(self.session_factory)
+
+    def check(self, address: str) -> str | None:
+        if not self.loaded:
+            return None
+        return self.list.check(address)
+
+    async def load_file(self, path: str) -> int:
+        def read() -> int:
+            with open(path) as f:
+                values = [line.split("#", 1)[0] for line in f]
+            return self.list.build_from_values(values)
+
+        return await asyncio.to_thread(read)
+
+    async def load_database(self) -> int:
+        async with self.session() as session:
+            conn = await session.connection()
+            await conn.run_sync(SuppressionEntry.__table__.create, checkfirst=True)
+            await session.commit()
+            self.watermark = await session.scalar(select(SuppressionEntry.updated_at).order_by(SuppressionEntry.updated_at.desc()).limit(1))
+            result = await session.stream(
+                select(SuppressionEntry.value).where(SuppressionEntry.active.is_(True)).execution_options(yield_per=10_000)
+            )
+            values = [value async for value in result.scalars()]
+        return await asyncio.to_thread(self.list.build_from_values, values)
+
+    async def refresh(self) -> int:
+        """Apply rows changed since the watermark; returns how many."""
+        async with self.session() as session:
+            query = select(SuppressionEntry.value, SuppressionEntry.active, SuppressionEntry.reason, SuppressionEntry.updated_at)
+            if self.watermark is not None:
+                # Re-read a short overlap: writers' clocks and commit order are not perfectly aligned
+                query = query.where(SuppressionEntry.updated_at >= self.watermark - timedelta(seconds=REFRESH_OVERLAP))
+            rows = (await session.execute(query.order_by(SuppressionEntry.updated_at))).all()
+        for row in rows:
+            if row.active:
+                self.list.add(row.value, row.reason)
+            else:
+                self.list.remove(row.value)
+        if rows:
+            self.watermark = rows[-1].updated_at
+        if self.list.needs_compaction():
+            await self.list.compact_async()
+        return len(rows)
+
+    async def add(self, value: str, reason: str | None = None) -> None:
+        self.list.add(value, reason)
+        if self.source == "database":
+            await self._persist(normalize(value), reason, True)
+
+    async def remove(self, value: str) -> None:
+        self.list.remove(value)
+        if self.source == "database":
+            await self._persist(normalize(value), None, False)
+
+    def record_bounce(self, address: str, error: str) -> None:
+        """Suppress a hard-bounced address; persisting runs in the background."""
+        if not self.loaded:
+            return
+        self.list.add(address, "hard_bounce")
+        logger.info({"status": "suppressed_hard_bounce", "to": address, "error": error})
+        if self.source == "database":
+            task = asyncio.create_task(self._persist(normalize(address), "hard_bounce", True))
+            self._pending.add(task)
+            task.add_done_callback(self._persisted)
+
+    def _persisted(self, task: asyncio.Task) -> None:
+        self._pending.discard(task)
+        if not task.cancelled() and task.exception():
+            logger.error({"status": "suppression_persist_failed", "error": str(task.exception())})
+
+    async def _persist(self, value: str, reason: str | None, active: bool) -> None:
+        async with self.session() as session:
+            entry = await session.get(SuppressionEntry, value)
+            if entry is None:
+                session.add(SuppressionEntry(value=value, reason=reason, active=active, updated_at=utcnow()))
+            else:
+                entry.active, entry.updated_at = active, utcnow()
+                if reason:
+                    entry.reason = reason
+            await session.commit()
+
+    async def _refresh_loop(self) -> None:
+        while True:
+            await asyncio.sleep(settings.suppression_refresh_interval)
+            try:
+                await self.refresh()
+            except Exception as e:
+                logger.error({"status": "suppression_refresh_failed", "error": str(e)})
+
+    async def start(self) -> None:
+        if self.loaded or not self.enabled:
+            return
+        if self.source == "file":
+            count = await self.load_file(settings.suppression_file)
+        else:
+            count = await self.load_database()
+            self._task = asyncio.create_task(self._refresh_loop())
+        self.loaded = True
+        logger.info({"status": "suppression_loaded", "source": self.source, "entries": count})
+
+    async def stop(self) -> None:
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if self._pending:
+            await asyncio.gather(*self._pending, return_exceptions=True)
+
+    def stats(self) -> dict:
+        return {"source": self.source or None, "loaded": self.loaded, **self.list.stats()}
+
+
+suppression = SuppressionService()
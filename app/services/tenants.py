@@ -0,0 +1,64 @@
+import json
+from functools import lru_cache
+import aio_pika
+from app.config import settings
+from app.utils.logger import get_logger
+
+logger = get_logger("tenants")
+
+DEFAULT_TENANT = "default"
+TENANT_HEADER = "x-tenant"
+
+
+@lru_cache(maxsize=1)
+def tenant_config() -> dict[str, dict]:
+    """TENANTS: {"acme": {"weight": 4, "max_in_flight": 8}, "bulk-import": {"weight": 1, "max_in_flight": 2}}"""
+    return json.loads(settings.tenants) if settings.tenants else {}
+
+
+@lru_cache(maxsize=1)
+def api_key_tenants() -> dict[str, str]:
+    """TENANT_API_KEYS: {"<api key>": "<tenant>"}"""
+    return json.loads(settings.tenant_api_keys) if settings.tenant_api_keys else {}
+
+
+def resolve_tenant(meta: dict | None = None, api_key: str | None = None) -> str:
+    """The tenant of the X-API-Key once TENANT_API_KEYS is set, so no client can claim another
+    tenant's share; meta["tenant"] is only honoured while no keys are configured."""
+    keys = api_key_tenants()
+    if keys:
+        return keys.get(api_key or "", DEFAULT_TENANT)
+    tenant = (meta or {}).get("tenant")
+    return str(tenant) if tenant else DEFAULT_TENANT
+
+
+def tenant_weight(tenant: str) -> float:
+    return float(tenant_config().get(tenant, {}).get("weight", settings.tenant_default_weight))
+
+
+def tenant_cap(tenant: str) -> int:
+    """Max deliveries in flight for the tenant in this process (0 = no cap)."""
+    return int(tenant_config().get(tenant, {}).get("max_in_flight", settings.tenant_default_max_in_flight))
+
+
+def tenant_queue_name(tenant: str) -> str | None:
+    """Configured tenants get their own broker queue; everyone else shares the FIFO email.queue
+    shards, so among them fairness only applies to what one consumer has prefetched."""
+    if tenant in tenant_config() and tenant != DEFAULT_TENANT:
+        return f"{settings.email_queue_name}.tenant.{tenant}"
+    return None
+
+
+async def declare_tenant_queues(channel: aio_pika.abc.AbstractChannel) -> list[aio_pika.abc.AbstractQueue]:
+    queues = []
+    for tenant in tenant_config():
+        name = tenant_queue_name(tenant)
+        if name:
+            queues.append(await channel.declare_queue(
+                name,
+                durable=True,
+                arguments={"x-dead-letter-exchange": settings.dead_letter_queue_name},
+            ))
+    if queues:
+        logger.info({"status": "tenant_queues_declared", "queues": [queue.name for queue in queues]})
+    return queues
@@ -0,0 +1,269 @@
+import asyncio
+import hashlib
+import hmac
+import ipaddress
+import json
+import random
+import socket
+import time
+from collections import Counter, OrderedDict
+from functools import lru_cache
+from urllib.parse import urlparse
+import httpx
+from app.config import settings
+from app.services.batch_publisher import BatchPublisher
+from app.services.circuit_breaker import CircuitBreaker
+from app.utils.logger import get_logger
+
+logger = get_logger("webhooks")
+
+# Statuses a delivery ends in; callers are notified of these only
+TERMINAL_STATUSES = ("delivered", "failed", "suppressed", "expired")
+SIGNATURE_HEADER = "X-Webhook-Signature"
+MAX_ENDPOINTS = 1000
+
+
+class WebhookError(Exception):
+    pass
+
+
+def _public_address(address: str) -> bool:
+    return ipaddress.ip_address(address.split("%")[0]).is_global
+
+
+def valid_callback_url(url: str) -> bool:
+    parsed = urlparse(url)
+    if parsed.scheme not in ("http", "https") or not parsed.hostname:
+        return False
+    try:
+        return _public_address(parsed.hostname)
+    except ValueError:
+        return True  # a name: checked against its addresses before every POST
+
+
+def allowed_callback_host(url: str) -> bool:
+    host = (urlparse(url).hostname or "").lower()
+    for allowed in filter(None, (entry.strip().lower() for entry in settings.webhook_allowed_hosts.split(","))):
+        if host == allowed or (allowed.startswith(".") and host.endswith(allowed)):
+            return True
+    return False
+
+
+async def resolve_host(host: str, port: int) -> list[str]:
+    infos = await asyncio.get_running_loop().getaddrinfo(host, port, type=socket.SOCK_STREAM)
+    return [info[4][0] for info in infos]
+
+
+async def require_public_target(url: str) -> None:
+    """Refuse callback URLs that resolve to private, loopback or link-local addresses (SSRF).
+
+    The name is resolved again by the HTTP client, so this narrows DNS
+    rebinding rather than ruling it out.
+    """
+    parsed = urlparse(url)
+    port = parsed.port or (443 if parsed.scheme == "https" else 80)
+    try:
+        addresses = await resolve_host(parsed.hostname or "", port)
+    except OSError as e:
+        raise WebhookError(f"Cannot resolve {parsed.hostname}: {e}")
+    if not addresses or not all(_public_address(address) for address in addresses):
+        raise WebhookError(f"Callback URL resolves to a non-public address ({parsed.hostname})")
+
+
+@lru_cache(maxsize=1)
+def tenant_webhooks() -> dict[str, str]:
+    """WEBHOOK_URLS: {"<tenant>": "https://hooks.example.com/email"}; tenants come from TENANT_API_KEYS."""
+    return json.loads(settings.webhook_urls) if settings.webhook_urls else {}
+
+
+def callback_url(message: dict) -> str | None:
+    """meta["callback_url"] of the request, else the webhook of the client's tenant."""
+    meta = message.get("meta") if isinstance(message.get("meta"), dict) else {}
+    url = meta.get("callback_url") or tenant_webhooks().get(message.get("tenant") or "")
+    return str(url) if url else None
+
+
+def sign(body: bytes, secret: str) -> str:
+    return "sha256=" + hmac.new(secret.encode(), body, hashlib.sha256).hexdigest()
+
+
+class Endpoint:
+    """One callback URL: its own batcher, in-flight limit and circuit breaker."""
+
+    def __init__(self, url: str, dispatcher: "WebhookDispatcher"):
+        self.url = url
+        self.pending = 0
+        self.slots = asyncio.Semaphore(dispatcher.max_concurrency)
+        self.circuit = CircuitBreaker(dispatcher.failure_threshold, dispatcher.recovery_time)
+        self.batcher = BatchPublisher(
+            lambda events: dispatcher.post(self, events), dispatcher.linger_ms, dispatcher.batch_size
+        )
+
+
+class WebhookDispatcher:
+    """Delivers status events to callback URLs without holding up deliveries.
+
+    emit() only queues the event. Events for the same URL are coalesced by a
+    BatchPublisher into one POST {"events": [...]} (batch_size, linger_ms),
+    sent over a shared pooled httpx.AsyncClient. Each URL has at most
+    max_concurrency POSTs in flight and its own circuit breaker; failed
+    POSTs are retried with exponential backoff and full jitter. When a URL
+    has max_pending events waiting, new ones for it are dropped and counted.
+    URLs other than the configured WEBHOOK_URLS must resolve to public addresses.
+    """
+
+    def __init__(
+        self,
+        batch_size: int = 50,
+        linger_ms: float = 200,
+        max_concurrency: int = 2,
+        max_pending: int = 10_000,
+        retries: int = 3,
+        backoff: float = 0.5,
+        timeout: float = 5,
+        failure_threshold: int = 5,
+        recovery_time: float = 30,
+        secret: str = "",
+        client: httpx.AsyncClient | None = None,
+    ):
+        self.batch_size = batch_size
+        self.linger_ms = linger_ms
+        self.max_concurrency = max(1, max_concurrency)
+        self.max_pending = max_pending
+        self.retries = max(1, retries)
+        self.backoff = backoff
+        self.timeout = timeout
+        self.failure_threshold = failure_threshold
+        self.recovery_time = recovery_time
+        self.secret = secret
+        self._client = client
+        self.endpoints: OrderedDict[str, Endpoint] = OrderedDict()
+        self._tasks: set[asyncio.Task] = set()
+        self.counts: Counter[str] = Counter()
+
+    @property
+    def client(self) -> httpx.AsyncClient:
+        if self._client is None:
+            self._client = httpx.AsyncClient(
+                timeout=self.timeout,
+                limits=httpx.Limits(max_connections=100, max_keepalive_connections=20),
+            )
+        return self._client
+
+    def _endpoint(self, url: str) -> Endpoint:
+        endpoint = self.endpoints.get(url)
+        if endpoint is None:
+            endpoint = self.endpoints[url] = Endpoint(url, self)
+            if len(self.endpoints) > MAX_ENDPOINTS:
+                idle = next((key for key, known in self.endpoints.items() if not known.pending), None)
+                if idle is not None:
+                    del self.endpoints[idle]
+        else:
+            self.endpoints.move_to_end(url)
+        return endpoint
+
+    def emit(self, url: str, event: dict) -> None:
+        endpoint = self._endpoint(url)
+        if endpoint.pending >= self.max_pending:
+            self.counts["dropped"] += 1
+            return
+        endpoint.pending += 1
+        task = asyncio.create_task(self._submit(endpoint, event))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _submit(self, endpoint: Endpoint, event: dict) -> None:
+        try:
+            await endpoint.batcher.submit(event)
+            self.counts["delivered"] += 1
+        except Exception as e:
+            self.counts["failed"] += 1
+            logger.warning({"status": "webhook_failed", "url": endpoint.url, "request_id": event.get("request_id"), "error": str(e)})
+        finally:
+            endpoint.pending -= 1
+
+    async def post(self, endpoint: Endpoint, events: list[dict]) -> list:
+        """Send one batch; returns a result per event for the BatchPublisher."""
+        body = json.dumps({"events": events}, separators=(",", ":")).encode()
+        headers = {"Content-Type": "application/json"}
+        if self.secret:
+            headers[SIGNATURE_HEADER] = sign(body, self.secret)
+
+        if endpoint.url not in tenant_webhooks().values():
+            try:
+                await require_public_target(endpoint.url)
+            except WebhookError as e:
+                self.counts["blocked"] += 1
+                return [e] * len(events)
+
+        async with endpoint.slots:
+            for attempt in range(1, self.retries + 1):
+                if not endpoint.circuit.allow_request():
+                    return [WebhookError("Circuit breaker is OPEN")] * len(events)
+                retry_after = None
+                try:
+                    response = await self.client.post(endpoint.url, content=body, headers=headers)
+                    if response.status_code < 300:
+                        endpoint.circuit.record_success()
+                        self.counts["posts"] += 1
+                        return [True] * len(events)
+                    error = WebhookError(f"HTTP {response.status_code}")
+                    if response.status_code < 500 and response.status_code not in (408, 429):
+                        # The endpoint answered: it is up, the request will not get better
+                        endpoint.circuit.record_success()
+                        return [error] * len(events)
+                    retry_after = response.headers.get("retry-after")
+                except httpx.HTTPError as e:
+                    error = WebhookError(f"{type(e).__name__}: {e}")
+                endpoint.circuit.record_failure()
+                if attempt < self.retries:
+                    self.counts["retries"] += 1
+                    delay = random.uniform(0, self.backoff * 2 ** (attempt - 1))
+                    if retry_after and retry_after.isdigit():
+                        delay = max(delay, min(float(retry_after), 30))
+                    await asyncio.sleep(delay)
+        return [error] * len(events)
+
+    async def flush(self, timeout: float | None = None) -> None:
+        """Wait, up to timeout, for every queued event to be sent (or to fail)."""
+        if self._tasks:
+            await asyncio.wait(list(self._tasks), timeout=timeout)
+
+    async def close(self, timeout: float = 5) -> None:
+        await self.flush(timeout)
+        for task in list(self._tasks):
+            task.cancel()
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    def stats(self) -> dict:
+        return {
+            "endpoints": len(self.endpoints),
+            "pending": sum(endpoint.pending for endpoint in self.endpoints.values()),
+            "open_circuits": sum(endpoint.circuit.state == "OPEN" for endpoint in self.endpoints.values()),
+            **self.counts,
+        }
+
+
+webhooks = WebhookDispatcher(
+    batch_size=settings.webhook_batch_size,
+    linger_ms=settings.webhook_linger_ms,
+    max_concurrency=settings.webhook_max_concurrency,
+    max_pending=settings.webhook_max_pending,
+    retries=settings.webhook_retries,
+    backoff=settings.webhook_backoff,
+    timeout=settings.webhook_timeout,
+    secret=settings.webhook_secret,
+)
+
+
+def notify(message: dict, request_id: str, status: str, **fields) -> None:
+    """Queue a status event for the message's callback URL, if it has one."""
+    if status not in TERMINAL_STATUSES:
+        return
+    url = callback_url(message)
+    if not url:
+        return
+    event = {"request_id": request_id, "status": status, "to": message.get("to"), "timestamp": round(time.time(), 3), **fields}
+    webhooks.emit(url, event)
@@ -2,11 +2,13 @@ import logging
 import os
 import sys
 import uuid
+from contextvars import ContextVar
 from logging.handlers import RotatingFileHandler
 from pythonjsonlogger.json import JsonFormatter
 from colorama import Fore, Style, init
 from typing import Optional
 import io
+from app.utils import tracing
 
 # Initialize color output for Windows terminals
 init(autoreset=True)
@@ -32,19 +34,22 @@ class ColorFormatter(logging.Formatter):
         return f"{color}{message}{Style.RESET_ALL}"
 
 
-# 🧩 Thread-local request context
+# 🧩 Per-task request context
 class RecordContext:
-    """Stores request-specific data like request_id."""
+    """Stores request-specific data like request_id.
+
+    Backed by a ContextVar, so concurrent requests and consumer tasks each see their own.
+    """
     def __init__(self):
-        self._request_id: Optional[str] = None
+        self._request_id: ContextVar[Optional[str]] = ContextVar("request_id", default=None)
 
     @property
     def request_id(self) -> Optional[str]:
-        return self._request_id
+        return self._request_id.get()
 
     @request_id.setter
     def request_id(self, value: Optional[str]):
-        self._request_id = value
+        self._request_id.set(value)
 
 
 record_context = RecordContext()
@@ -60,12 +65,30 @@ def clear_request_id():
     record_context.request_id = None
 
 
+# 🔗 Request and trace ids for plain-text formats
+class TraceContextFilter(logging.Filter):
+    """Sets request_id, trace_id and span_id on every record ("-" outside a request or trace)."""
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        trace = tracing.current()
+        record.request_id = record_context.request_id or "-"
+        record.trace_id = trace.trace_id if trace else "-"
+        record.span_id = (trace.span_id if trace else None) or "-"
+        return True
+
+
+TRACE_FORMAT = "%(asctime)s | %(levelname)s | %(name)s | trace=%(trace_id)s span=%(span_id)s request=%(request_id)s | %(message)s"
+
+
 # 🧾 JSON structured formatter
 class CustomJsonFormatter(JsonFormatter):
     def process_log_record(self, log_data: dict) -> dict:
         """Add custom fields to every JSON log record."""
         log_data["service"] = "email_service_app"
         log_data["request_id"] = record_context.request_id
+        trace = tracing.current()
+        log_data["trace_id"] = trace.trace_id if trace else None
+        log_data["span_id"] = trace.span_id if trace else None
         return log_data
 
 
@@ -110,3 +133,13 @@ def get_logger(name: str) -> logging.Logger:
         logger.addHandler(error_handler)
 
     return logger
+
+
+def flush_logs() -> None:
+    """Flush every handler, e.g. before the process exits."""
+    for logger in [logging.getLogger(), *logging.Logger.manager.loggerDict.values()]:
+        for handler in getattr(logger, "handlers", []):
+            try:
+                handler.flush()
+            except Exception:
+                pass
@@ -0,0 +1,227 @@
+import asyncio
+import logging
+import os
+import re
+import sys
+import threading
+import time
+from collections import Counter
+from contextlib import nullcontext
+from app.config import settings
+
+# Shared no-op returned while timing is off: one attribute check per hook
+_DISABLED = nullcontext()
+
+
+class _Stage:
+    __slots__ = ("timings", "name", "started")
+
+    def __init__(self, timings: "StageTimings", name: str):
+        self.timings = timings
+        self.name = name
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.timings.record(self.name, time.perf_counter() - self.started)
+        return False
+
+
+class StageTimings:
+    """Per-stage wall-clock totals for the publish/consume/SMTP hot paths.
+
+    Use as `with stage_timer("smtp.connect"): ...`; the block may contain
+    awaits, so a stage measures its own latency including time parked on I/O.
+    """
+
+    def __init__(self, enabled: bool = False):
+        self.enabled = enabled
+        self.stages: dict[str, list[float]] = {}  # name -> [count, total, max]
+
+    def __call__(self, name: str):
+        if not self.enabled:
+            return _DISABLED
+        return _Stage(self, name)
+
+    def record(self, name: str, elapsed: float) -> None:
+        entry = self.stages.get(name)
+        if entry is None:
+            self.stages[name] = [1, elapsed, elapsed]
+        else:
+            entry[0] += 1
+            entry[1] += elapsed
+            if elapsed > entry[2]:
+                entry[2] = elapsed
+
+    def reset(self) -> None:
+        self.stages.clear()
+
+    def stats(self) -> dict:
+        return {
+            "enabled": self.enabled,
+            "stages": {
+                name: {
+                    "count": count,
+                    "total_ms": round(total * 1000, 1),
+                    "mean_ms": round(total / count * 1000, 3),
+                    "max_ms": round(peak * 1000, 3),
+                }
+                for name, (count, total, peak) in sorted(self.stages.items(), key=lambda item: -item[1][1])
+            },
+        }
+
+
+stage_timer = StageTimings(enabled=settings.stage_timing_enabled)
+
+
+def _frame_label(frame) -> str:
+    code = frame.f_code
+    return f"{os.path.basename(code.co_filename)}:{code.co_name}"
+
+
+def collapse_stack(frame) -> str:
+    """Root-first `a;b;c` stack as used by flamegraph.pl / speedscope."""
+    labels = []
+    while frame is not None:
+        labels.append(_frame_label(frame))
+        frame = frame.f_back
+    return ";".join(reversed(labels))
+
+
+SLOW_CALLBACK_REGEX = re.compile(r"Executing (?P<handle>.+) took (?P<seconds>[\d.]+) seconds")
+
+
+class _SlowCallbackHandler(logging.Handler):
+    """Collects asyncio's debug-mode "Executing <handle> took N seconds" warnings."""
+
+    def __init__(self):
+        super().__init__(logging.WARNING)
+        self.records: list[dict] = []
+
+    def emit(self, record: logging.LogRecord) -> None:
+        match = SLOW_CALLBACK_REGEX.search(record.getMessage())
+        if match:
+            self.records.append({
+                "callback": match.group("handle")[:300],
+                "duration_ms": round(float(match.group("seconds")) * 1000, 1),
+            })
+
+
+class LoopProfiler:
+    """Time-boxed sampling profile of a running event loop.
+
+    A daemon thread snapshots the loop thread's stack every `interval` seconds
+    via sys._current_frames() and counts identical stacks. Samples taken while
+    the loop is parked in select/epoll show up under the selector frames, so
+    the flamegraph also shows how idle the loop was. In parallel a coroutine
+    measures loop lag (how late a sleep wakes up) and asyncio debug mode is
+    switched on for the duration to report slow callbacks.
+    """
+
+    def __init__(self, seconds: float, interval: float, slow_callback: float):
+        self.seconds = seconds
+        self.interval = interval
+        self.slow_callback = slow_callback
+        self.stacks: Counter[str] = Counter()
+        self.samples = 0
+        self.lags: list[float] = []
+        self.slow_callbacks: list[dict] = []
+        self.stages: dict = {}
+
+    def _sample(self, thread_id: int, stop: threading.Event) -> None:
+        while not stop.wait(self.interval):
+            frame = sys._current_frames().get(thread_id)
+            if frame is None:
+                return
+            self.stacks[collapse_stack(frame)] += 1
+            self.samples += 1
+
+    async def _measure_lag(self, stop: asyncio.Event) -> None:
+        period = max(self.interval, 0.005)
+        while not stop.is_set():
+            expected = time.perf_counter() + period
+            await asyncio.sleep(period)
+            self.lags.append(max(0.0, time.perf_counter() - expected))
+
+    async def run(self) -> dict:
+        loop = asyncio.get_running_loop()
+        thread_stop = threading.Event()
+        lag_stop = asyncio.Event()
+        sampler = threading.Thread(
+            target=self._sample, args=(threading.get_ident(), thread_stop), name="loop-profiler", daemon=True
+        )
+
+        asyncio_logger = logging.getLogger("asyncio")
+        handler = _SlowCallbackHandler()
+        was_debug, was_threshold = loop.get_debug(), loop.slow_callback_duration
+        asyncio_logger.addHandler(handler)
+        loop.slow_callback_duration = self.slow_callback
+        loop.set_debug(True)
+
+        lag_task = asyncio.create_task(self._measure_lag(lag_stop))
+        sampler.start()
+        try:
+            await asyncio.sleep(self.seconds)
+        finally:
+            thread_stop.set()
+            lag_stop.set()
+            await lag_task
+            await asyncio.to_thread(sampler.join)
+            loop.set_debug(was_debug)
+            loop.slow_callback_duration = was_threshold
+            asyncio_logger.removeHandler(handler)
+        self.slow_callbacks = sorted(handler.records, key=lambda r: -r["duration_ms"])
+        self.stages = stage_timer.stats()["stages"]
+        return self.summary()
+
+    def collapsed(self) -> str:
+        return "".join(f"{stack} {count}\n" for stack, count in self.stacks.most_common())
+
+    def summary(self) -> dict:
+        lags = sorted(self.lags)
+
+        def pct(p: float) -> float | None:
+            return round(lags[min(len(lags) - 1, int(p * len(lags)))] * 1000, 2) if lags else None
+
+        return {
+            "seconds": self.seconds,
+            "interval_ms": round(self.interval * 1000, 2),
+            "samples": self.samples,
+            "distinct_stacks": len(self.stacks),
+            "loop_lag_ms": {"p50": pct(0.5), "p99": pct(0.99), "max": pct(1.0)},
+            "slow_callbacks": self.slow_callbacks[:50],
+            "stages": self.stages,
+        }
+
+
+_profile_lock = asyncio.Lock()
+
+
+def profile_running() -> bool:
+    return _profile_lock.locked()
+
+
+async def profile_event_loop(
+    seconds: float,
+    interval_ms: float,
+    slow_callback_ms: float,
+    with_stages: bool = True,
+) -> LoopProfiler:
+    """Profile the current loop; only one profile runs at a time.
+
+    with_stages switches the stage timers on for the duration when they are
+    not already enabled, so the summary carries a per-stage breakdown too.
+    """
+    async with _profile_lock:
+        profiler = LoopProfiler(seconds, interval_ms / 1000, slow_callback_ms / 1000)
+        was_enabled = stage_timer.enabled
+        if with_stages and not was_enabled:
+            stage_timer.reset()
+            stage_timer.enabled = True
+        try:
+            await profiler.run()
+        finally:
+            stage_timer.enabled = was_enabled
+        return profiler
@@ -0,0 +1,39 @@
+import asyncio
+import importlib.util
+from typing import Any, Coroutine
+from app.config import settings
+
+ROLES = ("api", "worker", "both")
+
+
+def service_role() -> str:
+    if settings.service_role not in ROLES:
+        raise ValueError(f"SERVICE_ROLE must be one of {', '.join(ROLES)}, got {settings.service_role!r}")
+    return settings.service_role
+
+
+def runs_consumer() -> bool:
+    return service_role() in ("worker", "both")
+
+
+def _installed(module: str) -> bool:
+    return importlib.util.find_spec(module) is not None
+
+
+def loop_implementation() -> str:
+    """uvicorn --loop value: uvloop when installed (not on Windows) and not disabled."""
+    return "uvloop" if settings.use_uvloop and _installed("uvloop") else "asyncio"
+
+
+def http_implementation() -> str:
+    """uvicorn --http value: the httptools parser when installed, else h11."""
+    return "httptools" if settings.use_uvloop and _installed("httptools") else "h11"
+
+
+def run(main: Coroutine) -> Any:
+    """asyncio.run on uvloop when available."""
+    if loop_implementation() == "uvloop":
+        import uvloop
+
+        return uvloop.run(main)
+    return asyncio.run(main)
@@ -0,0 +1,296 @@
+import asyncio
+import importlib
+import json
+import logging
+import os
+import random
+import secrets
+import time
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
+from contextvars import ContextVar, Token
+from typing import Iterator
+from app.config import settings
+
+# Not get_logger: the log formatter reads the trace context from this module
+logger = logging.getLogger("tracing")
+
+TRACEPARENT_HEADER = "traceparent"
+PUBLISHED_AT_HEADER = "x-published-at"  # epoch ms, set by the publisher for the queue_wait span
+# Spans are written in batches, off the event loop
+FLUSH_SPANS = 200
+FLUSH_SECONDS = 1.0
+
+
+class SpanContext:
+    """One position in a trace: the trace id, the current span id and whether it is exported.
+
+    span_id is None for a fresh trace until its first span starts.
+    """
+
+    __slots__ = ("trace_id", "span_id", "sampled", "attributes")
+
+    def __init__(self, trace_id: str, span_id: str | None = None, sampled: bool = True):
+        self.trace_id = trace_id
+        self.span_id = span_id
+        self.sampled = sampled
+        self.attributes: dict = {}
+
+    @property
+    def traceparent(self) -> str:
+        """W3C trace-context header value."""
+        return f"00-{self.trace_id}-{self.span_id or '0' * 16}-{'01' if self.sampled else '00'}"
+
+
+_current: ContextVar[SpanContext | None] = ContextVar("trace_context", default=None)
+
+
+def parse_traceparent(value: str | bytes | None) -> SpanContext | None:
+    """SpanContext from a traceparent header, or None when it is missing or malformed."""
+    if isinstance(value, bytes):
+        value = value.decode("ascii", "replace")
+    if not value:
+        return None
+    parts = value.strip().lower().split("-")
+    if len(parts) != 4 or len(parts[1]) != 32 or len(parts[2]) != 16 or len(parts[3]) != 2:
+        return None
+    version, trace_id, span_id, flags = parts
+    try:
+        int(trace_id, 16), int(span_id, 16), int(flags, 16)
+    except ValueError:
+        return None
+    if version == "ff" or trace_id == "0" * 32:
+        return None
+    return SpanContext(trace_id, None if span_id == "0" * 16 else span_id, bool(int(flags, 16) & 1))
+
+
+def new_trace(sample_rate: float | None = None) -> SpanContext:
+    rate = settings.trace_sample_rate if sample_rate is None else sample_rate
+    return SpanContext(secrets.token_hex(16), None, exporter is not None and random.random() < rate)
+
+
+def current() -> SpanContext | None:
+    return _current.get()
+
+
+def activate(context: SpanContext | None) -> Token:
+    return _current.set(context)
+
+
+def deactivate(token: Token) -> None:
+    _current.reset(token)
+
+
+def annotate(**attributes) -> None:
+    """Add attributes to the current span (e.g. the request_id once the body is parsed)."""
+    context = _current.get()
+    if context is not None and context.span_id is not None:
+        context.attributes.update(attributes)
+
+
+def inject(headers: dict) -> dict:
+    """Add the current traceparent to outgoing (AMQP/HTTP) headers."""
+    context = _current.get()
+    if context is not None and context.span_id is not None:
+        headers[TRACEPARENT_HEADER] = context.traceparent
+    return headers
+
+
+def extract(headers: dict | None, fallback: str | None = None) -> SpanContext | None:
+    """The remote parent from incoming headers, else from a traceparent carried in the body."""
+    return parse_traceparent((headers or {}).get(TRACEPARENT_HEADER)) or parse_traceparent(fallback)
+
+
+def _emit(context: SpanContext, name: str, parent_id: str | None, start: float, duration: float, error: str | None) -> None:
+    if exporter is None or not context.sampled:
+        return
+    from app.utils.logger import record_context
+
+    record = {
+        "trace_id": context.trace_id,
+        "span_id": context.span_id,
+        "parent_id": parent_id,
+        "name": name,
+        "start": round(start, 6),
+        "duration_ms": round(duration * 1000, 3),
+        "role": settings.service_role,
+        "pid": os.getpid(),
+        "request_id": record_context.request_id,
+    }
+    if context.attributes:
+        record["attributes"] = context.attributes
+    if error:
+        record["error"] = error
+    try:
+        exporter.export(record)
+    except Exception as e:
+        logger.warning({"status": "span_export_failed", "error": str(e)})
+
+
+@contextmanager
+def span(name: str, **attributes) -> Iterator[SpanContext | None]:
+    """Time a block as a child of the current span; it is the current span inside the block.
+
+    Outside of a trace this is a no-op and yields None.
+    """
+    parent = _current.get()
+    if parent is None:
+        yield None
+        return
+    context = SpanContext(parent.trace_id, secrets.token_hex(8), parent.sampled)
+    context.attributes.update(attributes)
+    token = _current.set(context)
+    start, started = time.time(), time.perf_counter()
+    error = None
+    try:
+        yield context
+    except BaseException as e:
+        error = type(e).__name__ if isinstance(e, asyncio.CancelledError) else f"{type(e).__name__}: {e}"
+        raise
+    finally:
+        _current.reset(token)
+        _emit(context, name, parent.span_id, start, time.perf_counter() - started, error)
+
+
+def record_span(name: str, start: float, end: float, **attributes) -> None:
+    """Export a span measured from wall-clock timestamps (e.g. time spent in the broker)."""
+    parent = _current.get()
+    if parent is None:
+        return
+    context = SpanContext(parent.trace_id, secrets.token_hex(8), parent.sampled)
+    context.attributes.update(attributes)
+    _emit(context, name, parent.span_id, start, max(0.0, end - start), None)
+
+
+class SpanExporter(ABC):
+    """Receives finished spans as dicts. export() is called on the event loop and must not block."""
+
+    @abstractmethod
+    def export(self, span: dict) -> None:
+        ...
+
+    async def close(self) -> None:
+        pass
+
+    def stats(self) -> dict:
+        return {}
+
+
+class LogSpanExporter(SpanExporter):
+    def __init__(self):
+        from app.utils.logger import get_logger
+
+        self.logger = get_logger("spans")
+
+    def export(self, span: dict) -> None:
+        self.logger.info({"status": "span", **span})
+
+
+class FileSpanExporter(SpanExporter):
+    """Appends spans as NDJSON; every process of a deployment can share one file."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.exported = 0
+        self._buffer: list[str] = []
+        self._flushed_at = time.monotonic()
+        self._flush_task: asyncio.Task | None = None
+
+    def export(self, span: dict) -> None:
+        self._buffer.append(json.dumps(span, separators=(",", ":"), default=str))
+        self.exported += 1
+        due = len(self._buffer) >= FLUSH_SPANS or time.monotonic() - self._flushed_at >= FLUSH_SECONDS
+        if due and (self._flush_task is None or self._flush_task.done()):
+            try:
+                self._flush_task = asyncio.get_running_loop().create_task(self.flush())
+            except RuntimeError:
+                self._write(self._take())
+
+    def _take(self) -> list[str]:
+        lines, self._buffer = self._buffer, []
+        self._flushed_at = time.monotonic()
+        return lines
+
+    def _write(self, lines: list[str]) -> None:
+        if not lines:
+            return
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        # One write per batch keeps lines from concurrent processes whole (O_APPEND)
+        with open(self.path, "a", encoding="utf-8") as f:
+            f.write("".join(line + "\n" for line in lines))
+
+    async def flush(self) -> None:
+        lines = self._take()
+        if lines:
+            await asyncio.to_thread(self._write, lines)
+
+    async def close(self) -> None:
+        if self._flush_task is not None:
+            await self._flush_task
+        await self.flush()
+
+    def stats(self) -> dict:
+        return {"path": self.path, "exported": self.exported, "buffered": len(self._buffer)}
+
+
+def load_exporter(spec: str) -> SpanExporter | None:
+    """TRACE_EXPORTER: "" / "none", "file" (TRACE_FILE), "log", or "package.module:factory"."""
+    spec = spec.strip()
+    if spec in ("", "none"):
+        return None
+    if spec == "file":
+        return FileSpanExporter(settings.trace_file)
+    if spec == "log":
+        return LogSpanExporter()
+    module, _, attribute = spec.partition(":")
+    if not attribute:
+        raise ValueError(f"TRACE_EXPORTER must be none, file, log or module:factory, got {spec!r}")
+    loaded = getattr(importlib.import_module(module), attribute)()
+    if not isinstance(loaded, SpanExporter):
+        raise TypeError(f"TRACE_EXPORTER {spec!r} returned {type(loaded).__name__}, not a SpanExporter")
+    return loaded
+
+
+exporter: SpanExporter | None = load_exporter(settings.trace_exporter)
+
+
+def set_exporter(new: SpanExporter | None) -> SpanExporter | None:
+    global exporter
+    previous, exporter = exporter, new
+    return previous
+
+
+async def close_exporter() -> None:
+    if exporter is not None:
+        await exporter.close()
+
+
+def read_trace(trace_id: str, path: str | None = None) -> list[dict]:
+    """Every span of one trace from a FileSpanExporter file, in start order."""
+    path = path or settings.trace_file
+    spans: list[dict] = []
+    if not os.path.exists(path):
+        return spans
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            if trace_id not in line:
+                continue
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            if record.get("trace_id") == trace_id:
+                spans.append(record)
+    return sorted(spans, key=lambda record: record["start"])
+
+
+def breakdown(spans: list[dict]) -> dict:
+    """Total milliseconds per span name, plus end-to-end time from the first start to the last end."""
+    if not spans:
+        return {}
+    totals: dict[str, float] = {}
+    for record in spans:
+        totals[record["name"]] = round(totals.get(record["name"], 0.0) + record["duration_ms"], 3)
+    first = min(record["start"] for record in spans)
+    last = max(record["start"] + record["duration_ms"] / 1000 for record in spans)
+    return {"end_to_end_ms": round((last - first) * 1000, 3), "spans": totals}
@@ -0,0 +1,127 @@
+import asyncio
+import hashlib
+import json
+import os
+import random
+import secrets
+import time
+from datetime import datetime, timezone
+from app.config import settings
+from app.utils.logger import get_logger
+
+logger = get_logger("traffic_capture")
+
+CAPTURED_PATHS = ("/send_email",)
+# Lines are written in batches, off the event loop
+FLUSH_LINES = 100
+FLUSH_SECONDS = 1.0
+
+
+class TrafficCapture:
+    """Samples POST /send_email requests into an anonymized NDJSON trace.
+
+    Each line keeps the workload shape and nothing else: arrival time, the
+    response status and latency, subject/body/attachment sizes, priority,
+    tenant and whether the send was scheduled. Addresses, tenants and content
+    are replaced by salted hashes, so the same recipient, domain or content
+    still repeats in the trace (which matters for envelope merging, per
+    recipient ordering and suppression) but cannot be read back.
+    """
+
+    def __init__(self, path: str, sample_rate: float, max_bytes: int, salt: str | None = None):
+        self.path = path
+        self.sample_rate = sample_rate
+        self.max_bytes = max_bytes
+        self.salt = (salt or secrets.token_hex(16)).encode()
+        self.captured = 0
+        self.full = False
+        self._written = os.path.getsize(path) if os.path.exists(path) else 0
+        self._buffer: list[str] = []
+        self._flushed_at = time.monotonic()
+        self._flush_task: asyncio.Task | None = None
+
+    @property
+    def enabled(self) -> bool:
+        return self.sample_rate > 0 and not self.full
+
+    def should_capture(self, method: str, path: str) -> bool:
+        return self.enabled and method == "POST" and path in CAPTURED_PATHS and random.random() < self.sample_rate
+
+    def anonymize(self, value: str, size: int = 6) -> str:
+        return hashlib.blake2b(value.encode("utf-8"), key=self.salt[:64], digest_size=size).hexdigest()
+
+    def entry(self, payload: dict, status: int, seconds: float, tenant: str | None = None) -> dict:
+        to = str(payload.get("to") or "").lower()
+        local, _, domain = to.rpartition("@")
+        subject = str(payload.get("subject") or "")
+        body = str(payload.get("body") or "")
+        attachments = payload.get("attachments") if isinstance(payload.get("attachments"), list) else []
+        send_at_in = None
+        if payload.get("send_at"):
+            try:
+                send_at = datetime.fromisoformat(str(payload["send_at"]).replace("Z", "+00:00"))
+                if send_at.tzinfo is None:
+                    send_at = send_at.replace(tzinfo=timezone.utc)
+                send_at_in = round((send_at - datetime.now(timezone.utc)).total_seconds(), 1)
+            except ValueError:
+                pass
+        return {
+            "ts": round(time.time(), 4),
+            "status": status,
+            "duration_ms": round(seconds * 1000, 2),
+            # Still a valid address, so the trace can be replayed as-is
+            "to": f"{self.anonymize(local)}@{self.anonymize(domain, 4)}.example.com",
+            "subject_len": len(subject),
+            "body_len": len(body),
+            "content": self.anonymize(f"{subject}\0{body}"),
+            "priority": payload.get("priority") or 1,
+            "attachment_bytes": [self._attachment_size(str(digest)) for digest in attachments],
+            "send_at_in": send_at_in,
+            "tenant": self.anonymize(tenant) if tenant else None,
+        }
+
+    @staticmethod
+    def _attachment_size(digest: str) -> int | None:
+        from app.services.content_store import attachment_store
+
+        return attachment_store.size_hint(digest)
+
+    def record(self, payload: dict, status: int, seconds: float, tenant: str | None = None) -> None:
+        self._buffer.append(json.dumps(self.entry(payload, status, seconds, tenant), separators=(",", ":")))
+        self.captured += 1
+        due = len(self._buffer) >= FLUSH_LINES or time.monotonic() - self._flushed_at >= FLUSH_SECONDS
+        if due and (self._flush_task is None or self._flush_task.done()):
+            self._flush_task = asyncio.create_task(self.flush())
+
+    def _write(self, lines: list[str]) -> None:
+        data = "".join(line + "\n" for line in lines)
+        if self._written + len(data) > self.max_bytes:
+            self.full = True
+            logger.warning({"status": "traffic_capture_full", "path": self.path, "max_bytes": self.max_bytes})
+            return
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        with open(self.path, "a", encoding="utf-8") as f:
+            f.write(data)
+        self._written += len(data)
+
+    async def flush(self) -> None:
+        lines, self._buffer = self._buffer, []
+        self._flushed_at = time.monotonic()
+        if lines:
+            await asyncio.to_thread(self._write, lines)
+
+    async def close(self) -> None:
+        if self._flush_task is not None:
+            await self._flush_task
+        await self.flush()
+
+    def stats(self) -> dict:
+        return {"sample_rate": self.sample_rate, "captured": self.captured, "bytes": self._written, "full": self.full}
+
+
+traffic_capture = TrafficCapture(
+    settings.capture_path,
+    settings.capture_sample_rate,
+    settings.capture_max_bytes,
+    settings.capture_salt or None,
+)
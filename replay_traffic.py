@@ -0,0 +1,454 @@
+"""Replay a captured /send_email trace against this build.
+
+Capture with CAPTURE_SAMPLE_RATE (see app/utils/traffic_capture.py), then:
+
+    python replay_traffic.py logs/traffic.ndjson                      # API in-process, 1x
+    python replay_traffic.py logs/traffic.ndjson --speed 10
+    python replay_traffic.py logs/traffic.ndjson --target consumer --speed max --smtp-latency-ms 80
+    python replay_traffic.py logs/traffic.ndjson --target http://localhost:8000 --speed 10
+
+Targets:
+  api       the FastAPI app in-process over httpx.ASGITransport; RabbitMQ is
+            replaced by an in-memory stand-in broker
+  consumer  the delivery path (ConsumerPool -> email_sender -> relay pool)
+            with stand-in SMTP relays
+  <url>     a running deployment over HTTP
+
+Arrivals keep the trace's gaps divided by --speed ("max" = no gaps). Latency
+is measured from each request's scheduled arrival, so a system that falls
+behind shows its queueing delay instead of slowing the replay down. Payloads
+are rebuilt deterministically from the trace (same sizes, and the same text
+wherever the original content repeated), so two builds see identical input.
+"""
+import argparse
+import asyncio
+import hashlib
+import json
+import logging
+import math
+import random
+import sys
+import tempfile
+import time
+from collections import Counter
+from contextlib import ExitStack, asynccontextmanager, contextmanager
+from types import SimpleNamespace
+from aiosmtplib import SMTPResponse
+
+
+def load_trace(path: str) -> list[dict]:
+    """Trace entries sorted by arrival; files from several replicas can be concatenated."""
+    entries = []
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                continue
+            if isinstance(entry, dict) and "ts" in entry and "to" in entry:
+                entries.append(entry)
+    entries.sort(key=lambda entry: entry["ts"])
+    return entries
+
+
+def arrival_offsets(entries: list[dict], speed: float | None) -> list[float]:
+    """Seconds after the start at which each entry is sent; speed None = as fast as possible."""
+    if not entries or not speed:
+        return [0.0] * len(entries)
+    first = entries[0]["ts"]
+    return [(entry["ts"] - first) / speed for entry in entries]
+
+
+def filler(seed: str, length: int) -> str:
+    """Deterministic text of `length` characters; equal seeds give equal text."""
+    if length <= 0:
+        return ""
+    return (seed * (length // len(seed) + 1))[:length]
+
+
+def attachment_blob(seed: str, size: int) -> bytes:
+    return hashlib.shake_256(seed.encode()).digest(size)
+
+
+def payload_for(entry: dict, index: int, attachment_ids: dict[tuple, str]) -> dict:
+    content = entry.get("content") or f"content-{index}"
+    payload = {
+        "to": entry["to"],
+        "subject": filler(f"{content} subject ", entry.get("subject_len", 0)),
+        "body": filler(f"{content} body ", entry.get("body_len", 0)),
+        "request_id": f"replay-{index}",
+        "priority": entry.get("priority") or 1,
+    }
+    attachments = [
+        attachment_ids[(content, i, size)]
+        for i, size in enumerate(entry.get("attachment_bytes") or [])
+        if (content, i, size) in attachment_ids
+    ]
+    if attachments:
+        payload["attachments"] = attachments
+    if entry.get("tenant"):
+        payload["meta"] = {"tenant": entry["tenant"]}
+    return payload
+
+
+def attachment_specs(entries: list[dict]) -> set[tuple]:
+    return {
+        (entry.get("content") or f"content-{index}", i, size)
+        for index, entry in enumerate(entries)
+        for i, size in enumerate(entry.get("attachment_bytes") or [])
+        if size is not None
+    }
+
+
+def percentile(sorted_values: list[float], pct: float) -> float | None:
+    if not sorted_values:
+        return None
+    rank = max(0, min(len(sorted_values) - 1, math.ceil(pct / 100 * len(sorted_values)) - 1))
+    return sorted_values[rank]
+
+
+def distribution(values: list[float]) -> dict:
+    values = sorted(values)
+    return {
+        "p50": percentile(values, 50),
+        "p90": percentile(values, 90),
+        "p99": percentile(values, 99),
+        "max": values[-1] if values else None,
+    }
+
+
+@contextmanager
+def patched(target, **attributes):
+    """Swap module/object attributes for the duration of a replay."""
+    saved = {name: getattr(target, name) for name in attributes}
+    for name, value in attributes.items():
+        setattr(target, name, value)
+    try:
+        yield
+    finally:
+        for name, value in saved.items():
+            setattr(target, name, value)
+
+
+def scratch_stores(stack: ExitStack) -> None:
+    """Swap the attachment and body stores for file stores in a temporary directory."""
+    from app.services import claim_check, content_store, email_sender
+    from app.services.content_store import ContentStore
+
+    scratch = stack.enter_context(tempfile.TemporaryDirectory(prefix="replay-"))
+    attachments = ContentStore(f"{scratch}/attachments")
+    bodies = ContentStore(f"{scratch}/bodies")
+    for module in (content_store, claim_check, email_sender, sys.modules.get("app.main")):
+        if module is not None:
+            stack.enter_context(patched(module, attachment_store=attachments))
+    for module in (claim_check, sys.modules.get("app.main")):
+        if module is not None:
+            stack.enter_context(patched(module, body_store=bodies))
+
+
+class StandInBroker:
+    """Takes the place of publish_message: keeps messages in memory."""
+
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.messages: list[dict] = []
+
+    async def publish(self, message: dict) -> None:
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        self.messages.append(message)
+
+
+class StandInProtocol:
+    """Just enough of SMTPProtocol for mime_stream.stream_data."""
+
+    def __init__(self, smtp: "StandInSMTP"):
+        self.smtp = smtp
+        self._command_lock = asyncio.Lock()
+        self._data_started = False
+
+    def write(self, data: bytes) -> None:
+        self.smtp.bytes_sent += len(data)
+
+    async def _drain_helper(self) -> None:
+        pass
+
+    async def read_response(self, timeout: float | None = None) -> SMTPResponse:
+        self._data_started = not self._data_started
+        if self._data_started:
+            return SMTPResponse(354, "go ahead")
+        await self.smtp.wait()
+        return SMTPResponse(250, "queued")
+
+
+class StandInSMTP:
+    """SMTP relay stand-in with a fixed per-command latency and a failure rate."""
+
+    def __init__(self, stats: Counter, latency: float, failure_rate: float, rng: random.Random):
+        self.stats = stats
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.rng = rng
+        self.bytes_sent = 0
+        self.is_connected = False
+        self.protocol = StandInProtocol(self)
+
+    async def wait(self) -> None:
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+    async def connect(self) -> None:
+        self.stats["connections"] += 1
+        await self.wait()
+        if self.failure_rate and self.rng.random() < self.failure_rate:
+            self.stats["failures"] += 1
+            raise ConnectionError("stand-in relay failure")
+        self.is_connected = True
+
+    async def sendmail(self, sender: str, recipients: list[str], message: bytes) -> None:
+        self.stats["transactions"] += 1
+        self.stats["recipients"] += len(recipients)
+        self.bytes_sent += len(message)
+        await self.wait()
+
+    async def mail(self, sender: str) -> None:
+        self.stats["transactions"] += 1
+        await self.wait()
+
+    async def rcpt(self, recipient: str) -> None:
+        self.stats["recipients"] += 1
+        await self.wait()
+
+    async def data(self, message: bytes) -> None:
+        self.bytes_sent += len(message)
+        await self.wait()
+
+    async def rset(self) -> None:
+        pass
+
+    async def quit(self) -> None:
+        self.stats["data_bytes"] += self.bytes_sent
+        self.is_connected = False
+
+    def close(self) -> None:
+        self.stats["aborted"] += 1
+        self.is_connected = False
+
+
+class StandInMessage:
+    """Broker delivery stand-in; the ack (leaving process()) marks completion."""
+
+    def __init__(self, message: dict, on_ack):
+        self.body = json.dumps(message).encode()
+        self.headers = {"x-tenant": message["tenant"]} if message.get("tenant") else {}
+        self.timestamp = None
+        self.on_ack = on_ack
+
+    @asynccontextmanager
+    async def process(self):
+        try:
+            yield
+        finally:
+            self.on_ack()
+
+
+class StandInChannel:
+    def __init__(self):
+        self.dead_letters: list[bytes] = []
+        self.default_exchange = SimpleNamespace(publish=self._publish)
+
+    async def _publish(self, message, routing_key: str) -> None:
+        self.dead_letters.append(message.body)
+
+
+async def _play(entries: list[dict], speed: float | None, concurrency: int, send) -> tuple[list[float], float]:
+    """Open-loop playback: send(index, entry) runs at each arrival offset; returns latencies (s) and wall time."""
+    offsets = arrival_offsets(entries, speed)
+    latencies: list[float] = [0.0] * len(entries)
+    slots = asyncio.Semaphore(concurrency)
+    started = time.perf_counter()
+
+    async def one(index: int, entry: dict) -> None:
+        due = started + offsets[index]
+        delay = due - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        async with slots:
+            await send(index, entry)
+        latencies[index] = time.perf_counter() - due
+
+    await asyncio.gather(*(one(index, entry) for index, entry in enumerate(entries)))
+    return latencies, time.perf_counter() - started
+
+
+async def replay_http(entries: list[dict], speed: float | None, concurrency: int, base_url: str | None = None, broker_latency: float = 0.0) -> dict:
+    """Replay against the app in-process (base_url None) or a running deployment."""
+    import httpx
+
+    broker = None
+    statuses: Counter = Counter()
+    with ExitStack() as stack:
+        if base_url is None:
+            from app import main
+
+            scratch_stores(stack)
+            broker = StandInBroker(broker_latency)
+            stack.enter_context(patched(main, publish_message=broker.publish))
+            client = httpx.AsyncClient(transport=httpx.ASGITransport(app=main.app), base_url="http://replay")
+        else:
+            client = httpx.AsyncClient(base_url=base_url, limits=httpx.Limits(max_connections=concurrency))
+        async with client:
+            latencies, elapsed = await _play_http(client, entries, speed, concurrency, statuses)
+
+    report = {"outcomes": dict(statuses)}
+    if broker is not None:
+        report["published"] = len(broker.messages)
+    return _report(entries, latencies, elapsed, speed, report)
+
+
+async def _play_http(client, entries: list[dict], speed: float | None, concurrency: int, statuses: Counter) -> tuple[list[float], float]:
+    import httpx
+
+    # Attachments are uploaded up front and not timed
+    attachment_ids = {}
+    for spec in sorted(attachment_specs(entries)):
+        response = await client.post("/attachments", content=attachment_blob(repr(spec), spec[2]))
+        attachment_ids[spec] = response.json()["data"]["attachment_id"]
+
+    async def send(index: int, entry: dict) -> None:
+        try:
+            response = await client.post("/send_email", json=payload_for(entry, index, attachment_ids))
+            statuses[response.status_code] += 1
+        except httpx.HTTPError as e:
+            statuses[type(e).__name__] += 1
+
+    return await _play(entries, speed, concurrency, send)
+
+
+async def replay_consumer(
+    entries: list[dict],
+    speed: float | None,
+    workers: int,
+    smtp_latency: float = 0.05,
+    failure_rate: float = 0.0,
+    seed: int = 0,
+) -> dict:
+    """Feed the trace to a ConsumerPool whose SMTP relays are stand-ins; latency is arrival to ack."""
+    from app.services import email_sender
+    from app.services import content_store
+    from app.services.queue_consumer import ConsumerPool, email_status_store
+    from app.services.queue_publisher import build_message
+
+    rng = random.Random(seed)
+    smtp_stats: Counter = Counter()
+
+    async def open_smtp(relay):
+        smtp = StandInSMTP(smtp_stats, smtp_latency, failure_rate, rng)
+        await smtp.connect()
+        return smtp
+
+    channel = StandInChannel()
+    with ExitStack() as stack:
+        scratch_stores(stack)
+        stack.enter_context(patched(email_sender, _open_smtp=open_smtp))
+        attachment_ids = {}
+        for spec in sorted(attachment_specs(entries)):
+            attachment_ids[spec], _, _ = await content_store.attachment_store.put_bytes(attachment_blob(repr(spec), spec[2]))
+
+        pool = ConsumerPool(channel)
+        pool.resize(workers)
+
+        async def send(index: int, entry: dict) -> None:
+            payload = payload_for(entry, index, attachment_ids)
+            message = build_message(
+                payload["to"],
+                payload["subject"],
+                payload["body"],
+                payload["request_id"],
+                payload["priority"],
+                payload.get("attachments"),
+                tenant=entry.get("tenant"),
+            )
+            acked = asyncio.get_running_loop().create_future()
+            await pool.buffer.put(StandInMessage(message, lambda: acked.done() or acked.set_result(None)))
+            await acked
+
+        try:
+            # The pool's buffer is the queue here, so every arrival is let in
+            latencies, elapsed = await _play(entries, speed, max(1, len(entries)), send)
+        finally:
+            await pool.stop()
+
+    outcomes = Counter(email_status_store.get(f"replay-{index}", "unknown") for index in range(len(entries)))
+    report = {"outcomes": dict(outcomes), "dead_lettered": len(channel.dead_letters), "smtp": dict(smtp_stats)}
+    return _report(entries, latencies, elapsed, speed, report)
+
+
+def _report(entries: list[dict], latencies: list[float], elapsed: float, speed: float | None, extra: dict) -> dict:
+    span = entries[-1]["ts"] - entries[0]["ts"] if entries else 0.0
+    captured = [entry["duration_ms"] for entry in entries if entry.get("duration_ms") is not None]
+    return {
+        "requests": len(entries),
+        "speed": speed or "max",
+        "trace_span_s": round(span, 3),
+        "elapsed_s": round(elapsed, 3),
+        "throughput_rps": round(len(entries) / elapsed, 1) if elapsed > 0 else None,
+        "latency_ms": {k: round(v * 1000, 2) if v is not None else None for k, v in distribution(latencies).items()},
+        "captured_latency_ms": distribution(captured),
+        "scheduled_replayed_immediately": sum(1 for entry in entries if entry.get("send_at_in")),
+        **extra,
+    }
+
+
+def print_report(report: dict) -> None:
+    width = max(len(key) for key in report)
+    for key, value in report.items():
+        if isinstance(value, dict):
+            value = "  ".join(f"{k}={v}" for k, v in value.items())
+        print(f"{key.ljust(width)}  {value}")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Replay a captured /send_email trace.")
+    parser.add_argument("trace", help="NDJSON trace written by the capture middleware")
+    parser.add_argument("--target", default="api", help='"api", "consumer" or a base URL')
+    parser.add_argument("--speed", default="1", help='time compression factor, e.g. 1 or 10, or "max"')
+    parser.add_argument("--limit", type=int, default=0, help="replay only the first N requests")
+    parser.add_argument("--concurrency", type=int, default=200, help="max requests in flight (api / url)")
+    parser.add_argument("--workers", type=int, default=8, help="consumer pool tasks (consumer)")
+    parser.add_argument("--broker-latency-ms", type=float, default=0.0, help="stand-in publish latency (api)")
+    parser.add_argument("--smtp-latency-ms", type=float, default=50.0, help="stand-in SMTP per-command latency (consumer)")
+    parser.add_argument("--smtp-failure-rate", type=float, default=0.0, help="stand-in relay connect failures (consumer)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", action="store_true", help="print the report as JSON")
+    parser.add_argument("--verbose", action="store_true", help="keep the service's own logging")
+    args = parser.parse_args()
+
+    if not args.verbose:
+        logging.disable(logging.WARNING)
+    random.seed(args.seed)
+    speed = None if args.speed == "max" else float(args.speed)
+    entries = load_trace(args.trace)
+    if args.limit:
+        entries = entries[:args.limit]
+    if not entries:
+        raise SystemExit(f"No trace entries in {args.trace}")
+
+    if args.target == "consumer":
+        coro = replay_consumer(
+            entries, speed, args.workers, args.smtp_latency_ms / 1000, args.smtp_failure_rate, args.seed
+        )
+    elif args.target == "api":
+        coro = replay_http(entries, speed, args.concurrency, broker_latency=args.broker_latency_ms / 1000)
+    else:
+        coro = replay_http(entries, speed, args.concurrency, base_url=args.target)
+    report = asyncio.run(coro)
+
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print_report(report)
+
+
+if __name__ == "__main__":
+    main()
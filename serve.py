@@ -0,0 +1,139 @@
+"""Process launcher for the API and worker roles.
+
+    SERVICE_ROLE=api    python serve.py   # API_WORKERS uvicorn processes, no consumers
+    SERVICE_ROLE=worker python serve.py   # WORKER_PROCESSES consumer processes, no HTTP
+    SERVICE_ROLE=both   python serve.py   # API_WORKERS uvicorn processes, each with its consumer
+
+With api + worker, consumers never share an event loop with request handling,
+so SMTP-bound delivery work does not show up in API latency. Each role scales
+on its own: API_WORKERS / API_LIMIT_CONCURRENCY for HTTP, WORKER_PROCESSES and
+the CONSUMER_TASKS_* autoscaler for delivery. uvloop and httptools are used
+when installed (USE_UVLOOP=false turns both off).
+
+Delivery-side signals live in the process that consumes and reach the api
+processes over RabbitMQ fanout exchanges:
+  - STATUS_EVENTS_EXCHANGE: status transitions, for /status and /status/stream
+  - AUTOSCALER_REPORTS_EXCHANGE: each worker's autoscaler sample, from which
+    /scaling, /metrics "consumer" and the admission lag_seconds are computed
+Setting either to "" confines that signal to its process again. Per-delivery
+counters stay local: /metrics tenants, expired, webhooks and the delivery
+stages are zero in an api process.
+
+API_WORKERS processes each claim their own outbox directory (OUTBOX_DIR, then
+OUTBOX_DIR/1, ...) and scheduler node_id, so they never share segment files or
+scheduled-send leases. Slots numbered API_WORKERS and up that no process
+holds (API_WORKERS was lowered) are relayed by whichever process starts next.
+"""
+import multiprocessing
+import os
+import signal
+import threading
+import uvicorn
+from app.config import settings
+from app.services.content_store import check_content_store
+from app.utils.logger import get_logger
+from app.utils.runtime import http_implementation, loop_implementation, service_role
+
+logger = get_logger("serve")
+
+
+def run_worker_process() -> None:
+    import worker
+
+    worker.main()
+
+
+class WorkerSupervisor:
+    """Keeps WORKER_PROCESSES consumer processes running, restarting any that die."""
+
+    def __init__(self, count: int, check_interval: float = 5):
+        self.count = count
+        self.check_interval = check_interval
+        self.processes: list[multiprocessing.Process] = []
+        self._context = multiprocessing.get_context("spawn")
+        self._stopping = threading.Event()
+        self._thread: threading.Thread | None = None
+
+    def _spawn(self, index: int) -> multiprocessing.Process:
+        process = self._context.Process(target=run_worker_process, name=f"email-worker-{index}")
+        process.start()
+        return process
+
+    def _watch(self) -> None:
+        while not self._stopping.wait(self.check_interval):
+            for index, process in enumerate(self.processes):
+                if not process.is_alive() and not self._stopping.is_set():
+                    logger.warning({"status": "worker_restarting", "worker": process.name, "exitcode": process.exitcode})
+                    self.processes[index] = self._spawn(index)
+
+    def start(self) -> None:
+        self.processes = [self._spawn(index) for index in range(self.count)]
+        self._thread = threading.Thread(target=self._watch, name="worker-supervisor", daemon=True)
+        self._thread.start()
+        logger.info({"status": "workers_started", "processes": self.count})
+
+    def wait(self) -> None:
+        signal.signal(signal.SIGTERM, lambda *_: self._stopping.set())
+        self._stopping.wait()
+
+    def stop(self, timeout: float | None = None) -> None:
+        # SIGTERM makes each worker drain its in-flight deliveries; give it the time to
+        timeout = settings.drain_timeout + 10 if timeout is None else timeout
+        self._stopping.set()
+        for process in self.processes:
+            if process.is_alive():
+                process.terminate()
+        for process in self.processes:
+            process.join(timeout)
+
+
+def serve_api(role: str = "api") -> None:
+    # uvicorn's children inherit the environment: with api they start no consumers
+    os.environ["SERVICE_ROLE"] = role
+    settings.service_role = role
+    if settings.api_workers > 1 and settings.outbox_enabled and os.name == "nt":
+        raise SystemExit("OUTBOX_ENABLED needs API_WORKERS=1 on Windows: there is no flock to give each process its own outbox")
+    logger.info({
+        "status": "api_starting",
+        "role": role,
+        "workers": settings.api_workers,
+        "loop": loop_implementation(),
+        "http": http_implementation(),
+    })
+    uvicorn.run(
+        "app.main:app",
+        host=settings.host,
+        port=settings.port,
+        workers=max(1, settings.api_workers),
+        loop=loop_implementation(),
+        http=http_implementation(),
+        limit_concurrency=settings.api_limit_concurrency or None,
+        proxy_headers=True,
+    )
+
+
+def main() -> None:
+    role = service_role()
+    check_content_store(role)
+    if role == "worker" and settings.worker_processes <= 1:
+        run_worker_process()
+        return
+
+    # both keeps the consumer in the API process so its in-process signals stay visible
+    supervisor = WorkerSupervisor(settings.worker_processes) if role == "worker" else None
+    if supervisor:
+        supervisor.start()
+    try:
+        if supervisor:
+            supervisor.wait()
+        else:
+            serve_api(role)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if supervisor:
+            supervisor.stop()
+
+
+if __name__ == "__main__":
+    main()
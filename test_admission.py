@@ -0,0 +1,139 @@
+import asyncio
+import httpx
+import pytest
+import replay_traffic
+from app.services import admission as admission_module
+from app.services.admission import AdmissionController, Rejected
+
+
+@pytest.fixture
+def anyio_backend():
+    return "asyncio"
+
+
+class FakeLoad:
+    def __init__(self, **load):
+        self.load = load
+        self.samples = 0
+
+    async def __call__(self) -> dict:
+        self.samples += 1
+        return dict(self.load)
+
+
+@pytest.mark.anyio
+async def test_priority_limits_keep_transactional_mail_flowing():
+    load = FakeLoad(queue_depth=5_000, outbox_bytes=0, lag_seconds=None)
+    controller = AdmissionController(
+        {"queue_depth": 1_000, "outbox_bytes": 0, "lag_seconds": 60},
+        {2: {"queue_depth": 0}},
+        refresh_interval=60,
+        retry_after=7,
+        sample=load,
+    )
+
+    with pytest.raises(Rejected) as rejected:
+        await controller.admit(1, "bulk-client")
+    assert rejected.value.reason.startswith("queue_depth") and rejected.value.retry_after_header == "7"
+    for _ in range(10):
+        await controller.admit(2, "otp-client")  # no depth limit for priority 2
+    assert load.samples == 1  # one broker sample serves every request until the next refresh
+    assert (controller.admitted, controller.stats()["rejected"]) == (10, {"queue_depth": 1})
+
+
+@pytest.mark.anyio
+async def test_load_view_is_refreshed_in_the_background():
+    load = FakeLoad(queue_depth=5_000)
+    controller = AdmissionController({"queue_depth": 1_000}, refresh_interval=0.05, sample=load)
+    with pytest.raises(Rejected):
+        await controller.admit(1, None)
+
+    load.load["queue_depth"] = 0
+    await asyncio.sleep(0.06)
+    with pytest.raises(Rejected):
+        await controller.admit(1, None)  # serves the cached view and starts a refresh
+    await asyncio.sleep(0)
+    await controller.admit(1, None)
+    assert load.samples == 2
+
+    async def broken() -> dict:
+        raise ConnectionError("broker down")
+
+    controller.sample = broken
+    controller.snapshot = {"queue_depth": 5_000}
+    controller.sampled_at -= 1
+    controller.observed_at["queue_depth"] -= 1
+    await controller.admit(1, None)  # too stale to trust: fail open
+    await asyncio.sleep(0)
+    assert controller.sample_errors == 1
+
+
+@pytest.mark.anyio
+async def test_outbox_limit_sheds_while_the_broker_is_down(monkeypatch):
+    from app.services import queue_publisher
+    from app.services.outbox import outbox
+
+    async def broker_down() -> dict:
+        raise ConnectionError("broker down")
+
+    monkeypatch.setattr(queue_publisher, "queue_depths", broker_down)
+    monkeypatch.setattr(outbox, "log", object())  # enabled
+    monkeypatch.setattr(outbox, "stats", lambda: {"backlog_bytes": 10_000_000})
+    controller = AdmissionController({"queue_depth": 1_000, "outbox_bytes": 1_000_000}, refresh_interval=0.01)
+
+    for _ in range(3):
+        with pytest.raises(Rejected) as rejected:
+            await controller.admit(1, None)
+        await asyncio.sleep(0.02)  # well past STALE_INTERVALS: only the broker signal goes stale
+    assert rejected.value.reason.startswith("outbox_bytes")
+    assert "queue_depth" not in await controller.load() and controller.sample_errors == 0
+
+
+@pytest.mark.anyio
+async def test_send_email_returns_429_with_retry_after(monkeypatch):
+    from app import main
+
+    controller = AdmissionController({"queue_depth": 0}, client_rate=1, client_burst=2, sample=FakeLoad())
+    monkeypatch.setattr(main, "admission", controller)
+    broker = replay_traffic.StandInBroker()
+    with replay_traffic.patched(main, publish_message=broker.publish):
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=main.app), base_url="http://test") as client:
+            payload = {"to": "a@example.com", "subject": "s", "body": "b"}
+            statuses = [
+                (await client.post("/send_email", json=payload, headers={"X-API-Key": "k1"})).status_code
+                for _ in range(3)
+            ]
+            throttled = await client.post("/send_email", json=payload, headers={"X-API-Key": "k1"})
+            other = await client.post("/send_email", json=payload, headers={"X-API-Key": "k2"})
+
+    assert statuses == [200, 200, 429]
+    assert throttled.status_code == 429 and 1 <= int(throttled.headers["retry-after"]) <= 2
+    assert other.status_code == 200
+    assert len(broker.messages) == 3
+    assert admission_module.admission is not controller
+
+
+@pytest.mark.anyio
+async def test_lag_limit_applies_in_an_api_process_from_worker_reports(monkeypatch):
+    from app.services import autoscaler, queue_publisher
+
+    async def queue_depths() -> dict:
+        return {"email.queue.0": 600}
+
+    fleet = autoscaler.FleetScaling(interval=5, origin="api")
+    monkeypatch.setattr(autoscaler, "fleet", fleet)
+    monkeypatch.setattr(autoscaler, "active_autoscaler", None)
+    monkeypatch.setattr(queue_publisher, "queue_depths", queue_depths)
+
+    # The worker drains 5 msg/s: 600 queued is two minutes of lag
+    fleet.record("worker-a", {"queue_depths": {"email.queue.0": 600}, "consume_rate": 5.0, "queue_wait_seconds": 30.0})
+    assert (await admission_module.sample_load())["lag_seconds"] == 120
+
+    # Stuck consumers: nothing is drained, but the head message keeps ageing
+    fleet.record("worker-a", {"queue_depths": {"email.queue.0": 600}, "consume_rate": 0.0, "queue_wait_seconds": 900.0})
+    load = FakeLoad(**await admission_module.sample_load())
+    controller = AdmissionController({"lag_seconds": 0}, {1: {"lag_seconds": 600}}, sample=load)
+    with pytest.raises(Rejected) as rejected:
+        await controller.admit(1, None)
+    assert rejected.value.reason.startswith("lag_seconds 900")
+    await controller.admit(2, None)
@@ -0,0 +1,106 @@
+import email
+import pytest
+from app.services.content_store import ContentStore, ContentTooLarge
+from app.services.mime_stream import READ_CHUNK, dot_stuff, iter_mime_message
+
+
+@pytest.fixture
+def anyio_backend():
+    return "asyncio"
+
+
+@pytest.mark.anyio
+async def test_store_deduplicates_identical_content(tmp_path):
+    store = ContentStore(str(tmp_path))
+    first = await store.put_bytes(b"report", {"filename": "report.txt"})
+    second = await store.put_bytes(b"report", {"filename": "copy.txt"})
+
+    assert first[0] == second[0]
+    assert (first[2], second[2]) == (False, True)
+    assert (await store.metadata(first[0]))["filename"] == "report.txt"
+    assert await store.read_bytes(first[0]) == b"report"
+    assert not await store.exists("../../etc/passwd")
+
+
+@pytest.mark.anyio
+async def test_store_rejects_oversized_stream(tmp_path):
+    store = ContentStore(str(tmp_path))
+
+    async def chunks():
+        yield b"x" * 10
+        yield b"x" * 10
+
+    with pytest.raises(ContentTooLarge):
+        await store.put_stream(chunks(), max_bytes=15)
+    assert list((tmp_path / "tmp").iterdir()) == []
+
+
+@pytest.mark.anyio
+async def test_streamed_mime_round_trips(tmp_path):
+    store = ContentStore(str(tmp_path))
+    payload = bytes(range(256)) * (READ_CHUNK // 100)  # spans several read chunks
+    digest, _, _ = await store.put_bytes(payload, {"filename": "données.bin", "content_type": "application/pdf"})
+
+    raw = b"".join([
+        chunk async for chunk in iter_mime_message(
+            "from@x.com", "to@x.com", "Héllo", "body\n.line", False, [digest], store
+        )
+    ])
+    assert all(not line.startswith(b".") for line in raw.split(b"\r\n"))
+
+    msg = email.message_from_bytes(raw)
+    text, attachment = msg.get_payload()
+    assert text.get_payload(decode=True) == b"body\n.line"
+    assert attachment.get_content_type() == "application/pdf"
+    assert attachment.get_filename() == "données.bin"
+    assert attachment.get_payload(decode=True) == payload
+
+
+@pytest.mark.anyio
+async def test_header_values_cannot_break_lines(tmp_path):
+    store = ContentStore(str(tmp_path))
+    digest, _, _ = await store.put_bytes(b"x", {"filename": 'a"\r\n.\r\nRCPT TO:<evil@x.com>', "content_type": "text/plain\r\nX-Evil: 1"})
+
+    with pytest.raises(ValueError):
+        async for _ in iter_mime_message("from@x.com", "to@x.com", "Hi\r\n.\r\nMAIL FROM:<evil@x.com>", "b", False, [], store):
+            pass
+
+    raw = b"".join([chunk async for chunk in iter_mime_message("from@x.com", "to@x.com", "Hi", "b", False, [digest], store)])
+    assert b"\r\n.\r\n" not in raw and b"X-Evil" not in raw
+    attachment = email.message_from_bytes(raw).get_payload()[1]
+    assert attachment.get_filename() == 'a"\r\n.\r\nRCPT TO:<evil@x.com>'
+    assert attachment.get_content_type() == "application/octet-stream"
+
+
+@pytest.mark.anyio
+async def test_data_stream_is_dot_stuffed():
+    async def chunks():
+        yield b"a\r\n.\r\nMAIL FROM:<evil@x.com>\r\n"
+        yield b".starts a chunk\r\n..two"
+
+    stuffed = b"".join([chunk async for chunk in dot_stuff(chunks())])
+    assert stuffed == b"a\r\n..\r\nMAIL FROM:<evil@x.com>\r\n..starts a chunk\r\n...two\r\n"
+
+
+@pytest.mark.anyio
+async def test_attachment_uploaded_to_the_api_streams_from_a_worker(tmp_path, monkeypatch):
+    import httpx
+    from sqlalchemy.ext.asyncio import async_sessionmaker
+    from app import main
+    from app.db import create_async_db_engine
+    from app.services.content_store import DatabaseContentStore
+
+    engine = create_async_db_engine(f"sqlite:///{tmp_path}/content.db")
+    sessions = async_sessionmaker(bind=engine, expire_on_commit=False)
+    monkeypatch.setattr(main, "attachment_store", DatabaseContentStore("attachments", sessions))
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=main.app), base_url="http://test") as client:
+        response = await client.post("/attachments?filename=report.pdf", content=b"%PDF" * 5_000, headers={"content-type": "application/pdf"})
+    digest = response.json()["data"]["attachment_id"]
+
+    worker_store = DatabaseContentStore("attachments", sessions)
+    raw = b"".join([chunk async for chunk in iter_mime_message(
+        "a@x.com", "b@y.com", "Report", "Attached", False, [digest], worker_store
+    )])
+    part = [p for p in email.message_from_bytes(raw).walk() if p.get_filename()][0]
+    assert part.get_content_type() == "application/pdf" and part.get_payload(decode=True) == b"%PDF" * 5_000
+    await engine.dispose()
@@ -0,0 +1,42 @@
+import asyncio
+import pytest
+from app.services.batch_publisher import BatchPublisher
+
+
+@pytest.fixture
+def anyio_backend():
+    return "asyncio"
+
+
+@pytest.mark.anyio
+async def test_concurrent_submits_are_coalesced_and_results_routed_back():
+    batches: list[int] = []
+
+    async def send_batch(messages):
+        batches.append(len(messages))
+        return [
+            ValueError("rejected") if m["n"] % 50 == 0 else f"ok-{m['n']}"
+            for m in messages
+        ]
+
+    publisher = BatchPublisher(send_batch, linger_ms=5, max_batch=100)
+    results = await asyncio.gather(
+        *(publisher.submit({"n": n}) for n in range(1, 251)), return_exceptions=True
+    )
+
+    assert batches == [100, 100, 50]
+    assert results[0] == "ok-1"
+    assert isinstance(results[49], ValueError)
+    assert publisher.stats()["flushed_full"] == 2
+    assert publisher.stats()["flushed_linger"] == 1
+
+
+@pytest.mark.anyio
+async def test_lone_message_is_sent_after_linger():
+    async def send_batch(messages):
+        return ["done"] * len(messages)
+
+    publisher = BatchPublisher(send_batch, linger_ms=1, max_batch=100)
+
+    assert await publisher.submit({"n": 1}) == "done"
+    assert publisher.stats()["fill_histogram"]["<=0.1"] == 1
@@ -0,0 +1,153 @@
+import asyncio
+import json
+import os
+import time
+from contextlib import asynccontextmanager
+import pytest
+from app.services import claim_check as cc
+from app.services.content_store import ContentStore
+from app.services.queue_consumer import process_message
+
+
+@pytest.fixture
+def anyio_backend():
+    return "asyncio"
+
+
+@pytest.mark.anyio
+async def test_large_bodies_become_fixed_size_references(tmp_path):
+    store = ContentStore(str(tmp_path))
+    small = {"to": "a@x.com", "subject": "s", "body": "short"}
+    assert await cc.claim_check(small, store, threshold=100) is small
+
+    for length in (1_000, 5_000_000):
+        message = await cc.claim_check({"to": "a@x.com", "subject": "s", "body": "x" * length}, store, threshold=100)
+        assert "body" not in message and message["body_ref"]["size"] == length
+        assert len(json.dumps(message)) < 256
+
+
+@pytest.mark.anyio
+async def test_resolve_body_caches_and_verifies(tmp_path, monkeypatch):
+    store = ContentStore(str(tmp_path))
+    cache = cc.BodyCache(max_bytes=3_000)
+    refs = [
+        (await cc.claim_check({"body": ch * 1_000}, store, threshold=10))["body_ref"]
+        for ch in "abcd"
+    ]
+
+    reads = 0
+    original = store.read_bytes
+
+    async def counting_read(digest):
+        nonlocal reads
+        reads += 1
+        await asyncio.sleep(0.01)
+        return await original(digest)
+
+    monkeypatch.setattr(store, "read_bytes", counting_read)
+    bodies = await asyncio.gather(*(cc.resolve_body(refs[0], store, cache) for _ in range(5)))
+    assert bodies == ["a" * 1_000] * 5 and reads == 1
+
+    for ref in refs[1:]:
+        await cc.resolve_body(ref, store, cache)
+    assert cache.bytes == 3_000 and cache.get(refs[0]["id"]) is None  # LRU evicted
+
+    with pytest.raises(ValueError):
+        await cc.resolve_body({**refs[1], "sha256": "0" * 64}, store, cc.BodyCache(10_000))
+
+
+class FakeMessage:
+    def __init__(self, payload: dict):
+        self.body = json.dumps(payload).encode()
+
+    @asynccontextmanager
+    async def process(self):
+        yield
+
+
+@pytest.mark.anyio
+async def test_consumer_resolves_body_reference(tmp_path, monkeypatch):
+    store = ContentStore(str(tmp_path))
+    monkeypatch.setattr(cc, "body_store", store)
+    message = await cc.claim_check({"to": "a@x.com", "subject": "s", "body": "<p>" * 500, "request_id": "r1"}, store, threshold=100)
+    sent = []
+
+    async def fake_send_email(recipient, subject, body, attachments=None):
+        sent.append(body)
+
+    monkeypatch.setattr("app.services.queue_consumer.send_email", fake_send_email)
+    await process_message(None, FakeMessage(message))
+    assert sent == ["<p>" * 500]
+
+
+@pytest.mark.anyio
+async def test_blobs_are_swept_once_no_message_can_still_use_them(tmp_path, monkeypatch):
+    from datetime import datetime, timedelta, timezone
+
+    bodies, attachments = ContentStore(str(tmp_path / "bodies"), retention=60), ContentStore(str(tmp_path / "files"), retention=60)
+    monkeypatch.setattr(cc, "body_store", bodies)
+    monkeypatch.setattr(cc, "attachment_store", attachments)
+    monkeypatch.setattr(cc.settings, "content_retention_seconds", 60)
+    attachment, _, _ = await attachments.put_bytes(b"file", {"filename": "a.txt"})
+    message = await cc.claim_check({"body": "x" * 100, "attachments": [attachment]}, threshold=10)
+    body = message["body_ref"]["id"]
+    now = time.time()
+
+    assert await bodies.sweep(now + 30) == 0
+    assert await bodies.sweep(now + 120) == 1 and not await bodies.exists(body)
+    assert await attachments.sweep(now + 120) == 1 and not os.path.exists(attachments.path(attachment) + ".json")
+
+    # A scheduled send, and a deduplicated upload, push the deadline out; nothing pulls it back in
+    message = await cc.claim_check({"body": "x" * 100, "attachments": [attachment]}, threshold=10)
+    attachment, _, _ = await attachments.put_bytes(b"file")
+    await cc.retain_content(message, send_at=datetime.now(timezone.utc) + timedelta(hours=1))
+    await cc.retain_content(message, expires_at=datetime.now(timezone.utc) + timedelta(minutes=5))
+    assert await bodies.sweep(now + 3600) == 0 and await attachments.sweep(now + 3600) == 0
+    assert await bodies.sweep(now + 3700) == 1 and await attachments.sweep(now + 3700) == 1
+
+
+@pytest.mark.anyio
+async def test_database_store_is_shared_across_processes(tmp_path):
+    from sqlalchemy.ext.asyncio import async_sessionmaker
+    from app.db import create_async_db_engine
+    from app.services.content_store import DatabaseContentStore
+
+    engine = create_async_db_engine(f"sqlite:///{tmp_path}/content.db")
+    sessions = async_sessionmaker(bind=engine, expire_on_commit=False)
+    # The API process writes, a worker process (its own store object) reads
+    api, worker = (DatabaseContentStore("bodies", sessions, retention=60, chunk_bytes=1000) for _ in range(2))
+    data = bytes(range(256)) * 20
+
+    digest, size, deduplicated = await api.put_bytes(data, {"content_type": "application/octet-stream"})
+    assert (size, deduplicated) == (len(data), False)
+    assert (await api.put_bytes(data))[2] is True
+    assert await worker.exists(digest) and worker.size_hint(digest) == len(data)
+    assert (await worker.metadata(digest))["content_type"] == "application/octet-stream"
+    assert [len(chunk) for chunk in [c async for c in worker.iter_chunks(digest, 1500)]] == [1500, 1500, 1500, 620]
+    assert await worker.read_bytes(digest) == data
+    assert not await DatabaseContentStore("attachments", sessions).exists(digest)  # stores do not see each other
+
+    message = await cc.claim_check({"body": "x" * 100}, api, threshold=10)
+    assert await cc.resolve_body(message["body_ref"], worker, cc.BodyCache(1_000)) == "x" * 100
+
+    await worker.retain(digest, time.time() + 3600)
+    now = time.time()
+    assert await api.sweep(now + 120) == 1  # only the claim-checked body
+    assert await api.sweep(now + 3700) == 1 and not await worker.exists(digest)
+    with pytest.raises(FileNotFoundError):
+        await worker.read_bytes(digest)
+    await engine.dispose()
+
+
+def test_file_store_is_refused_for_split_roles_unless_shared(monkeypatch):
+    from app.services.content_store import check_content_store
+
+    monkeypatch.setattr(cc.settings, "content_store", "file")
+    check_content_store("both")
+    with pytest.raises(RuntimeError, match="CONTENT_DIR_SHARED"):
+        check_content_store("api")
+    monkeypatch.setattr(cc.settings, "content_dir_shared", True)
+    check_content_store("worker")
+    monkeypatch.setattr(cc.settings, "content_store", "database")
+    monkeypatch.setattr(cc.settings, "content_dir_shared", False)
+    check_content_store("worker")
@@ -0,0 +1,103 @@
+import asyncio
+import pytest
+from aiosmtplib import SMTPConnectError, SMTPDataError, SMTPRecipientRefused, SMTPRecipientsRefused, SMTPResponseException
+from app.services.concurrency import AdaptiveConcurrencyLimiter, is_recipient_rejection, is_temporary_rejection
+
+
+@pytest.fixture
+def anyio_backend():
+    return "asyncio"
+
+
+def test_only_4xx_replies_are_temporary_rejections():
+    for code in (421, 450, 451, 452):
+        assert is_temporary_rejection(SMTPResponseException(code, "try again later"))
+    assert is_temporary_rejection(SMTPDataError(451, "local error"))
+    assert is_temporary_rejection(SMTPRecipientsRefused([SMTPRecipientRefused(452, "mailbox full", "a@example.com")]))
+
+    for error in (
+        SMTPResponseException(250, "ok"),
+        SMTPResponseException(550, "no such user"),
+        SMTPRecipientsRefused([SMTPRecipientRefused(550, "no such user", "a@example.com")]),
+        SMTPConnectError("connection refused"),
+        TimeoutError(),
+    ):
+        assert not is_temporary_rejection(error)
+
+    assert is_recipient_rejection(SMTPRecipientRefused(550, "no such user", "a@example.com"))
+    assert not is_recipient_rejection(SMTPRecipientRefused(450, "greylisted", "a@example.com"))
+
+
+@pytest.mark.anyio
+async def test_limit_grows_additively_while_used_and_halves_on_rejection():
+    limiter = AdaptiveConcurrencyLimiter(initial=4, min_limit=1, max_limit=100)
+    limiter.in_flight = 3  # using the limit: successes grow it by 1/limit each
+    for _ in range(4):
+        limiter.on_success(0.1)
+    assert 4.9 < limiter.limit < 5.0 and int(limiter.limit) == 4
+
+    limiter.in_flight = 0  # idle slots: no growth
+    limiter.on_success(0.1)
+    assert 4.9 < limiter.limit < 5.0
+
+    limiter.on_rejection()
+    assert 2.4 < limiter.limit < 2.5 and limiter.stats()["temporary_rejections"] == 1
+
+    with pytest.raises(SMTPResponseException):
+        async with limiter.slot():
+            raise SMTPResponseException(421, "too many connections")
+    assert int(limiter.limit) == 1 and limiter.in_flight == 0
+
+    with pytest.raises(SMTPResponseException):
+        async with limiter.slot():
+            raise SMTPResponseException(550, "no such user")  # permanent: the limit is untouched
+    assert int(limiter.limit) == 1
+
+
+def test_rising_latency_trims_the_limit_once_per_rtt(monkeypatch):
+    from types import SimpleNamespace
+    from app.services import concurrency
+
+    now = 0.0
+    monkeypatch.setattr(concurrency, "time", SimpleNamespace(monotonic=lambda: now))
+    limiter = AdaptiveConcurrencyLimiter(initial=10, min_limit=1, max_limit=100, tolerance=2.0)
+    limiter.on_success(0.1)
+    # A burst of slow completions within one RTT: all started under the same limit
+    for _ in range(20):
+        limiter.on_success(1.0)
+    assert limiter.latency_backoffs == 1 and limiter.limit == 9
+
+    now += limiter.smoothed_rtt
+    limiter.on_success(1.0)
+    assert limiter.latency_backoffs == 2 and round(limiter.limit, 2) == 8.1
+
+
+@pytest.mark.anyio
+async def test_limit_stays_between_the_floor_and_the_ceiling():
+    assert AdaptiveConcurrencyLimiter(initial=50, min_limit=2, max_limit=8).limit == 8
+    assert AdaptiveConcurrencyLimiter(initial=0, min_limit=2, max_limit=8).limit == 2
+
+    limiter = AdaptiveConcurrencyLimiter(initial=3, min_limit=2, max_limit=4)
+    for _ in range(5):
+        limiter.on_rejection()
+    assert limiter.limit == 2
+
+    limiter.in_flight = 4
+    for _ in range(50):
+        limiter.on_success(0.1)
+    assert limiter.limit == 4
+
+    limiter.in_flight = 0
+    entered = 0
+
+    async def hold():
+        nonlocal entered
+        async with limiter.slot():
+            entered += 1
+            await asyncio.sleep(0.05)
+
+    tasks = [asyncio.create_task(hold()) for _ in range(6)]
+    await asyncio.sleep(0.01)
+    assert entered == 4 and limiter.in_flight == 4  # the ceiling caps in-flight transactions
+    await asyncio.gather(*tasks)
+    assert entered == 6 and limiter.in_flight == 0
@@ -0,0 +1,109 @@
+import asyncio
+import json
+import random
+from contextlib import asynccontextmanager
+import pytest
+from app.services.autoscaler import ConsumerAutoscaler
+from app.services.queue_consumer import ConsumerPool
+
+
+@pytest.fixture
+def anyio_backend():
+    return "asyncio"
+
+
+class FakeMessage:
+    def __init__(self, payload: dict):
+        self.body = json.dumps(payload).encode()
+        self.headers = {}
+
+    @asynccontextmanager
+    async def process(self):
+        yield
+
+
+@pytest.mark.anyio
+async def test_pool_keeps_per_recipient_order_across_tasks(monkeypatch):
+    sent: list[tuple[str, int]] = []
+
+    async def fake_send_email(recipient, subject, body, attachments=None):
+        await asyncio.sleep(random.random() / 200)
+        sent.append((recipient, int(body)))
+
+    monkeypatch.setattr("app.services.queue_consumer.send_email", fake_send_email)
+
+    pool = ConsumerPool(channel=None)
+    pool.resize(8)
+    for seq in range(30):
+        for user in ("a", "b", "c"):
+            await pool.buffer.put(FakeMessage({"to": f"{user}@x.com", "subject": "s", "body": str(seq)}))
+
+    while pool.processed < 90:
+        await asyncio.sleep(0.01)
+    pool.resize(2)
+    assert len(pool.workers) == 2
+    await pool.stop()
+
+    for user in ("a", "b", "c"):
+        assert [seq for to, seq in sent if to == f"{user}@x.com"] == list(range(30))
+
+
+class FakePool:
+    def __init__(self, target):
+        self.target = target
+        self.processed = 0
+        self.last_pickup = None
+
+    def resize(self, target):
+        self.target = target
+
+
+def test_autoscaler_grows_with_backlog_and_shrinks_gradually(monkeypatch):
+    from app.config import settings
+    monkeypatch.setattr(settings, "consumer_tasks_min", 1)
+    monkeypatch.setattr(settings, "consumer_tasks_max", 16)
+    monkeypatch.setattr(settings, "autoscale_target_drain_seconds", 60)
+
+    pool = FakePool(2)
+    scaler = ConsumerAutoscaler(pool, connection=None, consume_channel=None, queue_names=["email.queue"])
+
+    # First sample: backlog but no throughput data yet -> double
+    assert scaler.plan(depth=6000, consumers=1, elapsed=5) == 4
+    pool.target = 4
+
+    # 4 tasks processed 200 msgs in 5s -> 10 msg/s per task; need 6000/60 = 100 msg/s on top
+    pool.processed = 200
+    tasks = scaler.plan(depth=6000, consumers=1, elapsed=5)
+    assert tasks == 14
+    assert scaler.stats()["desired_replicas"] == 1
+
+    # Backlog gone -> step down by one per tick
+    pool.target = tasks
+    pool.processed = 400
+    assert scaler.plan(depth=0, consumers=1, elapsed=5) == 13
+
+
+def test_fleet_scaling_adds_up_worker_reports(monkeypatch):
+    from app.services.autoscaler import FleetScaling
+
+    fleet = FleetScaling(interval=5, target_drain=60, origin="api")
+
+    def report(depth: int, queue: str) -> dict:
+        return {"queue_depths": {queue: depth}, "queue_consumers": 2, "consume_rate": 10.0, "per_task_rate": 5.0, "tasks": 2, "max_tasks": 4}
+
+    fleet.record("worker-a", report(600, "email.queue.0"), now=0)
+    fleet.record("worker-b", report(600, "email.queue.1"), now=0)
+    # 20 msg/s consumed, 1200 to drain in 60s: 40 msg/s at 5 per task = 8 tasks = 2 workers of 4
+    stats = fleet.stats(now=1)
+    assert (stats["workers"], stats["queue_depth"], stats["consume_rate"], stats["desired_replicas"]) == (2, 1200, 20.0, 2)
+
+    # Each queue grows by 60 msg/s: 140 msg/s arrive, 170 msg/s drains 1800 in 60s = 34 tasks
+    fleet.record("worker-a", report(900, "email.queue.0"), now=5)
+    fleet.record("worker-b", report(900, "email.queue.1"), now=5)
+    stats = fleet.stats(now=6)
+    assert (stats["queue_depth"], stats["arrival_rate"], stats["desired_replicas"]) == (1800, 140.0, 9)
+
+    # This process's own consumer counts too; silent workers drop out
+    local = report(100, "email.queue.2")
+    assert fleet.stats(local, now=6)["workers"] == 3
+    assert fleet.stats(now=100) == {"enabled": False}
@@ -0,0 +1,125 @@
+import pytest
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import async_sessionmaker
+from app.db import DBStats, async_database_url, create_async_db_engine, session_scope
+from datetime import date, datetime, timedelta, timezone
+from app.config import settings
+from app.models import Base, EmailStatus, EmailStatusEnum
+from app.services import status_store
+
+
+@pytest.fixture
+def anyio_backend():
+    return "asyncio"
+
+
+def test_async_url_mapping():
+    assert async_database_url("postgresql://u:p@db:5432/x") == "postgresql+asyncpg://u:p@db:5432/x"
+    assert async_database_url("sqlite:///local.db") == "sqlite+aiosqlite:///local.db"
+
+
+@pytest.mark.anyio
+async def test_sqlite_stand_in_round_trip_records_stats(tmp_path):
+    stats = DBStats()
+    engine = create_async_db_engine(f"sqlite:///{tmp_path}/status.db", stats=stats)
+    factory = async_sessionmaker(bind=engine, expire_on_commit=False)
+
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+
+    async with session_scope(factory, stats) as session:
+        session.add(EmailStatus(request_id="req-1", to_email="a@example.com", subject="Hi", meta={"k": "v"}))
+        await session.commit()
+
+    async with session_scope(factory, stats) as session:
+        row = (await session.execute(select(EmailStatus).where(EmailStatus.request_id == "req-1"))).scalar_one()
+
+    await engine.dispose()
+
+    assert row.status == EmailStatusEnum.queued
+    assert row.meta == {"k": "v"}
+    assert stats.checkouts == 2
+    assert stats.queries >= 2
+    assert stats.snapshot()["query_max_ms"] > 0
+
+
+def test_partition_names_roll_over_years():
+    assert status_store.partition_name(date(2025, 12, 1)) == "email_status_2025_12"
+    assert status_store.partition_name(date(2025, 12, 1), "email_body") == "email_body_2025_12"
+    assert status_store._add_months(date(2025, 12, 1), 1) == date(2026, 1, 1)
+    assert status_store._add_months(date(2026, 1, 1), -6) == date(2025, 7, 1)
+
+
+@pytest.mark.anyio
+async def test_keyset_pages_and_offloaded_bodies(tmp_path, monkeypatch):
+    monkeypatch.setattr(settings, "status_offload_body", True)
+    engine = create_async_db_engine(f"sqlite:///{tmp_path}/keyset.db", stats=DBStats())
+    factory = async_sessionmaker(bind=engine, expire_on_commit=False)
+    async with engine.begin() as conn:
+        await status_store.create_status_schema(conn)
+
+    async with factory() as session:
+        for i in range(5):
+            await status_store.record_email(session, f"req-{i}", "same@example.com", "s", f"body-{i}")
+
+        first, cursor = await status_store.list_by_recipient(session, "same@example.com", limit=3)
+        second, end = await status_store.list_by_recipient(session, "same@example.com", after=cursor, limit=3)
+        latest = await status_store.get_status(session, "req-4", since=datetime.now(timezone.utc) - timedelta(days=1))
+        body = await status_store.get_body(session, latest)
+
+    await engine.dispose()
+
+    assert [r.request_id for r in first + second] == [f"req-{i}" for i in range(4, -1, -1)]
+    assert end is None
+    assert latest.body is None and body == "body-4"
+
+
+@pytest.mark.anyio
+async def test_reused_request_ids_keep_their_own_row_and_body(tmp_path, monkeypatch):
+    monkeypatch.setattr(settings, "status_offload_body", True)
+    engine = create_async_db_engine(f"sqlite:///{tmp_path}/wired.db", stats=DBStats())
+    factory = async_sessionmaker(bind=engine, expire_on_commit=False)
+    monkeypatch.setattr(status_store, "session_scope", lambda: session_scope(factory))
+    async with engine.begin() as conn:
+        await status_store.create_status_schema(conn)
+
+    first = {"to": "a@example.com", "subject": "s", "body": "first", "request_id": "otp"}
+    second = {**first, "body": "second"}
+    await status_store.record_message(first, EmailStatusEnum.pending)
+    await status_store.record_message(second, EmailStatusEnum.scheduled)
+    await status_store.record_final_status(second, EmailStatusEnum.delivered)
+    await status_store.record_final_status({"request_id": "otp"}, EmailStatusEnum.failed)  # no row stamp: ignored
+
+    async with factory() as session:
+        rows = list((await session.execute(select(EmailStatus).order_by(EmailStatus.created_at))).scalars())
+        bodies = [await status_store.get_body(session, row) for row in rows]
+    await engine.dispose()
+
+    assert [row.status for row in rows] == [EmailStatusEnum.pending, EmailStatusEnum.delivered]
+    assert bodies == ["first", "second"]
+
+
+@pytest.mark.anyio
+async def test_status_row_of_a_message_that_was_not_queued_is_failed(tmp_path, monkeypatch):
+    import httpx
+    from app import main
+
+    engine = create_async_db_engine(f"sqlite:///{tmp_path}/send.db", stats=DBStats())
+    factory = async_sessionmaker(bind=engine, expire_on_commit=False)
+    monkeypatch.setattr(settings, "status_store_enabled", True)
+    monkeypatch.setattr(status_store, "session_scope", lambda: session_scope(factory))
+    monkeypatch.setattr(main, "session_scope", lambda: session_scope(factory))
+    async with engine.begin() as conn:
+        await status_store.create_status_schema(conn)
+
+    async def broker_down(message):
+        raise ConnectionError("broker down")
+
+    monkeypatch.setattr(main, "publish_message", broker_down)
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=main.app), base_url="http://test") as client:
+        response = await client.post("/send_email", json={"to": "a@example.com", "subject": "s", "body": "b", "request_id": "lost-1"})
+        status = await client.post("/status", json={"request_id": "lost-1"})
+    await engine.dispose()
+
+    assert response.status_code == 500
+    assert status.json() == {"request_id": "lost-1", "status": "failed"}
@@ -0,0 +1,172 @@
+import asyncio
+import base64
+import email
+import hashlib
+import re
+import pytest
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import padding, rsa
+from app.config import settings
+from app.services import dkim
+from app.services.content_store import ContentStore
+from app.services.dkim import DkimSigner, RelaxedBodyHasher, body_hash, canonical_header, parse_headers, split_message
+from app.services.mime_stream import iter_signed_mime_message
+from app.services.render_pool import RenderPool, render_message
+
+HEADERS = "from:to:subject:date:message-id:mime-version:content-type".split(":")
+
+
+@pytest.fixture
+def anyio_backend():
+    return "asyncio"
+
+
+@pytest.fixture(scope="module")
+def key():
+    return rsa.generate_private_key(public_exponent=65537, key_size=2048)
+
+
+@pytest.fixture
+def pem(key):
+    return key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8, serialization.NoEncryption())
+
+
+# An independent relaxed/relaxed verifier, written from RFC 6376 rather than from app.services.dkim,
+# so a canonicalization bug shared by the signer and the verifier cannot pass unnoticed
+
+def relaxed_header(field: bytes) -> bytes:
+    name, _, value = field.partition(b":")
+    value = re.sub(rb"[ \t]+", b" ", value.replace(b"\r\n", b""))  # unfold, then compress WSP
+    return name.strip().lower() + b":" + value.strip(b" ") + b"\r\n"
+
+
+def relaxed_body(body: bytes) -> bytes:
+    lines = [re.sub(rb"[ \t]+", b" ", line).rstrip(b" ") for line in body.split(b"\r\n")]
+    while lines and not lines[-1]:
+        lines.pop()
+    return b"".join(line + b"\r\n" for line in lines)
+
+
+def header_fields(message: bytes) -> tuple[list[bytes], bytes]:
+    head, _, body = message.partition(b"\r\n\r\n")
+    fields: list[bytes] = []
+    for line in head.split(b"\r\n"):
+        if line[:1] in (b" ", b"\t"):
+            fields[-1] += b"\r\n" + line
+        else:
+            fields.append(line)
+    return fields, body
+
+
+def verify(message: bytes, public_key) -> None:
+    fields, body = header_fields(message)
+    signature = fields[0]
+    assert signature.lower().startswith(b"dkim-signature:")
+    tags = dict(
+        tag.split(b"=", 1) for tag in re.sub(rb"\s+", b"", signature.partition(b":")[2]).split(b";") if tag
+    )
+    assert (tags[b"v"], tags[b"a"], tags[b"c"]) == (b"1", b"rsa-sha256", b"relaxed/relaxed")
+    assert tags[b"bh"] == base64.b64encode(hashlib.sha256(relaxed_body(body)).digest())
+
+    # h= names are matched from the bottom of the header up
+    remaining = fields[1:]
+    signed = b""
+    for name in tags[b"h"].split(b":"):
+        for index in range(len(remaining) - 1, -1, -1):
+            if remaining[index].partition(b":")[0].strip().lower() == name.lower():
+                signed += relaxed_header(remaining.pop(index))
+                break
+    unsigned = re.sub(rb"(;\s*b\s*=)[^;]*", rb"\1", signature)
+    signed += relaxed_header(unsigned).removesuffix(b"\r\n")
+    public_key.verify(base64.b64decode(tags[b"b"]), signed, padding.PKCS1v15(), hashes.SHA256())
+
+
+def test_canonical_forms_of_a_fixed_message():
+    message = (
+        b"From: News <news@example.com>\r\n"
+        b"Subject:  Hello \r\n\t  World \r\n"
+        b"\r\n"
+        b"Hi  there \t\r\n"
+        b"\r\n"
+        b"Bye\r\n"
+        b"\r\n"
+        b"\r\n"
+    )
+    header_block, body = split_message(message)
+    assert [canonical_header(*header) for header in parse_headers(header_block)] == [
+        "from:News <news@example.com>\r\n",
+        "subject:Hello World\r\n",
+    ]
+    # sha256 of "Hi there\r\n\r\nBye\r\n"
+    assert body_hash(body) == "nWBrUz3hEPmPYMV36chZ/B6xeIiOX9mpMwESN7XynZA="
+    assert body_hash(b"\r\n\r\n") == "47DEQpj8HBSa+/TImW+5JCeuQeRkm5NMpJWZG3hSuFU="  # empty body
+
+
+def test_signature_verifies_with_dkimpy(key, pem):
+    dkimpy = pytest.importorskip("dkim")
+    public = key.public_key().public_bytes(serialization.Encoding.DER, serialization.PublicFormat.SubjectPublicKeyInfo)
+    record = b"v=DKIM1; k=rsa; p=" + base64.b64encode(public)
+
+    def dns(name, timeout=5):
+        return record if name == b"mail._domainkey.example.com." else None
+
+    signer = DkimSigner("example.com", "mail", pem, HEADERS)
+    message = signer.sign(render_message({"from": "news@example.com", "to": "a@x.com", "subject": "Hi  there", "body": "Body \t \n\n\n"}))
+    assert dkimpy.verify(message, dnsfunc=dns)
+
+
+def test_relaxed_body_canonicalization_is_chunk_independent():
+    body = b" C \r\nD \t E\r\n\r\n\r\n"
+    expected = base64.b64encode(hashlib.sha256(b" C\r\nD E\r\n").digest()).decode()
+    assert body_hash(body) == expected
+
+    hasher = RelaxedBodyHasher()
+    for i in range(len(body)):
+        hasher.update(body[i:i + 1])
+    assert hasher.digest() == expected
+
+
+def test_rendered_message_is_signed(key, pem):
+    signer = DkimSigner("example.com", "mail", pem, HEADERS)
+    message = signer.sign(render_message({
+        "from": "news@example.com", "to": "a@x.com", "subject": "Ünïcode  subject", "body": "<p>Hi \t there</p>\n" * 50, "html": True,
+    }))
+    verify(message, key.public_key())
+    parsed = email.message_from_bytes(message)
+    assert parsed["DKIM-Signature"] and parsed["Message-ID"].endswith("@example.com>")
+
+
+@pytest.mark.anyio
+async def test_streamed_message_signature_covers_the_second_pass(tmp_path, key, pem):
+    signer = DkimSigner("example.com", "mail", pem, HEADERS)
+    store = ContentStore(str(tmp_path))
+    digest, _, _ = await store.put_bytes(b"\x00\x01attachment" * 10_000, metadata={"filename": "a.bin"})
+
+    async def sign(header_block, bh):
+        return signer.signature(header_block, bh)
+
+    chunks = [chunk async for chunk in iter_signed_mime_message(
+        "news@example.com", "a@x.com", "Report", "See attached", False, [digest], store, sign
+    )]
+    verify(b"".join(chunks), key.public_key())
+
+
+@pytest.mark.anyio
+async def test_process_pool_renders_and_signs_in_batches(monkeypatch, key, pem):
+    monkeypatch.setenv("DKIM_DOMAIN", "example.com")
+    monkeypatch.setenv("DKIM_SELECTOR", "mail")
+    monkeypatch.setenv("DKIM_PRIVATE_KEY", pem.decode())
+    monkeypatch.setattr(settings, "dkim_domain", "example.com")
+    monkeypatch.setattr(settings, "dkim_selector", "mail")
+    monkeypatch.setattr(settings, "dkim_private_key", pem.decode())
+    dkim.get_signer.cache_clear()
+    pool = RenderPool(processes=1, batch_size=8, linger_ms=5)
+    try:
+        spec = {"from": "news@example.com", "to": "a@x.com", "subject": "Hi", "body": "Body", "html": False}
+        messages = await asyncio.gather(*(pool.render(dict(spec, to=f"u{i}@x.com")) for i in range(16)))
+        for message in messages:
+            verify(message, key.public_key())
+        assert pool.stats()["render"]["batches"] == 2
+    finally:
+        pool.close()
+        dkim.get_signer.cache_clear()
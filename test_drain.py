@@ -0,0 +1,73 @@
+import asyncio
+import json
+from contextlib import asynccontextmanager
+import pytest
+from app.services import queue_consumer
+from app.services.queue_consumer import ConsumerPool
+
+
+@pytest.fixture
+def anyio_backend():
+    return "asyncio"
+
+
+class FakeMessage:
+    def __init__(self, index: int):
+        self.body = json.dumps({"to": f"user{index}@example.com", "subject": "s", "body": "b", "request_id": f"drain-{index}"}).encode()
+        self.headers = {}
+        self.timestamp = None
+        self.acked = False
+        self.requeued = False
+
+    @asynccontextmanager
+    async def process(self):
+        yield
+        self.acked = True
+
+    async def nack(self, requeue: bool = True):
+        self.requeued = requeue
+
+
+@pytest.fixture
+def slow_send(monkeypatch):
+    sent = []
+
+    async def send_email(recipient, subject, body, attachments=None):
+        await asyncio.sleep(0.1)
+        sent.append(recipient)
+
+    monkeypatch.setattr(queue_consumer, "send_email", send_email)
+    return sent
+
+
+async def started_pool(messages: list[FakeMessage], workers: int) -> ConsumerPool:
+    pool = ConsumerPool(channel=None)
+    pool.resize(workers)
+    for message in messages:
+        await pool.buffer.put(message)
+    while pool.in_flight < workers:
+        await asyncio.sleep(0.001)
+    return pool
+
+
+@pytest.mark.anyio
+async def test_drain_finishes_in_flight_and_requeues_the_rest(slow_send):
+    messages = [FakeMessage(index) for index in range(5)]
+    pool = await started_pool(messages, workers=2)
+
+    result = await pool.drain(timeout=2)
+
+    assert result == {"requeued": 3, "finished": 2, "cut_off": 0}
+    assert len(slow_send) == 2 and not pool.workers
+    assert [message.acked for message in messages] == [True, True, False, False, False]
+    assert [message.requeued for message in messages] == [False, False, True, True, True]
+
+
+@pytest.mark.anyio
+async def test_drain_cuts_off_at_the_deadline(slow_send):
+    pool = await started_pool([FakeMessage(index) for index in range(2)], workers=2)
+
+    result = await pool.drain(timeout=0.01)
+
+    assert result == {"requeued": 0, "finished": 0, "cut_off": 2}
+    assert slow_send == [] and not pool.workers
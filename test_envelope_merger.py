@@ -0,0 +1,110 @@
+import asyncio
+from types import SimpleNamespace
+import pytest
+from aiosmtplib import SMTPRecipientRefused
+from app.services import email_sender
+from app.services.envelope_merger import EnvelopeMerger, merge_key
+
+
+@pytest.fixture
+def anyio_backend():
+    return "asyncio"
+
+
+def test_merge_key_splits_by_domain_and_content():
+    base = merge_key("a@x.com", "Hi", "Body", None)
+    assert merge_key("b@X.com", "Hi", "Body", None) == base
+    assert merge_key("a@y.com", "Hi", "Body", None) != base
+    assert merge_key("a@x.com", "Hi", "Body!", None) != base
+    assert merge_key("a@x.com", "Hi", "Body", ["f" * 64]) != base
+
+
+@pytest.mark.anyio
+async def test_identical_messages_share_one_transaction():
+    calls = []
+
+    async def send_group(recipients, subject, body, attachments=None):
+        calls.append(list(recipients))
+        return {r: (r != "bad@x.com", None if r != "bad@x.com" else "550 no such user") for r in recipients}
+
+    merger = EnvelopeMerger(send_group, linger_ms=5, max_recipients=3)
+    recipients = ["a@x.com", "bad@x.com", "c@x.com", "d@x.com", "e@y.com"]
+    results = await asyncio.gather(*(merger.send(r, "Launch", "Same body") for r in recipients))
+
+    assert sorted(map(sorted, calls)) == [["a@x.com", "bad@x.com", "c@x.com"], ["d@x.com"], ["e@y.com"]]
+    assert results[1] == (False, "550 no such user")
+    assert all(ok for i, (ok, _) in enumerate(results) if i != 1)
+    assert merger.stats()["transactions"] == 3
+
+
+class FakeSMTP:
+    """Refuses perm@x.com with 550 and temp@x.com with 451 on the first attempt."""
+
+    attempts = 0
+
+    def __init__(self, log):
+        self.log = log
+        self.is_connected = True
+
+    async def mail(self, sender):
+        FakeSMTP.attempts += 1
+
+    async def rcpt(self, recipient):
+        if recipient == "perm@x.com" or (recipient == "temp@x.com" and FakeSMTP.attempts == 1):
+            code = 550 if recipient == "perm@x.com" else 451
+            raise SMTPRecipientRefused(code, "refused", recipient)
+        self.log.append(("rcpt", recipient))
+
+    async def data(self, message):
+        self.log.append(("data", b"undisclosed-recipients" in message))
+
+    async def sendmail(self, sender, recipients, message):
+        self.log.append(("sendmail", recipients, b"undisclosed-recipients" in message))
+
+    async def rset(self):
+        pass
+
+    async def quit(self):
+        self.is_connected = False
+
+    def close(self):
+        self.log.append("closed")
+        self.is_connected = False
+
+
+@pytest.mark.anyio
+async def test_group_send_maps_rcpt_results_and_retries_deferred(monkeypatch):
+    log = []
+    FakeSMTP.attempts = 0
+
+    async def open_smtp(relay):
+        return FakeSMTP(log)
+
+    async def no_sleep(_):
+        pass
+
+    monkeypatch.setattr(email_sender, "_open_smtp", open_smtp)
+    monkeypatch.setattr(email_sender, "asyncio", SimpleNamespace(sleep=no_sleep))
+    results = await email_sender.send_email_group_async(
+        ["ok@x.com", "perm@x.com", "temp@x.com", "not-an-address"], "Hi", "Body"
+    )
+
+    assert results["ok@x.com"] == (True, None)
+    assert results["perm@x.com"][0] is False and "refused" in results["perm@x.com"][1]
+    assert results["temp@x.com"] == (True, None)
+    assert results["not-an-address"] == (False, "Invalid email address format")
+    assert log == [("rcpt", "ok@x.com"), ("data", True), ("rcpt", "temp@x.com"), ("data", True)]
+
+
+@pytest.mark.anyio
+async def test_group_of_one_is_sent_with_its_real_to_header(monkeypatch):
+    log = []
+
+    async def open_smtp(relay):
+        return FakeSMTP(log)
+
+    monkeypatch.setattr(email_sender, "_open_smtp", open_smtp)
+    results = await email_sender.send_email_group_async(["ok@x.com", "ok@x.com"], "Hi", "Body")
+
+    assert results == {"ok@x.com": (True, None)}
+    assert log == [("sendmail", ["ok@x.com"], False)]
@@ -0,0 +1,66 @@
+from datetime import datetime, timedelta, timezone
+import httpx
+import pytest
+import replay_traffic
+from app.config import settings
+from app.services import queue_consumer
+from app.services.queue_publisher import build_message, is_expired
+
+
+@pytest.fixture
+def anyio_backend():
+    return "asyncio"
+
+
+def delivery(message: dict):
+    return replay_traffic.StandInMessage(message, lambda: None)
+
+
+@pytest.mark.anyio
+@pytest.mark.parametrize("action", ["drop", "dead_letter"])
+async def test_expired_messages_are_shed_before_sending(monkeypatch, action):
+    monkeypatch.setattr(settings, "expired_action", action)
+    monkeypatch.setattr(queue_consumer, "expired_counts", queue_consumer.Counter())
+    sent = []
+
+    async def fake_send_email(recipient, subject, body, attachments=None):
+        sent.append(recipient)
+
+    monkeypatch.setattr(queue_consumer, "send_email", fake_send_email)
+    now = datetime.now(timezone.utc)
+    stale = build_message("otp@example.com", "Code", "123456", "otp-1", expires_at=now - timedelta(seconds=1))
+    fresh = build_message("otp@example.com", "Code", "654321", "otp-2", expires_at=now + timedelta(minutes=5))
+    channel = replay_traffic.StandInChannel()
+
+    await queue_consumer.process_message(channel, delivery(stale), stale)
+    await queue_consumer.process_message(channel, delivery(fresh), fresh)
+
+    assert sent == ["otp@example.com"]
+    assert queue_consumer.email_status_store["otp-1"] == "expired"
+    assert queue_consumer.email_status_store["otp-2"] == "delivered"
+    if action == "drop":
+        assert queue_consumer.expired_stats() == {"action": "drop", "dropped": 1}
+        assert channel.dead_letters == []
+    else:
+        assert queue_consumer.expired_stats() == {"action": "dead_letter", "dead_lettered": 1}
+        assert len(channel.dead_letters) == 1
+
+
+@pytest.mark.anyio
+async def test_send_email_sets_the_earlier_deadline():
+    from app import main
+
+    broker = replay_traffic.StandInBroker()
+    later = (datetime.now(timezone.utc) + timedelta(hours=1)).isoformat()
+    with replay_traffic.patched(main, publish_message=broker.publish):
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=main.app), base_url="http://test") as client:
+            ok = await client.post("/send_email", json={"to": "a@example.com", "subject": "s", "body": "b", "ttl": 60, "expires_at": later})
+            no_deadline = await client.post("/send_email", json={"to": "a@example.com", "subject": "s", "body": "b"})
+            past = await client.post("/send_email", json={"to": "a@example.com", "subject": "s", "body": "b", "expires_at": "2000-01-01T00:00:00Z"})
+
+    assert (ok.status_code, no_deadline.status_code, past.status_code) == (200, 200, 400)
+    expires_at = datetime.fromisoformat(broker.messages[0]["expires_at"])
+    assert timedelta(seconds=50) < expires_at - datetime.now(timezone.utc) <= timedelta(seconds=60)
+    assert "expires_at" not in broker.messages[1]
+    assert not is_expired(broker.messages[0])
+    assert is_expired(broker.messages[0], now=expires_at)
@@ -0,0 +1,86 @@
+import asyncio
+from collections import Counter
+import pytest
+from app.config import settings
+from app.services import tenants
+from app.services.fair_queue import FairBuffer
+
+
+@pytest.fixture
+def anyio_backend():
+    return "asyncio"
+
+
+def make_buffer(weights: dict, caps: dict | None = None) -> FairBuffer:
+    return FairBuffer(
+        tenant_of=lambda item: item[0],
+        weight_of=lambda tenant: weights.get(tenant, 1),
+        cap_of=lambda tenant: (caps or {}).get(tenant, 0),
+    )
+
+
+@pytest.mark.anyio
+async def test_small_tenant_is_not_stuck_behind_a_bulk_import():
+    buffer = make_buffer({"bulk": 1, "shop": 1})
+    for i in range(1000):
+        await buffer.put(("bulk", i))
+    for i in range(5):
+        await buffer.put(("shop", i))
+
+    order = []
+    for _ in range(10):
+        tenant, item = await buffer.get()
+        order.append(tenant)
+        await buffer.done(tenant)
+    assert order.count("shop") == 5
+    assert buffer.lanes["bulk"].items[0][1] == ("bulk", 5)
+
+
+@pytest.mark.anyio
+async def test_dispatch_follows_weights_and_caps():
+    buffer = make_buffer({"gold": 3, "free": 1}, caps={"free": 1})
+    for i in range(400):
+        await buffer.put(("gold", i))
+        await buffer.put(("free", i))
+
+    served = Counter()
+    for _ in range(400):
+        tenant, _ = await buffer.get()
+        served[tenant] += 1
+        await buffer.done(tenant, service_seconds=0.01)
+    assert served["gold"] == 300 and served["free"] == 100
+
+    # free already has one delivery in flight: only gold is handed out
+    tenant, _ = await buffer.get()
+    while tenant != "free":
+        await buffer.done(tenant)
+        tenant, _ = await buffer.get()
+    held = [await buffer.get() for _ in range(5)]
+    assert {t for t, _ in held} == {"gold"}
+
+    waiter = asyncio.create_task(buffer.get())
+    for t, _ in held:
+        await buffer.done(t)
+    stats = buffer.stats()
+    assert stats["free"]["in_flight"] == 1 and stats["free"]["backlog"] > 0
+    waiter.cancel()
+
+
+def test_api_keys_replace_meta_tenant(monkeypatch):
+    monkeypatch.setattr(settings, "tenant_api_keys", '{"k-acme": "acme"}')
+    monkeypatch.setattr(settings, "tenants", '{"acme": {"weight": 4}, "bulk": {"weight": 1}}')
+    tenants.api_key_tenants.cache_clear()
+    tenants.tenant_config.cache_clear()
+    try:
+        assert tenants.resolve_tenant({"tenant": "bulk"}, "k-acme") == "acme"
+        assert tenants.resolve_tenant({"tenant": "acme"}, None) == tenants.DEFAULT_TENANT
+        assert tenants.resolve_tenant({"tenant": "acme"}, "unknown") == tenants.DEFAULT_TENANT
+        monkeypatch.setattr(settings, "tenant_api_keys", "")
+        tenants.api_key_tenants.cache_clear()
+        assert tenants.resolve_tenant({"tenant": "bulk"}, None) == "bulk"
+        assert tenants.tenant_queue_name("acme") == "email.queue.tenant.acme"
+        assert tenants.tenant_queue_name("someone-else") is None
+        assert tenants.tenant_weight("acme") == 4
+    finally:
+        tenants.api_key_tenants.cache_clear()
+        tenants.tenant_config.cache_clear()
@@ -0,0 +1,151 @@
+import asyncio
+import os
+import pytest
+from app.config import settings
+from app.services.outbox import Outbox, SegmentLog
+
+
+@pytest.fixture
+def anyio_backend():
+    return "asyncio"
+
+
+@pytest.mark.anyio
+async def test_concurrent_appends_share_fsyncs(tmp_path):
+    log = SegmentLog(str(tmp_path), segment_bytes=1024, group_commit_ms=1)
+    log.start()
+
+    await asyncio.gather(*(log.append(f"record-{i}".encode()) for i in range(100)))
+    await asyncio.gather(*(log.append(f"record-{i}".encode()) for i in range(100, 200)))
+    records, _ = await log.read((0, 0), limit=1000)
+    await log.close()
+
+    assert [r.decode() for r in records] == [f"record-{i}" for i in range(200)]
+    assert log.fsyncs < log.appends
+    assert len(log.segments()) > 1  # rolled over at 1 KiB
+
+
+@pytest.mark.anyio
+async def test_failed_write_is_cut_back_before_the_next_append(tmp_path, monkeypatch):
+    log = SegmentLog(str(tmp_path), segment_bytes=1 << 20, group_commit_ms=0)
+    log.start()
+    await log.append(b"first")
+    fsync = os.fsync
+
+    def failing_fsync(fd):
+        raise OSError("disk full")
+
+    monkeypatch.setattr(os, "fsync", failing_fsync)  # the bytes are written, the fsync fails
+    with pytest.raises(OSError):
+        await log.append(b"lost")
+    monkeypatch.setattr(os, "fsync", fsync)
+    await log.append(b"second")
+    records, position = await log.read((0, 0), limit=10)
+    await log.close()
+
+    assert records == [b"first", b"second"]
+    assert position == (0, log.committed) == (0, os.path.getsize(os.path.join(tmp_path, "000000000000.log")))
+
+
+@pytest.mark.anyio
+async def test_torn_tail_is_truncated_on_reopen(tmp_path):
+    log = SegmentLog(str(tmp_path), segment_bytes=1 << 20, group_commit_ms=0)
+    log.start()
+    await log.append(b"complete")
+    await log.close()
+
+    with open(os.path.join(tmp_path, "000000000000.log"), "ab") as f:
+        f.write(b"\x10\x00\x00\x00garbage")
+
+    reopened = SegmentLog(str(tmp_path), segment_bytes=1 << 20, group_commit_ms=0)
+    records, _ = await reopened.read((0, 0), limit=10)
+    await reopened.close()
+
+    assert records == [b"complete"]
+
+
+@pytest.mark.anyio
+async def test_relay_replays_unconfirmed_records_after_restart(tmp_path, monkeypatch):
+    monkeypatch.setattr(settings, "outbox_dir", str(tmp_path))
+    published: list[dict] = []
+    broker_up = False
+
+    async def fake_publish_batch(messages):
+        if not broker_up:
+            return [ConnectionError("broker down")] * len(messages)
+        published.extend(messages)
+        return ["email.queue"] * len(messages)
+
+    monkeypatch.setattr("app.services.queue_publisher.publish_batch", fake_publish_batch)
+
+    first = Outbox()
+    await first.start()
+    for i in range(5):
+        await first.append({"to": f"u{i}@example.com", "request_id": f"r{i}"})
+    await first.stop()
+    assert published == []
+
+    broker_up = True
+    second = Outbox()
+    await second.start()
+    for _ in range(100):
+        if len(published) == 5:
+            break
+        await asyncio.sleep(0.02)
+    await second.stop()
+
+    assert [m["request_id"] for m in published] == [f"r{i}" for i in range(5)]
+    with open(os.path.join(tmp_path, "checkpoint")) as f:
+        assert f.read().split() != ["0", "0"]
+    assert second.relayed == 5
+
+
+@pytest.mark.anyio
+async def test_processes_sharing_outbox_dir_get_their_own_slot(tmp_path, monkeypatch):
+    monkeypatch.setattr(settings, "outbox_dir", str(tmp_path))
+    published: list[dict] = []
+
+    async def fake_publish_batch(messages):
+        published.extend(messages)
+        return ["email.queue"] * len(messages)
+
+    monkeypatch.setattr("app.services.queue_publisher.publish_batch", fake_publish_batch)
+    first, second = Outbox(), Outbox()
+    await first.start()
+    await second.start()
+    assert (first.directory, second.directory) == (str(tmp_path), os.path.join(tmp_path, "1"))
+    await first.append({"request_id": "a"})
+    await second.append({"request_id": "b"})
+    await first.stop()
+    await second.stop()
+    assert sorted(message["request_id"] for message in published) == ["a", "b"]
+
+    third = Outbox()
+    await third.start()  # the slot freed by the first process is taken over
+    assert third.directory == str(tmp_path)
+    await third.stop()
+
+
+@pytest.mark.anyio
+async def test_slots_left_above_api_workers_are_drained_on_start(tmp_path, monkeypatch):
+    monkeypatch.setattr(settings, "outbox_dir", str(tmp_path))
+    monkeypatch.setattr(settings, "api_workers", 2)
+    published: list[dict] = []
+
+    async def fake_publish_batch(messages):
+        published.extend(messages)
+        return ["email.queue"] * len(messages)
+
+    monkeypatch.setattr("app.services.queue_publisher.publish_batch", fake_publish_batch)
+    # Written by a third API worker before API_WORKERS went from 3 to 2
+    orphan = SegmentLog(os.path.join(tmp_path, "2"), segment_bytes=1 << 20, group_commit_ms=0)
+    orphan.start()
+    await orphan.append(b'{"request_id": "left-behind"}')
+    await orphan.close()
+
+    outbox = Outbox()
+    await outbox.start()
+    assert await asyncio.wait_for(outbox._orphans, 5) == 1
+    assert published == [{"request_id": "left-behind"}]
+    assert await outbox.drain_orphans() == 0  # checkpointed: nothing is relayed twice
+    await outbox.stop()
@@ -0,0 +1,51 @@
+import asyncio
+import time
+import pytest
+from app.utils.profiling import StageTimings, profile_event_loop, stage_timer
+
+
+@pytest.fixture
+def anyio_backend():
+    return "asyncio"
+
+
+def test_stage_timer_is_noop_when_disabled():
+    timings = StageTimings(enabled=False)
+    with timings("smtp.connect"):
+        pass
+    assert timings.stats()["stages"] == {}
+
+    timings.enabled = True
+    for _ in range(3):
+        with timings("smtp.connect"):
+            time.sleep(0.001)
+    stage = timings.stats()["stages"]["smtp.connect"]
+    assert stage["count"] == 3 and stage["max_ms"] >= 1
+
+
+def blocking_handler():
+    time.sleep(0.08)
+
+
+@pytest.mark.anyio
+async def test_profile_reports_blocking_callback_and_stacks():
+    async def workload():
+        await asyncio.sleep(0.05)
+        with stage_timer("test.block"):
+            blocking_handler()
+
+    task = asyncio.create_task(workload())
+    profiler = await profile_event_loop(seconds=0.3, interval_ms=2, slow_callback_ms=50)
+    await task
+
+    summary = profiler.summary()
+    assert summary["samples"] > 0
+    assert summary["loop_lag_ms"]["max"] >= 50
+    assert summary["slow_callbacks"] and summary["slow_callbacks"][0]["duration_ms"] >= 50
+    assert summary["stages"]["test.block"]["count"] == 1
+    assert not stage_timer.enabled
+
+    folded = profiler.collapsed()
+    assert "test_profiling.py:blocking_handler" in folded
+    stack, count = folded.splitlines()[0].rsplit(" ", 1)
+    assert int(count) > 0 and ";" in stack
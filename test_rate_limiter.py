@@ -0,0 +1,80 @@
+import asyncio
+import time
+import pytest
+from app.services.rate_limiter import DistributedRateLimiter
+
+
+@pytest.fixture
+def anyio_backend():
+    return "asyncio"
+
+
+class FakeRedis:
+    """Stand-in for the Lua token bucket, shared by several limiters."""
+
+    def __init__(self):
+        self.state: dict[str, tuple[float, float]] = {}
+        self.calls = 0
+        self.down = False
+
+    def register_script(self, source):
+        async def script(keys, args):
+            if self.down:
+                raise ConnectionError("redis unavailable")
+            self.calls += 1
+            rate, burst, requested = float(args[0]), float(args[1]), int(args[2])
+            now = time.monotonic() * 1000
+            tokens, ts = self.state.get(keys[0], (burst, now))
+            tokens = min(burst, tokens + max(0, now - ts) * rate / 1000)
+            granted = min(requested, int(tokens))
+            tokens -= granted
+            self.state[keys[0]] = (tokens, now)
+            wait = 0 if granted else int((min(requested, burst) - tokens) * 1000 / rate) + 1
+            return [granted, wait]
+
+        return script
+
+
+async def _count_for(limiters, seconds):
+    counts = [0] * len(limiters)
+
+    async def run(index, limiter):
+        while True:
+            await limiter.acquire()
+            counts[index] += 1
+
+    tasks = [asyncio.create_task(run(i, l)) for i, l in enumerate(limiters)]
+    await asyncio.sleep(seconds)
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    return counts
+
+
+@pytest.mark.anyio
+async def test_replicas_share_one_global_budget_with_leased_tokens():
+    redis = FakeRedis()
+    replicas = [
+        DistributedRateLimiter(rate=200, burst=20, lease=5, key="k", client=redis)
+        for _ in range(3)
+    ]
+
+    counts = await _count_for(replicas, 0.5)
+
+    # burst + 0.5s * 200/s, regardless of the number of replicas
+    assert 90 <= sum(counts) <= 140
+    assert redis.calls < sum(counts)
+
+
+@pytest.mark.anyio
+async def test_falls_back_to_local_share_when_redis_is_down():
+    redis = FakeRedis()
+    redis.down = True
+    limiter = DistributedRateLimiter(rate=100, burst=10, lease=5, key="k", client=redis, fallback_replicas=2)
+
+    counts = await _count_for([limiter], 0.3)
+
+    # Local share is 50/s with a burst of 5
+    assert 10 <= counts[0] <= 30
+    assert limiter.stats()["degraded"] is True
+    assert limiter.redis_errors == 1
@@ -0,0 +1,116 @@
+import json
+from collections import Counter
+from types import SimpleNamespace
+import pytest
+from aiosmtplib import SMTPRecipientRefused, SMTPRecipientsRefused, SMTPServerDisconnected
+from app.services import email_sender
+from app.services.relay_router import RelayRouter, load_relays
+
+
+@pytest.fixture
+def anyio_backend():
+    return "asyncio"
+
+
+def make_router(*specs):
+    return RelayRouter(load_relays(json.dumps([{"host": f"{name}.example", "name": name, "weight": w} for name, w in specs])))
+
+
+def test_pick_follows_weight_latency_and_health():
+    router = make_router(("a", 3), ("b", 1))
+    counts = Counter(router.pick().name for _ in range(4000))
+    assert 2700 < counts["a"] < 3300
+
+    # b becomes 6x faster than a -> it now wins despite the lower weight
+    a, b = router.relays
+    a.record_success(0.6)
+    b.record_success(0.1)
+    counts = Counter(router.pick().name for _ in range(4000))
+    assert counts["b"] > counts["a"]
+
+    for _ in range(3):
+        b.record_failure(SMTPServerDisconnected("gone"))
+    assert not b.healthy()
+    assert {router.pick().name for _ in range(50)} == {"a"}
+    assert router.pick(exclude={"a"}) is None
+
+
+class FakeSMTP:
+    def __init__(self, relay, log, fail):
+        self.relay, self.log, self.fail = relay, log, fail
+        self.is_connected = True
+
+    async def sendmail(self, sender, recipients, message):
+        if self.relay.name in self.fail:
+            raise self.fail[self.relay.name]
+        self.log.append(self.relay.name)
+
+    async def quit(self):
+        self.is_connected = False
+
+    def close(self):
+        self.log.append("closed")
+        self.is_connected = False
+
+
+async def send_via(monkeypatch, router, fail):
+    log = []
+
+    async def open_smtp(relay):
+        return FakeSMTP(relay, log, fail)
+
+    async def no_sleep(_):
+        pass
+
+    monkeypatch.setattr(email_sender, "relay_router", router)
+    monkeypatch.setattr(email_sender, "_open_smtp", open_smtp)
+    monkeypatch.setattr(email_sender, "asyncio", SimpleNamespace(sleep=no_sleep))
+    result = await email_sender.send_email_async("to@x.com", "Hi", "Body")
+    return result, log
+
+
+@pytest.mark.anyio
+async def test_send_fails_over_to_next_relay_in_same_attempt(monkeypatch):
+    router = make_router(("a", 1), ("b", 1))
+    result, log = await send_via(monkeypatch, router, {"a": SMTPServerDisconnected("down")})
+    assert result == (True, None)
+    assert log[-1] == "b"
+    # A failover happened exactly when a was picked first, and its connection was closed, not leaked
+    assert router.failovers == router.relays[0].errors == log.count("closed")
+
+
+@pytest.mark.anyio
+async def test_bad_recipient_is_not_retried_or_failed_over(monkeypatch):
+    router = make_router(("a", 1), ("b", 1))
+    refused = SMTPRecipientsRefused([SMTPRecipientRefused(550, "no such user", "to@x.com")])
+    result, log = await send_via(monkeypatch, router, {"a": refused, "b": refused})
+    assert result[0] is False and log == ["closed"]
+    assert sum(r.sent for r in router.relays) == 1 and router.failovers == 0
+
+
+@pytest.mark.anyio
+async def test_relay_quota_is_charged_every_recipient(monkeypatch):
+    router = RelayRouter(load_relays(json.dumps([{"host": "a.example", "name": "a", "rate": 5}])))
+    bucket = router.relays[0].bucket
+    charged = []
+    original = bucket.try_acquire
+
+    def try_acquire(tokens=1):
+        wait = original(tokens)
+        if not wait:
+            charged.append(tokens)
+        return wait
+
+    monkeypatch.setattr(bucket, "try_acquire", try_acquire)
+    monkeypatch.setattr(bucket, "rate", 1000)  # refill fast so the test does not wait
+    monkeypatch.setattr(email_sender, "relay_router", router)
+
+    async def transaction(smtp):
+        return "sent"
+
+    async def open_smtp(relay):
+        return FakeSMTP(relay, [], {})
+
+    monkeypatch.setattr(email_sender, "_open_smtp", open_smtp)
+    assert (await email_sender._run_on_relays(transaction, tokens=12))[0] == "sent"
+    assert charged == [5, 5, 2]
@@ -0,0 +1,61 @@
+import pytest
+from app import main
+from app.config import settings
+from app.utils.runtime import http_implementation, loop_implementation, runs_consumer
+
+
+@pytest.fixture
+def anyio_backend():
+    return "asyncio"
+
+
+def test_roles_decide_who_consumes(monkeypatch):
+    for role, consumes in (("api", False), ("worker", True), ("both", True)):
+        monkeypatch.setattr(settings, "service_role", role)
+        assert runs_consumer() is consumes
+    monkeypatch.setattr(settings, "service_role", "web")
+    with pytest.raises(ValueError):
+        runs_consumer()
+
+
+def test_uvloop_can_be_turned_off(monkeypatch):
+    monkeypatch.setattr(settings, "use_uvloop", False)
+    assert (loop_implementation(), http_implementation()) == ("asyncio", "h11")
+
+
+@pytest.mark.anyio
+async def test_api_role_starts_no_consumer_but_listens_to_the_workers(monkeypatch):
+    import asyncio
+
+    started, listening = [], []
+
+    async def start_consumer():
+        started.append(True)
+
+    def listener(name):
+        async def run(open_channel):
+            listening.append(name)
+        return run
+
+    monkeypatch.setattr(settings, "service_role", "api")
+    monkeypatch.setattr(settings, "status_retention_enabled", False)
+    monkeypatch.setattr(main, "start_consumer", start_consumer)
+    monkeypatch.setattr(main.status_bus, "run", listener("status_events"))
+    monkeypatch.setattr(main.fleet, "run", listener("autoscaler_reports"))
+    await main.on_startup()
+    await asyncio.sleep(0)
+    assert started == []
+    # Status transitions, /scaling and the admission lag come from the worker processes
+    assert sorted(listening) == ["autoscaler_reports", "status_events"]
+    assert (await main.health_check())["role"] == "api"
+
+
+def test_both_role_serves_consumers_in_process(monkeypatch):
+    import serve
+
+    served, supervised = [], []
+    monkeypatch.setattr(settings, "service_role", "both")
+    monkeypatch.setattr(serve, "serve_api", served.append)
+    monkeypatch.setattr(serve.WorkerSupervisor, "start", lambda self: supervised.append(self))
+    serve.main()
+    assert served == ["both"] and supervised == []
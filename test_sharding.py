@@ -0,0 +1,137 @@
+from app.services.sharding import HashRing, route, shard_queue_name
+from app.config import settings
+
+
+def test_ring_is_deterministic_and_covers_all_shards():
+    ring = HashRing(4)
+    keys = [f"user{i}@example.com" for i in range(2000)]
+    assignments = [ring.shard_for(key) for key in keys]
+
+    assert assignments == [HashRing(4).shard_for(key) for key in keys]
+    assert set(assignments) == {0, 1, 2, 3}
+
+
+def test_adding_a_shard_moves_only_a_fraction_of_keys():
+    keys = [f"user{i}@example.com" for i in range(5000)]
+    before = HashRing(4)
+    after = HashRing(5)
+
+    moved = sum(1 for key in keys if before.shard_for(key) != after.shard_for(key))
+
+    # Ideal is 1/5 of the keys; a naive modulo hash would move ~4/5
+    assert moved / len(keys) < 0.35
+
+
+def test_route_keeps_recipient_on_one_shard():
+    exchange, key_a = route("Alice@Example.com", "req-1", count=8)
+    _, key_b = route("alice@example.com", "req-2", count=8)
+
+    assert exchange == settings.email_shard_exchange
+    assert key_a == key_b
+    assert key_a.startswith(f"{settings.email_queue_name}.shard.")
+
+
+def test_single_shard_uses_legacy_queue():
+    assert route("bob@example.com", "req-3", count=1) == ("", settings.email_queue_name)
+    assert shard_queue_name(0, 1) == settings.email_queue_name
+
+
+def test_email_queues_dead_letter_into_a_declared_exchange():
+    import asyncio
+    from types import SimpleNamespace
+    from app.services.sharding import declare_email_queues
+
+    class RecordingChannel:
+        def __init__(self):
+            self.exchanges, self.queues, self.bindings = {}, {}, []
+
+        async def declare_exchange(self, name, type, durable=False):
+            self.exchanges[name] = type
+            return SimpleNamespace(name=name)
+
+        async def declare_queue(self, name, durable=False, arguments=None):
+            self.queues[name] = arguments or {}
+
+            async def bind(exchange, routing_key=None):
+                self.bindings.append((exchange.name, name))
+
+            return SimpleNamespace(name=name, bind=bind)
+
+    channel = RecordingChannel()
+    asyncio.run(declare_email_queues(channel, count=1))
+
+    dlx = channel.queues[settings.email_queue_name]["x-dead-letter-exchange"]
+    assert channel.exchanges[dlx] == "fanout"
+    assert (dlx, settings.dead_letter_queue_name) in channel.bindings
+
+
+def test_migration_needs_consumers_and_publishers_stopped():
+    import asyncio
+    import json
+    from datetime import datetime, timezone
+    from types import SimpleNamespace
+    import aio_pika
+    import pytest
+    from app.services.setup_queues import migrate_shards
+
+    class BrokerChannel:
+        """In-memory queues; publisher_running keeps writing to the old layout while it is drained."""
+
+        def __init__(self, queues, consumers=None, publisher_running=False):
+            self.queues, self.consumers, self.publisher_running = queues, consumers or {}, publisher_running
+            self.deleted = []
+            self.default_exchange = SimpleNamespace(publish=self.publish)
+
+        async def publish(self, message, routing_key):
+            self.queues.setdefault(routing_key, []).append(message)
+
+        async def declare_queue(self, name, passive=False):
+            result = SimpleNamespace(message_count=len(self.queues[name]), consumer_count=self.consumers.get(name, 0))
+
+            async def get(fail=True):
+                message = self.queues[name].pop(0)
+                if self.publisher_running:
+                    self.queues[name].append(message)
+
+                async def ack():
+                    pass
+
+                properties = {key: getattr(message, key) for key in message.info() if hasattr(message, key)}
+                return SimpleNamespace(**{**properties, "body": message.body, "ack": ack})
+
+            return SimpleNamespace(declaration_result=result, get=get)
+
+        async def queue_delete(self, name, if_empty=False):
+            self.deleted.append(name)
+
+    published_at = datetime(2026, 1, 1, tzinfo=timezone.utc)
+
+    def layout():
+        message = aio_pika.Message(
+            json.dumps({"to": "a@x.com"}).encode(),
+            headers={"x-published-at": 1767225600000},
+            content_type="application/json",
+            delivery_mode=aio_pika.DeliveryMode.PERSISTENT,
+            priority=2,
+            correlation_id="req-1",
+            expiration=3600,
+            message_id="msg-1",
+            timestamp=published_at,
+        )
+        return {shard_queue_name(0, 2): [message], shard_queue_name(1, 2): []}
+
+    channel = BrokerChannel(layout(), consumers={shard_queue_name(1, 2): 1})
+    with pytest.raises(RuntimeError, match="consumer"):
+        asyncio.run(migrate_shards(channel, 2, 1))
+    assert channel.queues[shard_queue_name(0, 2)]  # nothing moved
+
+    channel = BrokerChannel(layout(), publisher_running=True)
+    assert asyncio.run(migrate_shards(channel, 2, 1)) == 1
+    assert channel.deleted == [shard_queue_name(1, 2)]  # the queue still being written to is kept
+
+    channel = BrokerChannel(layout())
+    assert asyncio.run(migrate_shards(channel, 2, 1)) == 1
+    assert channel.deleted == [shard_queue_name(0, 2), shard_queue_name(1, 2)]
+    migrated, = channel.queues[settings.email_queue_name]
+    assert (migrated.message_id, migrated.correlation_id, migrated.priority, migrated.timestamp) == ("msg-1", "req-1", 2, published_at)
+    assert (migrated.content_type, migrated.expiration, migrated.headers) == ("application/json", 3600, {"x-published-at": 1767225600000})
@@ -0,0 +1,168 @@
+import asyncio
+import json
+import pytest
+from types import SimpleNamespace
+from app.services.status_hub import StatusHub
+
+
+@pytest.fixture
+def anyio_backend():
+    return "asyncio"
+
+
+def events(chunks: list[bytes]) -> list[tuple[str, dict]]:
+    parsed = []
+    for chunk in chunks:
+        fields = dict(line.split(": ", 1) for line in chunk.decode().strip().splitlines() if not line.startswith(":"))
+        parsed.append((fields["event"], json.loads(fields["data"])))
+    return parsed
+
+
+async def take(stream, count: int) -> list[bytes]:
+    return [await asyncio.wait_for(stream.__anext__(), 1) for _ in range(count)]
+
+
+@pytest.mark.anyio
+async def test_fan_out_reaches_only_matching_subscribers():
+    hub = StatusHub()
+    everything = hub.subscribe()
+    only_a = hub.subscribe(["a"])
+    a_and_b = hub.subscribe(["a", "b"])
+
+    for request_id in ("a", "b", "c"):
+        hub.publish(request_id, "delivered", relay="primary")
+
+    def seen(subscription) -> list[str]:
+        return [subscription.queue.get_nowait().request_id for _ in range(subscription.queue.qsize())]
+
+    assert (seen(everything), seen(only_a), seen(a_and_b)) == (["a", "b", "c"], ["a"], ["a", "b"])
+    assert hub.stats() == {"published": 3, "subscribers_all": 1, "subscribed_request_ids": 2}
+
+    for subscription in (everything, only_a, a_and_b):
+        hub.unsubscribe(subscription)
+    hub.publish("a", "failed")  # nobody listens: not even serialized
+    assert hub.stats() == {"published": 3, "subscribers_all": 0, "subscribed_request_ids": 0}
+
+
+@pytest.mark.anyio
+async def test_slow_subscriber_drops_the_oldest_and_is_told_it_lagged():
+    hub = StatusHub()
+    subscription = hub.subscribe(["r1"], maxsize=2)
+    for status in ("pending", "sending", "retrying", "delivered", "webhook"):
+        hub.publish("r1", status)  # never blocks the publisher
+    assert subscription.dropped == 3
+
+    stream = subscription.stream(heartbeat=0.01)
+    received = events(await take(stream, 3))
+    assert received == [
+        ("lagged", {"dropped": 3}),
+        ("status", {**received[1][1], "request_id": "r1", "status": "delivered"}),
+        ("status", {**received[2][1], "request_id": "r1", "status": "webhook"}),
+    ]
+    assert subscription.dropped == 0
+    assert await take(stream, 1) == [b": keepalive\n\n"]
+    await stream.aclose()
+
+
+@pytest.mark.anyio
+async def test_status_stream_endpoint_sends_current_status_then_transitions(monkeypatch):
+    from app import main
+
+    hub = StatusHub()
+    monkeypatch.setattr(main, "status_hub", hub)
+    monkeypatch.setitem(main.email_status_store, "stream-1", "pending")
+
+    response = await main.status_stream(request_ids="stream-1, stream-2")
+    assert response.media_type == "text/event-stream"
+    stream = response.body_iterator
+    first = await take(stream, 1)
+    hub.publish("stream-2", "delivered")
+    hub.publish("stream-3", "delivered")  # not subscribed
+    hub.publish("stream-1", "failed", error="550")
+    received = events(first + await take(stream, 2))
+
+    assert [(name, data["request_id"], data["status"]) for name, data in received] == [
+        ("status", "stream-1", "pending"),
+        ("status", "stream-2", "delivered"),
+        ("status", "stream-1", "failed"),
+    ]
+    assert received[2][1]["error"] == "550"
+    await stream.aclose()
+    assert hub.stats()["subscribed_request_ids"] == 0  # closing the response unsubscribes
+
+
+class FanoutBroker:
+    """In-memory fanout exchanges shared by the channels of several processes."""
+
+    def __init__(self):
+        self.bindings: dict[str, list] = {}
+
+    def channel(self):
+        return FanoutChannel(self)
+
+
+class FanoutChannel:
+    def __init__(self, broker: FanoutBroker):
+        self.broker = broker
+
+    async def declare_exchange(self, name, kind, durable=False):
+        broker = self.broker
+
+        class Exchange:
+            async def publish(self, message, routing_key):
+                for callback in list(broker.bindings.get(name, [])):
+                    await callback(SimpleNamespace(body=message.body))
+
+        broker.bindings.setdefault(name, [])
+        exchange = Exchange()
+        exchange.name = name
+        return exchange
+
+    async def declare_queue(self, exclusive=False, auto_delete=False, arguments=None):
+        broker = self.broker
+        queue = SimpleNamespace(name="amq.gen-test", bound=[])
+
+        async def bind(exchange):
+            queue.bound.append(exchange.name)
+
+        async def consume(callback, no_ack=False):
+            for name in queue.bound:
+                broker.bindings[name].append(callback)
+
+        queue.bind, queue.consume = bind, consume
+        return queue
+
+
+@pytest.mark.anyio
+async def test_transitions_published_in_a_worker_reach_an_api_process_subscriber():
+    from app.services.status_hub import StatusEventBus
+
+    broker = FanoutBroker()
+    worker_hub, api_hub = StatusHub(), StatusHub()
+    worker_bus = StatusEventBus(worker_hub, "status-events")
+    api_bus = StatusEventBus(api_hub, "status-events")
+    seen_by_api: list[tuple[str, str]] = []
+    api_bus.listeners.append(lambda request_id, status: seen_by_api.append((request_id, status)))
+
+    assert await worker_bus.attach(broker.channel())
+    await api_bus.run(lambda: asyncio.sleep(0, broker.channel()))
+    assert not await api_bus.attach(broker.channel())  # already publishing through its listener channel
+
+    subscription = api_hub.subscribe(["r1"])
+    own_events = api_hub.subscribe()
+    stream = subscription.stream(heartbeat=5)
+
+    worker_hub.publish("r1", "delivered", relay="primary")
+    (kind, data), = events(await take(stream, 1))
+    assert (kind, data["request_id"], data["status"], data["relay"]) == ("status", "r1", "delivered", "primary")
+    assert seen_by_api == [("r1", "delivered")]
+
+    api_hub.publish("r2", "pending")
+    await asyncio.sleep(0)
+    # The API's own event came back over the exchange but was delivered locally only once
+    assert [own_events.queue.get_nowait().request_id for _ in range(own_events.queue.qsize())] == ["r1", "r2"]
+    assert (worker_bus.stats()["sent"], api_bus.stats()["sent"], api_bus.stats()["received"]) == (1, 1, 1)
+
+    await stream.aclose()
+    worker_bus.detach()
+    assert worker_hub.bus is None
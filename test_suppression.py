@@ -0,0 +1,153 @@
+from datetime import timedelta
+import pytest
+from sqlalchemy.ext.asyncio import async_sessionmaker
+from app.db import DBStats, create_async_db_engine
+from app.models import SuppressionEntry, utcnow
+from app.services.suppression import SuppressionList, SuppressionService
+
+
+@pytest.fixture
+def anyio_backend():
+    return "asyncio"
+
+
+@pytest.fixture
+async def session_factory(tmp_path):
+    engine = create_async_db_engine(f"sqlite:///{tmp_path}/suppression.db", stats=DBStats())
+    yield async_sessionmaker(bind=engine, expire_on_commit=False)
+    await engine.dispose()
+
+
+def test_lookup_matches_addresses_and_domains():
+    suppressed = SuppressionList(error_rate=0.01)
+    suppressed.build_from_values([f"user{i}@example.org" for i in range(5000)] + ["blocked.test", "@spam.test"])
+
+    assert suppressed.check("User42@Example.org") == "address"
+    assert suppressed.check("anyone@blocked.test") == "domain"
+    assert suppressed.check("x@spam.test") == "domain"
+    assert suppressed.check("user5000@example.org") is None
+    # Misses are mostly answered by the Bloom filter; memory stays ~8 bytes per entry plus the filter
+    assert sum(suppressed.check(f"other{i}@example.net") is None for i in range(2000)) == 2000
+    assert suppressed.stats()["memory_bytes"] < 5002 * 8 + 8 * 1024
+
+
+def test_delta_updates_and_compaction():
+    suppressed = SuppressionList(error_rate=0.01, compact_threshold=2)
+    suppressed.build_from_values(["a@x.test", "b@x.test"])
+
+    suppressed.add("c@x.test")
+    suppressed.remove("a@x.test")
+    assert suppressed.check("c@x.test") == "address"
+    assert suppressed.check("a@x.test") is None
+    assert suppressed.stats()["delta_added"] == 1 and suppressed.stats()["delta_removed"] == 1
+
+    suppressed.add("d@x.test")
+    assert suppressed.needs_compaction()
+    suppressed.compact()
+    stats = suppressed.stats()
+    assert (stats["base_entries"], stats["delta_added"], stats["delta_removed"]) == (3, 0, 0)
+    assert [suppressed.check(a) for a in ("a@x.test", "b@x.test", "c@x.test", "d@x.test")] == [None, "address", "address", "address"]
+
+
+@pytest.mark.anyio
+async def test_file_source(tmp_path):
+    path = tmp_path / "suppression.txt"
+    path.write_text("# hard bounces\nbounced@example.com\n\nexample.net  # whole domain\n")
+    service = SuppressionService(source="file")
+
+    assert service.check("bounced@example.com") is None  # nothing is suppressed before loading
+    assert await service.load_file(str(path)) == 2
+    service.loaded = True
+    assert service.check("bounced@example.com") == "address"
+    assert service.check("someone@example.net") == "domain"
+
+
+@pytest.mark.anyio
+async def test_database_source_refreshes_from_watermark(session_factory):
+    writer = SuppressionService(session_factory, source="database")
+    reader = SuppressionService(session_factory, source="database")
+    await writer.load_database()
+    await writer.add("first@example.com", "complaint")
+
+    assert await reader.load_database() == 1
+    reader.loaded = True
+    assert reader.check("first@example.com") == "address"
+
+    await writer.add("second@example.com", "hard_bounce")
+    await writer.remove("first@example.com")
+    await reader.refresh()
+    assert reader.check("second@example.com") == "address"
+    assert reader.check("first@example.com") is None
+
+    # Rows far older than the watermark are not re-read
+    async with session_factory() as session:
+        session.add(SuppressionEntry(value="old@example.com", updated_at=utcnow() - timedelta(days=1)))
+        await session.commit()
+    await reader.refresh()
+    assert reader.check("old@example.com") is None
+
+
+@pytest.mark.anyio
+async def test_suppression_writes_need_the_admin_token(monkeypatch):
+    import httpx
+    from app import main
+    from app.config import settings
+
+    service = SuppressionService(source="database")
+    changes = []
+
+    async def add(value, reason=None):
+        changes.append(("add", value))
+
+    async def remove(value):
+        changes.append(("remove", value))
+
+    monkeypatch.setattr(service, "add", add)
+    monkeypatch.setattr(service, "remove", remove)
+    monkeypatch.setattr(main, "suppression", service)
+    monkeypatch.setattr(settings, "admin_token", "t0ken")
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=main.app), base_url="http://test") as client:
+        anonymous = [
+            (await client.post("/suppressions", json={"value": "a@x.test"})).status_code,
+            (await client.delete("/suppressions/a@x.test")).status_code,
+        ]
+        admin = {"X-Admin-Token": "t0ken"}
+        allowed = [
+            (await client.post("/suppressions", json={"value": "a@x.test"}, headers=admin)).status_code,
+            (await client.delete("/suppressions/a@x.test", headers=admin)).status_code,
+        ]
+    assert (anonymous, allowed) == ([403, 403], [200, 200])
+    assert changes == [("add", "a@x.test"), ("remove", "a@x.test")]
+
+
+@pytest.mark.anyio
+async def test_changes_made_during_async_compaction_survive(monkeypatch):
+    suppressed = SuppressionList(error_rate=0.01)
+    suppressed.build_from_values(["a@x.test"])
+    suppressed.add("b@x.test")
+    suppressed.remove("a@x.test")
+    merge = suppressed._merge
+
+    def slow_merge(added, removed):
+        # Runs while the loop handles updates judged against the old base
+        suppressed.add("a@x.test")
+        suppressed.remove("b@x.test")
+        suppressed.add("c@x.test")
+        return merge(added, removed)
+
+    monkeypatch.setattr(suppressed, "_merge", slow_merge)
+    await suppressed.compact_async()
+    assert [suppressed.check(a) for a in ("a@x.test", "b@x.test", "c@x.test")] == ["address", None, "address"]
+
+
+@pytest.mark.anyio
+async def test_file_source_rejects_api_writes(monkeypatch):
+    import httpx
+    from app import main
+    from app.config import settings
+
+    monkeypatch.setattr(main, "suppression", SuppressionService(source="file"))
+    monkeypatch.setattr(settings, "admin_token", "t0ken")
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=main.app), base_url="http://test") as client:
+        response = await client.post("/suppressions", json={"value": "a@x.test"}, headers={"X-Admin-Token": "t0ken"})
+    assert response.status_code == 400
@@ -0,0 +1,173 @@
+import asyncio
+import random
+import time
+from collections import Counter
+from contextlib import ExitStack
+import httpx
+import pytest
+import replay_traffic
+from app.services import email_sender
+from app.services.queue_consumer import ConsumerPool
+from app.services.queue_publisher import message_headers
+from app.utils import tracing
+from app.utils.logger import CustomJsonFormatter, record_context
+
+
+@pytest.fixture
+def anyio_backend():
+    return "asyncio"
+
+
+class MemoryExporter(tracing.SpanExporter):
+    def __init__(self):
+        self.spans: list[dict] = []
+
+    def export(self, span: dict) -> None:
+        self.spans.append(span)
+
+
+@pytest.fixture
+def spans():
+    exporter = MemoryExporter()
+    previous = tracing.set_exporter(exporter)
+    yield exporter.spans
+    tracing.set_exporter(previous)
+
+
+def test_traceparent_round_trip():
+    context = tracing.parse_traceparent("00-4bf92f3577b34da6a3ce929d0e0e4736-00f067aa0ba902b7-01")
+    assert (context.trace_id, context.span_id, context.sampled) == ("4bf92f3577b34da6a3ce929d0e0e4736", "00f067aa0ba902b7", True)
+    assert context.traceparent == "00-4bf92f3577b34da6a3ce929d0e0e4736-00f067aa0ba902b7-01"
+    for bad in (None, "", "garbage", "00-" + "0" * 32 + "-00f067aa0ba902b7-01", "00-xyz-00f067aa0ba902b7-01"):
+        assert tracing.parse_traceparent(bad) is None
+
+
+def test_spans_nest_and_log_records_carry_the_trace(spans):
+    token = tracing.activate(tracing.new_trace(sample_rate=1.0))
+    try:
+        with tracing.span("outer") as outer:
+            with tracing.span("inner", stage=1) as inner:
+                record = CustomJsonFormatter().process_log_record({})
+            tracing.record_span("waited", 100.0, 100.25)
+    finally:
+        tracing.deactivate(token)
+
+    assert (record["trace_id"], record["span_id"]) == (inner.trace_id, inner.span_id)
+    by_name = {span["name"]: span for span in spans}
+    assert by_name["inner"]["parent_id"] == outer.span_id and by_name["inner"]["attributes"] == {"stage": 1}
+    assert by_name["waited"]["parent_id"] == outer.span_id and by_name["waited"]["duration_ms"] == 250
+    assert by_name["outer"]["parent_id"] is None
+    assert tracing.current() is None
+    with tracing.span("untraced") as context:
+        assert context is None
+    assert len(spans) == 3
+
+
+@pytest.mark.anyio
+async def test_request_ids_do_not_leak_between_tasks():
+    async def handle(request_id: str) -> str | None:
+        record_context.request_id = request_id
+        await asyncio.sleep(0.01)
+        return record_context.request_id
+
+    assert await asyncio.gather(handle("a"), handle("b")) == ["a", "b"]
+    assert record_context.request_id is None
+
+
+@pytest.mark.anyio
+async def test_one_trace_from_send_email_to_smtp(spans):
+    from app import main
+
+    incoming = "00-4bf92f3577b34da6a3ce929d0e0e4736-00f067aa0ba902b7-01"
+    broker = replay_traffic.StandInBroker()
+    smtp_stats: Counter = Counter()
+
+    async def open_smtp(relay):
+        smtp = replay_traffic.StandInSMTP(smtp_stats, 0.0, 0.0, random.Random(0))
+        await smtp.connect()
+        return smtp
+
+    with ExitStack() as stack:
+        stack.enter_context(replay_traffic.patched(main, publish_message=broker.publish))
+        stack.enter_context(replay_traffic.patched(email_sender, _open_smtp=open_smtp))
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=main.app), base_url="http://test") as client:
+            response = await client.post(
+                "/send_email",
+                json={"to": "trace@example.com", "subject": "Hi", "body": "Hello", "request_id": "trace-1"},
+                headers={"traceparent": incoming},
+            )
+        assert response.status_code == 200
+        assert response.headers["x-trace-id"] == "4bf92f3577b34da6a3ce929d0e0e4736"
+
+        message = broker.messages[0]
+        delivered = asyncio.get_running_loop().create_future()
+        delivery = replay_traffic.StandInMessage(message, lambda: delivered.done() or delivered.set_result(None))
+        delivery.headers = message_headers(message, published_at=int(time.time() * 1000))
+        pool = ConsumerPool(replay_traffic.StandInChannel())
+        pool.resize(1)
+        try:
+            await pool.buffer.put(delivery)
+            await asyncio.wait_for(delivered, 5)
+        finally:
+            await pool.stop()
+
+    assert smtp_stats["recipients"] == 1
+    assert {span["trace_id"] for span in spans} == {"4bf92f3577b34da6a3ce929d0e0e4736"}
+    by_name = {span["name"]: span for span in spans}
+    assert {"api", "queue_wait", "consume", "render", "smtp"} <= set(by_name)
+    assert by_name["api"]["parent_id"] == "00f067aa0ba902b7"
+    assert by_name["api"]["attributes"]["request_id"] == "trace-1"
+    assert by_name["consume"]["parent_id"] == by_name["queue_wait"]["parent_id"] == message["traceparent"].split("-")[2]
+    assert by_name["smtp"]["request_id"] == "trace-1"
+    assert set(tracing.breakdown(spans)["spans"]) == set(by_name)
+
+
+@pytest.mark.anyio
+async def test_file_exporter_and_trace_lookup(tmp_path):
+    exporter = tracing.FileSpanExporter(str(tmp_path / "spans.ndjson"))
+    previous = tracing.set_exporter(exporter)
+    try:
+        for _ in range(2):
+            token = tracing.activate(tracing.new_trace(sample_rate=1.0))
+            with tracing.span("api") as context:
+                with tracing.span("publish"):
+                    pass
+            tracing.deactivate(token)
+        await exporter.close()
+    finally:
+        tracing.set_exporter(previous)
+
+    spans = tracing.read_trace(context.trace_id, exporter.path)
+    assert sorted(span["name"] for span in spans) == ["api", "publish"]
+    assert tracing.breakdown(spans)["end_to_end_ms"] >= 0
+
+
+def test_exporters_must_implement_export(monkeypatch):
+    class Incomplete(tracing.SpanExporter):
+        pass
+
+    with pytest.raises(TypeError):
+        Incomplete()
+    monkeypatch.setattr(tracing, "NotAnExporter", object, raising=False)
+    with pytest.raises(TypeError):
+        tracing.load_exporter("app.utils.tracing:NotAnExporter")
+    assert isinstance(tracing.load_exporter("test_tracing:MemoryExporter"), MemoryExporter)
+
+
+def test_app_log_lines_carry_the_trace():
+    import logging
+    from app import main
+
+    record = logging.LogRecord("email_service_app", logging.INFO, __file__, 1, "queued", None, None)
+    token = tracing.activate(tracing.new_trace(sample_rate=1.0))
+    try:
+        with tracing.span("api") as context:
+            assert all(handler.filter(record) for handler in main.logger.handlers)
+            traced = main.log_formatter.format(record)
+    finally:
+        tracing.deactivate(token)
+    assert f"trace={context.trace_id} span={context.span_id}" in traced and traced.endswith("| queued")
+
+    untraced = logging.LogRecord("email_service_app", logging.INFO, __file__, 1, "idle", None, None)
+    assert all(handler.filter(untraced) for handler in main.logger.handlers)
+    assert "trace=- span=- request=-" in main.log_formatter.format(untraced)
@@ -0,0 +1,68 @@
+import json
+import pytest
+import replay_traffic
+from app.utils.traffic_capture import TrafficCapture
+
+
+@pytest.fixture
+def anyio_backend():
+    return "asyncio"
+
+
+def trace_entries(capture: TrafficCapture) -> list[dict]:
+    payloads = [
+        {"to": "Alice@Example.com", "subject": "Launch", "body": "Same body", "priority": 2, "meta": {"tenant": "acme"}},
+        {"to": "bob@example.com", "subject": "Launch", "body": "Same body"},
+        {"to": "alice@example.com", "subject": "Receipt", "body": "x" * 300},
+    ]
+    entries = []
+    for offset, payload in enumerate(payloads):
+        entry = capture.entry(payload, 200, 0.004, (payload.get("meta") or {}).get("tenant"))
+        entry["ts"] = 1000.0 + offset * 0.05
+        entries.append(entry)
+    return entries
+
+
+@pytest.mark.anyio
+async def test_capture_is_anonymized_but_keeps_the_workload_shape(tmp_path):
+    capture = TrafficCapture(str(tmp_path / "traffic.ndjson"), sample_rate=1.0, max_bytes=10_000, salt="s")
+    for payload in ({"to": "alice@example.com", "subject": "Hi", "body": "secret text"},) * 2:
+        capture.record(payload, 200, 0.01, "acme")
+    await capture.close()
+
+    lines = (tmp_path / "traffic.ndjson").read_text().splitlines()
+    assert len(lines) == 2
+    assert "alice" not in lines[0] and "secret" not in lines[0] and "acme" not in lines[0]
+    first, second = map(json.loads, lines)
+    assert first["to"] == second["to"] and first["to"].endswith(".example.com")
+    assert (first["subject_len"], first["body_len"], first["content"]) == (2, 11, second["content"])
+
+    entries = trace_entries(capture)
+    assert entries[0]["to"] == entries[2]["to"]  # case-insensitive recipient
+    assert entries[0]["to"].split("@")[1] == entries[1]["to"].split("@")[1]  # same domain
+    assert entries[0]["content"] == entries[1]["content"] != entries[2]["content"]
+
+
+def test_payloads_are_rebuilt_deterministically():
+    capture = TrafficCapture("unused", sample_rate=1.0, max_bytes=0, salt="s")
+    entries = trace_entries(capture)
+    first, second, third = (replay_traffic.payload_for(entry, i, {}) for i, entry in enumerate(entries))
+
+    assert (first["subject"], first["body"]) == (second["subject"], second["body"])
+    assert len(third["body"]) == 300 and third["body"] != first["body"]
+    assert replay_traffic.arrival_offsets(entries, 10) == pytest.approx([0, 0.005, 0.01])
+    assert replay_traffic.percentile([1, 2, 3, 4], 50) == 2
+
+
+@pytest.mark.anyio
+async def test_replay_against_the_app_and_the_consumer():
+    capture = TrafficCapture("unused", sample_rate=1.0, max_bytes=0, salt="s")
+    entries = trace_entries(capture)
+
+    report = await replay_traffic.replay_http(entries, speed=None, concurrency=10)
+    assert report["outcomes"] == {200: 3} and report["published"] == 3
+    assert report["latency_ms"]["max"] is not None
+
+    report = await replay_traffic.replay_consumer(entries, speed=None, workers=2, smtp_latency=0)
+    assert report["outcomes"] == {"delivered": 3}
+    assert report["smtp"]["recipients"] == 3
@@ -0,0 +1,141 @@
+import asyncio
+import json
+import httpx
+import pytest
+import replay_traffic
+from app.services import queue_consumer
+from app.services import webhooks as webhooks_module
+from app.services.queue_publisher import build_message
+from app.config import settings
+from app.services.webhooks import WebhookDispatcher, sign
+
+
+@pytest.fixture
+def anyio_backend():
+    return "asyncio"
+
+
+@pytest.fixture(autouse=True)
+def public_dns(monkeypatch):
+    """Every callback host resolves to a public address unless a test says otherwise."""
+    addresses = {"internal.example": ["10.0.0.5"], "rebind.example": ["93.184.216.34", "127.0.0.1"]}
+
+    async def resolve_host(host: str, port: int) -> list[str]:
+        return addresses.get(host, ["93.184.216.34"])
+
+    monkeypatch.setattr(webhooks_module, "resolve_host", resolve_host)
+
+
+class Receiver:
+    """httpx.MockTransport handler answering with a scripted list of status codes."""
+
+    def __init__(self, *statuses: int):
+        self.statuses = list(statuses)
+        self.requests: list[httpx.Request] = []
+
+    def __call__(self, request: httpx.Request) -> httpx.Response:
+        self.requests.append(request)
+        status = self.statuses.pop(0) if self.statuses else 200
+        return httpx.Response(status)
+
+    def events(self) -> list[dict]:
+        return [event for request in self.requests for event in json.loads(request.content)["events"]]
+
+
+def dispatcher(receiver: Receiver, **options) -> WebhookDispatcher:
+    client = httpx.AsyncClient(transport=httpx.MockTransport(receiver))
+    return WebhookDispatcher(linger_ms=10, backoff=0.01, client=client, **options)
+
+
+@pytest.mark.anyio
+async def test_events_are_batched_per_endpoint_and_signed():
+    receiver = Receiver()
+    hooks = dispatcher(receiver, secret="s3cret")
+    for index in range(5):
+        hooks.emit("https://a.example/hook", {"request_id": f"a{index}", "status": "delivered"})
+    hooks.emit("https://b.example/hook", {"request_id": "b0", "status": "failed"})
+    await hooks.close()
+
+    assert sorted(str(request.url) for request in receiver.requests) == ["https://a.example/hook", "https://b.example/hook"]
+    batch = next(request for request in receiver.requests if request.url.host == "a.example")
+    assert [event["request_id"] for event in json.loads(batch.content)["events"]] == ["a0", "a1", "a2", "a3", "a4"]
+    for request in receiver.requests:
+        assert request.headers["x-webhook-signature"] == sign(request.content, "s3cret")
+    assert hooks.stats()["delivered"] == 6 and hooks.stats()["posts"] == 2
+
+
+@pytest.mark.anyio
+async def test_failed_posts_are_retried_then_the_circuit_opens():
+    receiver = Receiver(503, 200)
+    hooks = dispatcher(receiver, retries=3)
+    hooks.emit("https://a.example/hook", {"request_id": "r1", "status": "delivered"})
+    await hooks.flush()
+    assert len(receiver.requests) == 2 and hooks.counts["delivered"] == 1 and hooks.counts["retries"] == 1
+
+    down = Receiver(500, 500, 500, 500)
+    hooks = dispatcher(down, retries=1, failure_threshold=2)
+    for index in range(3):
+        hooks.emit("https://down.example/hook", {"request_id": f"r{index}", "status": "delivered"})
+        await hooks.flush()
+    assert len(down.requests) == 2  # the third batch is failed without a request
+    assert hooks.stats()["failed"] == 3 and hooks.stats()["open_circuits"] == 1
+    await hooks.close()
+
+
+@pytest.mark.anyio
+async def test_callbacks_to_private_addresses_are_blocked():
+    receiver = Receiver()
+    hooks = dispatcher(receiver)
+    for url in ("https://internal.example/hook", "https://rebind.example/hook", "https://ok.example/hook"):
+        hooks.emit(url, {"request_id": "r1", "status": "delivered"})
+    await hooks.close()
+
+    assert [request.url.host for request in receiver.requests] == ["ok.example"]
+    assert hooks.stats()["blocked"] == 2 and hooks.stats()["failed"] == 2
+    for url in ("http://127.0.0.1/", "http://169.254.169.254/latest/meta-data", "http://[::1]:8080/", "http://10.1.2.3/"):
+        assert not webhooks_module.valid_callback_url(url)
+
+
+@pytest.mark.anyio
+async def test_consumer_notifies_the_callback_url(monkeypatch):
+    receiver = Receiver()
+    hooks = dispatcher(receiver)
+    monkeypatch.setattr(webhooks_module, "webhooks", hooks)
+
+    async def send_email(recipient, subject, body, attachments=None):
+        await asyncio.sleep(0)
+
+    monkeypatch.setattr(queue_consumer, "send_email", send_email)
+    with_callback = build_message("a@example.com", "s", "b", "hooked", meta={"callback_url": "https://cb.example/hook"})
+    without = build_message("b@example.com", "s", "b", "plain")
+    for message in (with_callback, without):
+        await queue_consumer.process_message(None, replay_traffic.StandInMessage(message, lambda: None), message)
+    await hooks.close()
+
+    assert [(event["request_id"], event["status"]) for event in receiver.events()] == [("hooked", "delivered")]
+
+
+@pytest.mark.anyio
+async def test_send_email_accepts_callback_urls_only_from_tenants_or_allowed_hosts(monkeypatch):
+    from app import main
+
+    monkeypatch.setattr(main, "api_key_tenants", lambda: {"k1": "acme"})
+    monkeypatch.setattr(settings, "webhook_allowed_hosts", ".trusted.example")
+    broker = replay_traffic.StandInBroker()
+
+    async def post(callback_url: str, api_key: str | None = None) -> int:
+        payload = {"to": "a@example.com", "subject": "s", "body": "b", "meta": {"callback_url": callback_url}}
+        response = await client.post("/send_email", json=payload, headers={"X-API-Key": api_key} if api_key else {})
+        return response.status_code
+
+    with replay_traffic.patched(main, publish_message=broker.publish):
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=main.app), base_url="http://test") as client:
+            statuses = [
+                await post("ftp://x", "k1"),
+                await post("http://169.254.169.254/latest/meta-data", "k1"),
+                await post("https://cb.example/hook"),
+                await post("https://cb.example/hook", "k1"),
+                await post("https://hooks.trusted.example/email"),
+            ]
+    assert statuses == [400, 400, 403, 200, 200]
+    assert [message["meta"]["callback_url"] for message in broker.messages] == ["https://cb.example/hook", "https://hooks.trusted.example/email"]
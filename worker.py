@@ -1,12 +1,55 @@
 import asyncio
+import platform
+import signal
+from app.db import dispose_async_engine
+from app.services.content_store import check_content_store
 from app.services.queue_consumer import consume
-from app.utils.logger import get_logger
+from app.services.render_pool import render_pool
+from app.services.suppression import suppression
+from app.services.webhooks import webhooks
+from app.utils.logger import flush_logs, get_logger
+from app.utils.tracing import close_exporter
+from app.utils.runtime import run
 
 logger = get_logger("worker")
 
-if __name__ == "__main__":
+async def run_worker():
+    stop = asyncio.Event()
+    if platform.system() != "Windows":
+        # Drain instead of dying mid-delivery: see consume()
+        loop = asyncio.get_running_loop()
+        loop.add_signal_handler(signal.SIGTERM, stop.set)
+        loop.add_signal_handler(signal.SIGINT, stop.set)
+
+    check_content_store("worker")
+    if suppression.enabled:
+        await suppression.start()
+    try:
+        while not stop.is_set():
+            try:
+                await consume(stop)
+            except Exception as e:
+                logger.error({"status": "consumer_crashed", "error": str(e)})
+            # Broker connection lost: reconnect after a pause
+            try:
+                await asyncio.wait_for(stop.wait(), 5)
+            except asyncio.TimeoutError:
+                pass
+    finally:
+        await webhooks.close()
+        await suppression.stop()
+        render_pool.close()
+        await close_exporter()
+        await dispose_async_engine()
+        logger.info("worker_stopped")
+        flush_logs()
+
+def main():
     try:
         logger.info("worker_starting")
-        asyncio.run(consume())
+        run(run_worker())
     except KeyboardInterrupt:
         logger.info("worker_stopped")
+
+if __name__ == "__main__":
+    main()